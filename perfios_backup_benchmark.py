@@ -0,0 +1,551 @@
+"""
+Benchmarks for perfios_backup_to_s3. Run from the directory perfios_backup_to_s3 runs from, as it logs to logs/bk.log
+
+Usage:
+python3 perfios_backup_benchmark.py [-h] [-b] [-n] [-s] [-g] [-w] [-d] [-t] [--distribution] [--files_per_dir]
+                                    [--change_rate] [--seed] [--hash_algorithm] [--endpoint_url] [--bucket]
+                                    [--baseline] [--save_baseline] [--tolerance]
+optional arguments:
+  -h, --help           show this help message and exit
+  -b , --benchmark     Benchmark to run. encrypt, walk, hash, suite, file_info
+  -n , --files         Number of files, the number of entries of the file_info benchmark
+  -s , --size          Size of each file in bytes. The mean size with the uniform and lognormal distributions
+  -g , --gpg_id        GPG ID used by the gpg encryptor. The gpg encryptor is skipped if not given
+  -w , --work_dir      Directory the synthetic files are created in. By default a temporary directory
+  -d , --depth         Depth of the synthetic tree
+  -t , --threads       Threads listing the directories in the parallel walk, hashing the files in the suite
+  --distribution       Distribution of the file sizes of the suite. fixed, uniform, lognormal
+  --files_per_dir      Files in each directory of the synthetic tree. By default 100
+  --change_rate        Fraction of the files changed between the two scans of the suite
+  --seed               Seed of the sizes, contents and changes of the suite, so that runs are comparable
+  --hash_algorithm     Hash algorithm of the scans of the suite, see checksum
+  --endpoint_url       S3 stand-in the suite uploads to, e.g. moto_server or minio. The upload is skipped if not
+                       given. The credentials are read from the environment as usual
+  --bucket             Bucket the suite uploads to, created if missing
+  --baseline           Results of an earlier suite run to compare with. Exits with 1 on a regression
+  --save_baseline      File the results of the suite are saved to, to be used as the baseline of later runs
+  --tolerance          Fraction a stage may be slower than the baseline before it is reported as a regression
+
+The encrypt benchmark compares the files per second of gpg, one process per file, against the in process aes-gcm
+encryptor.
+The walk benchmark compares os.walk followed by an os.stat per file, the walk scan used to do, against scandir_walk
+serially and with a thread pool. For the tree of a million files, which is reused from the work_dir if present:
+python3 perfios_backup_benchmark.py -b walk -n 1000000 -s 0 -w /data/walk_benchmark
+The hash benchmark compares the MB/s of the hash algorithms available to checksum, and the hash with the Content-MD5
+in a single pass against two passes over the files.
+The suite generates a tree, then times scan, compare, a rescan after change_rate of the files changed, compare,
+the dedup chunking, compress, encrypt, archive, upload and restore of the changed files. The restore verifies each file
+against the Local-Hash of its object, hashed with --hash_algorithm. It reports the seconds, files/s, MB/s and the peak
+RSS after each stage. e.g.
+python3 perfios_backup_benchmark.py -b suite -n 10000 -s 65536 --distribution lognormal \
+    --endpoint_url http://localhost:5000 --save_baseline baseline.json
+python3 perfios_backup_benchmark.py -b suite -n 10000 -s 65536 --distribution lognormal \
+    --endpoint_url http://localhost:5000 --baseline baseline.json
+The progress printed by the stages goes to stderr, the results to stdout.
+The file_info benchmark compares the RSS, build and lookup time of the file information of PickleManifest as a dict of
+dicts, as it used to be, against the FileTable, each built in its own process. The entries are added in random order,
+as the hash workers complete them, spread over directories of files_per_dir files. No files are created. e.g.
+python3 perfios_backup_benchmark.py -b file_info -n 5000000
+
+Author: Sudharshan
+"""
+
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+from perfios_backup_to_s3 import AesGcmEncryptor
+from perfios_backup_to_s3 import FileTable
+from perfios_backup_to_s3 import GpgEncryptor
+from perfios_backup_to_s3 import SqliteManifest
+from perfios_backup_to_s3 import cdc_chunks
+from perfios_backup_to_s3 import checksum
+from perfios_backup_to_s3 import compare
+from perfios_backup_to_s3 import compress
+from perfios_backup_to_s3 import encrypt
+from perfios_backup_to_s3 import file_filter
+from perfios_backup_to_s3 import hash_constructor
+from perfios_backup_to_s3 import s3_client
+from perfios_backup_to_s3 import scan
+from perfios_backup_to_s3 import scandir_walk
+from perfios_backup_to_s3 import s3_key
+from perfios_backup_to_s3 import upload
+from perfios_restore_from_s3 import Restorer
+
+# mtime of the synthetic files, old enough not to be ignored by consider_older
+BASE_TIME = 1577836800
+
+
+def make_files(root, count, size):
+    """
+    Create count files of size random bytes below root
+    :param root:
+    :param count:
+    :param size:
+    :return: list of locations
+    """
+    os.makedirs(root, exist_ok=True)
+    locations = list()
+    for i in range(count):
+        location = os.path.join(root, "file_{}.bin".format(i))
+        with open(location, "wb") as f:
+            f.write(os.urandom(size))
+        locations.append(location)
+    return locations
+
+
+def file_size(rng, size, distribution="fixed"):
+    """
+    :param rng: random.Random
+    :param size: Mean size
+    :param distribution: "fixed", "uniform" or "lognormal", the long tail of a few large files among many small ones
+    :return: int
+    """
+    if distribution == "uniform":
+        return rng.randint(0, 2 * size)
+    if distribution == "lognormal":
+        sigma = 1.5
+        return int(rng.lognormvariate(math.log(max(size, 1)) - sigma * sigma / 2, sigma))
+    return size
+
+
+def file_content(rng, size):
+    """
+    :param rng: random.Random. None for random bytes from os.urandom
+    :param size:
+    :return: size bytes, half random and half repeated text with rng, so that the files compress about 2:1
+    """
+    if rng is None:
+        return os.urandom(size)
+    half = size // 2
+    return rng.randbytes(half) + (b"perfios backup benchmark " * (half // 25 + 1))[:size - half]
+
+
+def make_tree(root, count, size, depth=3, files_per_dir=100, distribution="fixed", seed=None, reuse=True):
+    """
+    Create count files in a tree of depth levels below root, files_per_dir files per directory. The files have an old
+    mtime, so that scan doesn't ignore them.
+    :param root:
+    :param count:
+    :param size: Size of each file, the mean size with the uniform and lognormal distributions
+    :param depth:
+    :param files_per_dir:
+    :param distribution: see file_size
+    :param seed: Seed of the sizes and contents, None for random contents
+    :param reuse: If True, an existing tree at root is reused as is
+    :return: root
+    """
+    if os.path.isdir(root):
+        if reuse:
+            print("Reusing the tree at {}".format(root), file=sys.stderr)
+            return root
+        shutil.rmtree(root)
+    rng = random.Random(seed) if seed is not None else None
+    dirs = max(1, -(-count // files_per_dir))
+    fanout = max(2, int(round(dirs ** (1 / depth))) + 1)
+    for i in range(count):
+        leaf = i // files_per_dir
+        directory = os.path.join(root, *("d{}".format((leaf // fanout ** level) % fanout) for level in range(depth)))
+        if i % files_per_dir == 0:
+            os.makedirs(directory, exist_ok=True)
+        location = os.path.join(directory, "file_{}.bin".format(i))
+        with open(location, "wb") as f:
+            f.write(file_content(rng, file_size(rng or random, size, distribution)))
+        os.utime(location, (BASE_TIME, BASE_TIME))
+    return root
+
+
+def tree_files(root):
+    """
+    :param root:
+    :return: sorted list of the files below root
+    """
+    return sorted(os.path.join(directory, name) for directory, _, names in os.walk(root) for name in names)
+
+
+def change_tree(locations, change_rate, rng):
+    """
+    Rewrite change_rate of the locations with new contents of the same size and a newer mtime
+    :param locations:
+    :param change_rate: Fraction of the files changed
+    :param rng: random.Random
+    :return: list of the changed locations
+    """
+    changed = sorted(rng.sample(locations, int(len(locations) * change_rate)))
+    for location in changed:
+        size = os.path.getsize(location)
+        with open(location, "wb") as f:
+            f.write(file_content(rng, size))
+        os.utime(location, (BASE_TIME + 86400, BASE_TIME + 86400))
+    return changed
+
+
+def peak_rss_mb():
+    """
+    :return: Peak resident set size of the process in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    """
+    :return: Resident set size of the process in MB, the peak where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def build_file_info(representation, entries, files_per_dir, seed=1):
+    """
+    Build the file information of entries synthetic files in random order, in a process of its own
+    :param representation: "dict" or "file_table"
+    :param entries:
+    :param files_per_dir:
+    :param seed:
+    :return: dict of the results
+    """
+    rng = random.Random(seed)
+    locations = ["/data/backup/statements/d{}/d{}/statement_{:08d}.pdf".format(
+        i // files_per_dir // 100, i // files_per_dir % 100, i) for i in range(entries)]
+    rng.shuffle(locations)
+    rss = current_rss_mb()
+    start = time.time()
+    file_info = FileTable() if representation == "file_table" else dict()
+    for i, location in enumerate(locations):
+        file_info[location] = {"hash": "{:040x}".format(rng.getrandbits(160)),
+                               "stat": (rng.randrange(1 << 30), BASE_TIME * 10 ** 9 + rng.randrange(10 ** 15),
+                                        1000000 + i, 2049)}
+    if representation == "file_table":
+        file_info.pack()
+    elapsed = time.time() - start
+    rss = current_rss_mb() - rss
+    keys = rng.sample(locations, min(100000, entries))
+    start = time.time()
+    for location in keys:
+        file_info[location]["hash"]
+    lookup = time.time() - start
+    return {"entries": len(file_info), "rss_mb": rss, "bytes_per_entry": rss * 1048576 / max(entries, 1),
+            "build_seconds": elapsed, "lookups_per_second": len(keys) / max(lookup, 1e-6)}
+
+
+def bench_file_info(entries, files_per_dir):
+    """
+    :param entries:
+    :param files_per_dir:
+    :return: dict of the results of each representation
+    """
+    results = dict()
+    context = multiprocessing.get_context("spawn")
+    for representation in ("dict", "file_table"):
+        with context.Pool(1) as pool:
+            results[representation] = pool.apply(build_file_info, (representation, entries, files_per_dir))
+    results["rss_reduction"] = results["dict"]["rss_mb"] / max(results["file_table"]["rss_mb"], 1e-6)
+    return results
+
+
+def run_stage(stages, name, function, files, size):
+    """
+    Time a stage of the suite into stages
+    :param stages: dict of the results of the stages
+    :param name: Name of the stage
+    :param function: Runs the stage, its output is printed to stderr
+    :param files: Number of files processed by the stage
+    :param size: Bytes processed by the stage
+    :return: Return value of function
+    """
+    start = time.time()
+    with contextlib.redirect_stdout(sys.stderr):
+        value = function()
+    elapsed = max(time.time() - start, 1e-6)
+    stages[name] = {"seconds": elapsed, "files": files, "bytes": size, "files_per_second": files / elapsed,
+                    "mb_per_second": size / 1048576 / elapsed, "peak_rss_mb": peak_rss_mb()}
+    return value
+
+
+def bench_suite(args, work_dir):
+    """
+    Time the stages of a backup run on a synthetic tree
+    :param args: Parsed arguments
+    :param work_dir:
+    :return: dict of the results of the stages
+    """
+    root = make_tree(os.path.join(work_dir, "tree"), args.files, args.size, args.depth, args.files_per_dir,
+                     args.distribution, args.seed, reuse=False)
+    tmp = os.path.join(work_dir, "tmp")
+    os.makedirs(tmp, exist_ok=True)
+    db_path = os.path.join(work_dir, "manifest.db")
+    for path in (db_path, db_path + "-wal", db_path + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    manifest = SqliteManifest(db_path)
+    locations = tree_files(root)
+    size = sum(os.path.getsize(location) for location in locations)
+    stages = dict()
+
+    run_stage(stages, "scan", lambda: scan(root, None, None, hash_workers=args.threads, manifest=manifest,
+                                           hash_algorithm=args.hash_algorithm),
+              len(locations), size)
+    # compare streams the changed files, they are listed to time the whole diff
+    changed = run_stage(stages, "compare", lambda: list(compare(manifest, root)[0]), len(locations), 0)
+    # As if the first run backed up every file
+    for location in changed:
+        manifest.commit(location)
+    manifest.save()
+
+    changed = change_tree(locations, args.change_rate, random.Random(args.seed))
+    changed_size = sum(os.path.getsize(location) for location in changed)
+    run_stage(stages, "rescan", lambda: scan(root, None, None, hash_workers=args.threads, manifest=manifest,
+                                             hash_algorithm=args.hash_algorithm),
+              len(locations), changed_size)
+    changed = run_stage(stages, "compare_changed", lambda: list(compare(manifest, root)[0]), len(locations), 0)
+    hashes = [manifest.current(location)["hash"] for location in changed]
+    manifest.save()
+    manifest.close()
+
+    run_stage(stages, "chunk", lambda: [chunk_file(location) for location in changed], len(changed), changed_size)
+
+    compressed = run_stage(stages, "compress", lambda: [compress(location, tmp) for location in changed],
+                           len(changed), changed_size)
+    encryptor = AesGcmEncryptor(os.urandom(32))
+    compressed_size = sum(os.path.getsize(location) for location in compressed)
+    encrypted = run_stage(stages, "encrypt", lambda: [encrypt(location, encryptor) for location in compressed],
+                          len(compressed), compressed_size)
+
+    def archive():
+        with tarfile.open(os.path.join(tmp, "archive.tar.gz"), "w:gz") as archiver:
+            for location in changed:
+                archiver.add(location, arcname=location[len(root) + 1:], recursive=False)
+
+    run_stage(stages, "archive", archive, len(changed), changed_size)
+
+    if args.endpoint_url:
+        s3 = s3_client(boto3.session.Session(), args.endpoint_url)
+        try:
+            s3.create_bucket(Bucket=args.bucket)
+        except ClientError:
+            # Already present
+            pass
+        encrypted_size = sum(os.path.getsize(location) for location in encrypted)
+        run_stage(stages, "upload", lambda: [upload(s3, root, args.bucket, "benchmark", location, encrypted_location,
+                                                    "2020-01-01", local_hash=local_hash)
+                                             for location, encrypted_location, local_hash in
+                                             zip(changed, encrypted, hashes)],
+                  len(encrypted), encrypted_size)
+
+        # A file not matching the Local-Hash of its object fails the suite
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            restorer = Restorer(s3, args.bucket, "benchmark", root, os.path.join(work_dir, "restored"), executor,
+                                "aes-gcm", encryptor, True)
+            keys = [s3_key(root, "benchmark", location, encrypted_location)
+                    for location, encrypted_location in zip(changed, encrypted)]
+            run_stage(stages, "restore", lambda: [restorer.restore(key, key[len("benchmark/"):],
+                                                                   os.path.getsize(encrypted_location))
+                                                  for key, encrypted_location in zip(keys, encrypted)],
+                      len(encrypted), changed_size)
+    return stages
+
+
+def chunk_file(location):
+    """
+    Split location into the content defined chunks of the dedup mode
+    :param location:
+    :return: Number of chunks
+    """
+    with open(location, "rb") as f_in:
+        return sum(1 for _ in cdc_chunks(f_in))
+
+
+def compare_baseline(stages, baseline, tolerance):
+    """
+    Compare the seconds of the stages against the baseline
+    :param stages: dict of the results of the stages
+    :param baseline: Results of an earlier run
+    :param tolerance: Fraction a stage may be slower than the baseline
+    :return: dict of {stage: {"ratio": .., "regression": bool}}
+    """
+    comparison = dict()
+    for name, result in stages.items():
+        base = baseline.get("results", dict()).get(name)
+        if not base:
+            continue
+        ratio = result["seconds"] / max(base["seconds"], 1e-6)
+        # Stages taking a few milliseconds are too noisy to compare
+        regression = ratio > 1 + tolerance and result["seconds"] - base["seconds"] > 0.05
+        comparison[name] = {"ratio": ratio, "regression": regression}
+    return comparison
+
+
+def bench_walk(walker, root):
+    """
+    Walk root, stat-ing every file
+    :param walker: function taking root and returning the number of files
+    :param root:
+    :return: dict having the seconds, files and files/s
+    """
+    start = time.time()
+    files = walker(root)
+    elapsed = max(time.time() - start, 1e-6)
+    return {"seconds": elapsed, "files": files, "files_per_second": files / elapsed}
+
+
+def os_walk_files(root):
+    included = file_filter(None, None)
+    files = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if included(name):
+                os.stat(os.path.join(directory, name))
+                files += 1
+    return files
+
+
+def scandir_walk_files(root, workers=0):
+    return sum(len(included_files) for _, included_files, _ in scandir_walk([root], file_filter(None, None), workers))
+
+
+def bench_hash(hasher, locations):
+    """
+    Hash every location
+    :param hasher: function taking the location
+    :param locations:
+    :return: dict having the seconds and MB/s
+    """
+    start = time.time()
+    size = 0
+    for location in locations:
+        hasher(location)
+        size += os.path.getsize(location)
+    elapsed = max(time.time() - start, 1e-6)
+    return {"seconds": elapsed, "mb_per_second": size / 1048576 / elapsed}
+
+
+def bench_encrypt(encryptor, locations, tmp):
+    """
+    Encrypt every location into tmp
+    :param encryptor: GpgEncryptor/AesGcmEncryptor
+    :param locations:
+    :param tmp: temporary location the encrypted files are written to
+    :return: dict having the seconds, files/s and MB/s
+    """
+    start = time.time()
+    size = 0
+    for location in locations:
+        os.remove(encrypt(tmp, encryptor, location))
+        size += os.path.getsize(location)
+    elapsed = max(time.time() - start, 1e-6)
+    return {"seconds": elapsed, "files_per_second": len(locations) / elapsed,
+            "mb_per_second": size / 1048576 / elapsed}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-b", "--benchmark", help="Benchmark to run",
+                        choices=["encrypt", "walk", "hash", "suite", "file_info"], default="encrypt")
+    parser.add_argument("-n", "--files", help="Number of files", type=int, metavar="", default=500)
+    parser.add_argument("-s", "--size", help="Size of each file in bytes", type=int, metavar="", default=16384)
+    parser.add_argument("-g", "--gpg_id", help="GPG ID used by the gpg encryptor", type=str, metavar="", default=None)
+    parser.add_argument("-w", "--work_dir", help="Directory the synthetic files are created in", type=str,
+                        metavar="", default=None)
+    parser.add_argument("-d", "--depth", help="Depth of the synthetic tree", type=int, metavar="", default=3)
+    parser.add_argument("-t", "--threads", help="Threads listing the directories in the parallel walk", type=int,
+                        metavar="", default=8)
+    parser.add_argument("--distribution", help="Distribution of the file sizes", choices=["fixed", "uniform",
+                                                                                         "lognormal"],
+                        default="fixed")
+    parser.add_argument("--files_per_dir", help="Files in each directory", type=int, metavar="", default=100)
+    parser.add_argument("--change_rate", help="Fraction of the files changed", type=float, metavar="", default=0.1)
+    parser.add_argument("--seed", help="Seed of the sizes, contents and changes", type=int, metavar="", default=1)
+    parser.add_argument("--hash_algorithm", help="Hash algorithm of the scans", type=str, metavar="", default="sha1")
+    parser.add_argument("--endpoint_url", help="S3 stand-in the suite uploads to", type=str, metavar="",
+                        default=None)
+    parser.add_argument("--bucket", help="Bucket the suite uploads to", type=str, metavar="", default="benchmark")
+    parser.add_argument("--baseline", help="Results to compare with", type=str, metavar="", default=None)
+    parser.add_argument("--save_baseline", help="File the results are saved to", type=str, metavar="", default=None)
+    parser.add_argument("--tolerance", help="Fraction a stage may be slower than the baseline", type=float,
+                        metavar="", default=0.2)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="backup_benchmark_")
+    results = dict()
+    try:
+        if args.benchmark == "suite":
+            results = bench_suite(args, work_dir)
+        elif args.benchmark == "file_info":
+            results = bench_file_info(args.files, args.files_per_dir)
+        elif args.benchmark == "walk":
+            root = make_tree(os.path.join(work_dir, "tree"), args.files, args.size, args.depth)
+            results["os.walk"] = bench_walk(os_walk_files, root)
+            results["scandir"] = bench_walk(scandir_walk_files, root)
+            results["scandir_threads"] = bench_walk(lambda tree: scandir_walk_files(tree, args.threads), root)
+            for walker in ("scandir", "scandir_threads"):
+                results["speedup_" + walker] = (results[walker]["files_per_second"] /
+                                                results["os.walk"]["files_per_second"])
+        elif args.benchmark == "hash":
+            locations = make_files(os.path.join(work_dir, "files"), args.files, args.size)
+            for algorithm in ("sha1", "md5", "sha256", "blake2b", "xxh3", "blake3"):
+                try:
+                    hash_constructor(algorithm)
+                except ValueError:
+                    continue
+                results[algorithm] = bench_hash(lambda location: checksum(location, algorithm), locations)
+            results["sha1+md5 single pass"] = bench_hash(lambda location: checksum(location, "sha1", True), locations)
+            results["sha1, md5 two passes"] = bench_hash(
+                lambda location: (checksum(location, "sha1"), checksum(location, "md5")), locations)
+        else:
+            locations = make_files(os.path.join(work_dir, "files"), args.files, args.size)
+            tmp = os.path.join(work_dir, "tmp")
+            os.makedirs(tmp, exist_ok=True)
+            if args.gpg_id:
+                results["gpg"] = bench_encrypt(GpgEncryptor(args.gpg_id), locations, tmp)
+            results["aes-gcm"] = bench_encrypt(AesGcmEncryptor(os.urandom(32)), locations, tmp)
+            if "gpg" in results:
+                results["speedup"] = results["aes-gcm"]["files_per_second"] / results["gpg"]["files_per_second"]
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    output = {"benchmark": args.benchmark, "files": args.files, "size": args.size, "results": results}
+    regressions = list()
+    if args.benchmark == "suite":
+        output.update({"distribution": args.distribution, "depth": args.depth, "files_per_dir": args.files_per_dir,
+                       "change_rate": args.change_rate, "seed": args.seed, "hash_algorithm": args.hash_algorithm,
+                       "peak_rss_mb": peak_rss_mb()})
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            parameters = ("files", "size", "distribution", "depth", "files_per_dir", "change_rate", "seed",
+                          "hash_algorithm")
+            if any(baseline.get(key) != output[key] for key in parameters):
+                print("The baseline was run with other parameters, the comparison is not meaningful",
+                      file=sys.stderr)
+            output["baseline"] = compare_baseline(results, baseline, args.tolerance)
+            regressions = [name for name, result in output["baseline"].items() if result["regression"]]
+            output["regressions"] = regressions
+        if args.save_baseline:
+            with open(args.save_baseline, "w") as f:
+                json.dump(output, f, indent=2)
+    print(json.dumps(output, indent=2))
+    if regressions:
+        print("Regressions in {}".format(regressions), file=sys.stderr)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
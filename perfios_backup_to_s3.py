@@ -6,10 +6,16 @@ The archiving can also be done at a directory level wrt to base_path
 Refer backup_config.json.reference for all options available
 
 Usage:
-python3 perfios_backup_to_s3.py [-h] [-c]
+python3 perfios_backup_to_s3.py [-h] [-c] [-p] [--hash_threads] [--compress_processes] [--upload_connections]
+                                [--tmp_bytes]
 optional arguments:
-  -h, --help           show this help message and exit
-  -c , --config_path   Test Configuration Path
+  -h, --help              show this help message and exit
+  -c , --config_path      Test Configuration Path
+  -p , --parallel         Number of config entries backed up concurrently
+  --hash_threads          Hashing threads shared by the concurrent entries
+  --compress_processes    Compression processes shared by the concurrent entries
+  --upload_connections    S3 connections shared by the concurrent entries
+  --tmp_bytes             Bytes in the tmp_path shared by the concurrent entries
 
 
 Some Statistics for hash algo
@@ -49,25 +55,83 @@ Entire Program Time
 Author: Sudharshan
 """
 
+import array
+import base64
+import collections
+import collections.abc
+import contextlib
 import gzip
 import hashlib
+import io
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 import pickle
+import queue
+import random
 import re
+import shutil
+import sqlite3
+import struct
+import subprocess
 import tarfile
+import tempfile
+import threading
 import time
 
 from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 
 from datetime import datetime
 from datetime import timedelta
 from logging import handlers
-from pathlib import Path
 
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import BaseSubscriber
+from boto3.s3.transfer import TransferConfig
+from boto3.s3.transfer import create_transfer_manager
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
 from botocore.exceptions import ClientError
+from botocore.exceptions import ConnectTimeoutError
+from botocore.exceptions import ReadTimeoutError
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM, InvalidTag = None, None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
@@ -77,6 +141,18 @@ FILE_HANDLER.suffix = "%Y-%m-%d"
 FILE_HANDLER.setFormatter(FORMATTER)
 LOGGER.addHandler(FILE_HANDLER)
 
+# Suffix added to the compressed files, so that the codec to restore with is known from the key
+CODEC_SUFFIXES = {"gzip": ".gz", "zstd": ".zst", "lz4": ".lz4", "none": ""}
+# Suffix added to the files a compressing entry stores as is, so that their keys don't collide with a compressed
+# file, e.g. data.csv.gz stored as is and data.csv compressed with gzip
+STORED_SUFFIX = ".raw"
+# Random values of each byte for the gear rolling hash of the dedup chunker. Fixed, as the chunk boundaries must be
+# the same in every run for the chunks to dedup
+GEAR = struct.unpack(">256Q", random.Random(1048576).getrandbits(64 * 256).to_bytes(8 * 256, "big"))
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy else None
+# Bytes of the buffer hashed at once by the numpy cut_point
+CUT_BLOCK_SIZE = 65536
+
 
 def file_blocks(location, blocksize=1048576):
     """
@@ -92,506 +168,4378 @@ def file_blocks(location, blocksize=1048576):
             block = f.read(blocksize)
 
 
-def checksum(location):
+def hash_constructor(algorithm):
+    """
+    :param algorithm: "sha1", "md5", "sha256", "blake2b" or any other hashlib algorithm, "xxh3" if xxhash is installed,
+                      "blake3" if blake3 is installed
+    :return: function creating the hash object
+    """
+    if algorithm == "xxh3":
+        if xxhash is None:
+            raise ValueError("xxh3 needs the xxhash package")
+        return xxhash.xxh3_128
+    if algorithm == "blake3":
+        if blake3 is None:
+            raise ValueError("blake3 needs the blake3 package")
+        return blake3.blake3
+    if algorithm not in hashlib.algorithms_available:
+        raise ValueError("Unknown hash algorithm {}".format(algorithm))
+    return lambda: hashlib.new(algorithm)
+
+
+def hash_prefix(algorithm):
+    """
+    :param algorithm: see hash_constructor
+    :return: Prefix of the hashes of algorithm, none for sha1, so that the hashes of different algorithms never match
+    """
+    return "" if algorithm == "sha1" else algorithm + ":"
+
+
+def hash_algorithm_of(value):
+    """
+    :param value: Hash returned by checksum
+    :return: Algorithm of the hash, sha1 if it has no prefix
+    """
+    return value.rpartition(":")[0] or "sha1"
+
+
+def checksum(location, algorithm="sha1", content_md5=False):
     """
-    Calculate the sha1 of the location file contents
+    Calculate the hash of the location file contents. With content_md5, the md5 sent as the Content-MD5 of the upload
+    is calculated in the same read of the file
     :param location:
-    :return: string: SHA1 of file
+    :param algorithm: see hash_constructor
+    :param content_md5: bool
+    :return: string: hash of file, prefixed by the algorithm unless it's sha1, so that the hashes of different
+             algorithms never match. A tuple (hash, base64 md5) with content_md5
     """
-    hasher = hashlib.sha1()
+    prefix = hash_prefix(algorithm)
+    if not content_md5 and hasattr(hashlib, "file_digest") and algorithm in hashlib.algorithms_guaranteed:
+        with open(location, "rb") as f:
+            return prefix + hashlib.file_digest(f, algorithm).hexdigest()
+    hasher = hash_constructor(algorithm)()
+    md5 = hashlib.md5() if content_md5 and algorithm != "md5" else None
     for data in file_blocks(location):
         hasher.update(data)
-    return hasher.hexdigest()
+        if md5:
+            md5.update(data)
+    if content_md5:
+        return prefix + hasher.hexdigest(), base64.b64encode((md5 or hasher).digest()).decode()
+    return prefix + hasher.hexdigest()
 
 
-def compress(location, tmp):
+def compress(location, tmp, executor=None, parallel_threshold=None, block_size=8388608, read_ahead=8, codec="gzip",
+             level=None, budget=None):
     """
-    Compress the given location using gzip. Store the compressed file in the temporary location
+    Compress the given location using the codec. Store the compressed file in the temporary location
     :param location:
     :param tmp: temporary location used to store the compressed files
-    :return: Path of the compressed file in tmp
+    :param executor: Process pool compressing the files of at least parallel_threshold bytes block wise.
+                     None compresses every file on a single core
+    :param parallel_threshold: Size in bytes from which a file is compressed on the executor
+    :param block_size: Size of the blocks compressed on the executor
+    :param read_ahead: Number of blocks read ahead of the written block
+    :param codec: "gzip", "zstd", "lz4" or "none"
+    :param level: Compression level. None for the default level of the codec
+    :param budget: ResourceBudget, see compress_stream
+    :return: Path of the compressed file in tmp, None if the codec is "none"
     """
+    if codec == "none":
+        return None
     filename = location[location.rindex("/") + 1:]
-    compressed_path = os.path.join(tmp, filename + ".gz")
+    compressed_path = os.path.join(tmp, filename + CODEC_SUFFIXES[codec])
 
-    with open(location, "rb") as f_in, gzip.open(compressed_path, "wb") as f_out:
-        f_out.writelines(f_in)
+    with open(location, "rb") as f_in, open(compressed_path, "wb") as f_out:
+        compress_stream(f_in, f_out, codec, level, executor, parallel_threshold, block_size, read_ahead, budget)
 
     return compressed_path
 
 
-def encrypt(tmp_location, gpg_id, location=None):
+def compress_stream(f_in, out, codec="gzip", level=None, executor=None, parallel_threshold=None, block_size=8388608,
+                    read_ahead=8, budget=None):
+    """
+    Compress the file f_in into out using the codec. gzip files of at least parallel_threshold bytes are compressed
+    block wise on the executor
+    :param f_in: File opened for reading
+    :param out: File like object the compressed stream is written to. Not closed
+    :param codec: "gzip", "zstd" or "lz4"
+    :param level: Compression level. None for the default level of the codec
+    :param executor: Process pool
+    :param parallel_threshold: Size in bytes from which a file is compressed on the executor
+    :param block_size: Size of the blocks compressed on the executor
+    :param read_ahead: Number of blocks read ahead of the written block
+    :param budget: ResourceBudget. Compressing on the calling thread holds one of its compress_processes, the blocks
+                   compressed on the executor hold theirs through the executor, see ResourceBudget.gate
+    :return:
+    """
+    if codec == "gzip" and executor and parallel_threshold is not None and \
+            os.fstat(f_in.fileno()).st_size >= parallel_threshold:
+        for member in gzip_members(f_in, executor, block_size, read_ahead, 9 if level is None else level):
+            out.write(member)
+        return
+    with budget.hold("compress_processes") if budget else contextlib.nullcontext():
+        with codec_writer(codec, out, level, os.path.basename(f_in.name)) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1048576)
+
+
+def codec_writer(codec, out, level=None, filename=""):
+    """
+    File like object compressing the bytes written to it into out
+    :param codec: "gzip", "zstd" or "lz4"
+    :param out: File like object. Not closed when the writer is closed
+    :param level: Compression level. None for the default level of the codec
+    :param filename: Name stored in the gzip header
+    :return: File like object
+    """
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(out, closefd=False)
+    if codec == "lz4":
+        return lz4.frame.LZ4FrameFile(out, mode="wb", compression_level=level or 0)
+    return gzip.GzipFile(filename=filename, mode="wb", fileobj=out, compresslevel=9 if level is None else level)
+
+
+def compress_block(codec, data, level=None):
+    """
+    Compress data in memory using the codec
+    :param codec: "gzip", "zstd" or "lz4"
+    :param data: bytes
+    :param level: Compression level. None for the default level of the codec
+    :return: bytes
+    """
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    if codec == "lz4":
+        return lz4.frame.compress(data, compression_level=level or 0)
+    return gzip.compress(data, 9 if level is None else level)
+
+
+class CodecPolicy:
     """
-    Encrypt either the compressed file in temporary location or the original file in location using GPG, based on config
+    Chooses the codec and level of each file. The codecs rules of the config are tried in order, the first rule whose
+    pattern is found in the file name wins, like the include and exclude regexes. The first block of the file is
+    then compressed as a probe, and the file is left uncompressed if it doesn't shrink below min_ratio.
+    A zstd or lz4 rule falls back to gzip when the zstandard or lz4 package is not installed.
+    """
+
+    def __init__(self, rules=None, codec="gzip", level=None, min_ratio=None, probe_size=1048576, ignore_case=False):
+        """
+        :param rules: list of {"pattern": regex, "codec": "gzip"/"zstd"/"lz4"/"none", "level": int}
+        :param codec: Codec of the files not matching any rule
+        :param level: Level of the files not matching any rule
+        :param min_ratio: Compressed/original size of the probe above which the file is not compressed.
+                          None doesn't probe
+        :param probe_size: Size of the probe
+        :param ignore_case: Ignore the case in the patterns
+        """
+        flags = re.IGNORECASE if ignore_case else 0
+        self.rules = [(re.compile(rule["pattern"], flags), self.available(rule["codec"]), rule.get("level"))
+                      for rule in rules or list()]
+        self.codec = self.available(codec)
+        self.level = level
+        self.min_ratio = min_ratio
+        self.probe_size = probe_size
+
+    @staticmethod
+    def available(codec):
+        if codec not in CODEC_SUFFIXES:
+            raise ValueError("Unknown codec {}".format(codec))
+        if (codec == "zstd" and zstandard is None) or (codec == "lz4" and lz4 is None):
+            LOGGER.warning("{} is not installed, using gzip instead".format(codec))
+            return "gzip"
+        return codec
+
+    def choose(self, location):
+        """
+        :param location:
+        :return: codec, level
+        """
+        filename = location[location.rindex("/") + 1:]
+        codec, level = self.codec, self.level
+        for pattern, rule_codec, rule_level in self.rules:
+            if pattern.search(filename):
+                codec, level = rule_codec, rule_level
+                break
+        if codec != "none" and self.min_ratio is not None:
+            with open(location, "rb") as f:
+                probe = f.read(self.probe_size)
+            if probe and len(compress_block(codec, probe, level)) > self.min_ratio * len(probe):
+                LOGGER.info("Not compressing {} as it doesn't compress below the ratio {}".format(location,
+                                                                                                  self.min_ratio))
+                return "none", None
+        return codec, level
+
+
+def gzip_members(f_in, executor, block_size=8388608, read_ahead=8, compresslevel=9):
+    """
+    Compress f_in pigz style, splitting it into blocks compressed independently on the executor. Each block is a
+    complete gzip member, and the members concatenated in order are a standard multi-member gzip stream that gunzip
+    and gzip.open read as one file.
+    :param f_in: File like object to compress
+    :param executor: Process pool
+    :param block_size: Size of each block
+    :param read_ahead: Number of blocks read and compressing ahead of the one being yielded
+    :param compresslevel: gzip compression level
+    :return: generator of gzip members, in the order of the blocks
+    """
+    pending = collections.deque()
+    block = f_in.read(block_size)
+    while block:
+        pending.append(executor.submit(gzip.compress, block, compresslevel))
+        if len(pending) >= read_ahead:
+            yield pending.popleft().result()
+        block = f_in.read(block_size)
+    while pending:
+        yield pending.popleft().result()
+
+
+class EncryptionError(Exception):
+    """
+    Raised when a file or stream couldn't be encrypted
+    """
+
+
+def encrypt(tmp_location, encryptor, location=None, suffix=""):
+    """
+    Encrypt either the compressed file in temporary location or the original file in location, based on config
     :param tmp_location: Temporary location of the compressed file. This will be used when compress option is true
-    :param gpg_id: GPG ID to be used for encryption
+    :param encryptor: GpgEncryptor/AesGcmEncryptor
     :param location: if compress option is false, the file is taken from the original location, storing the
                      encrypted file in tmp_location
-    :return: Path of the compressed file in tmp
+    :param suffix: Added to the file name of location before the encryption suffix, see codec_suffix
+    :return: Path of the encrypted file in tmp
     """
     if location:
         filename = location[location.rindex("/") + 1:]
-        encrypted_path = os.path.join(tmp_location, filename + ".gpg")
-        command = "gpg --always-trust -o '{}' -r {} -e '{}'".format(encrypted_path, gpg_id, location)
-    else:
-        command = "gpg --always-trust -r '{}' -e '{}'".format(gpg_id, tmp_location)
-
-    if os.WEXITSTATUS(os.system(command)):
-        LOGGER.error("Encryption for " + tmp_location + " failed with traceback. Trying again")
-        os.remove(tmp_location + ".gpg")
-        os.system(command)
-
-    if location:
+        encrypted_path = os.path.join(tmp_location, filename + suffix + encryptor.suffix)
+        encryptor.encrypt_file(location, encrypted_path)
         return encrypted_path
     else:
+        encryptor.encrypt_file(tmp_location, tmp_location + encryptor.suffix)
         os.remove(tmp_location)
-        return tmp_location + ".gpg"
+        return tmp_location + encryptor.suffix
 
 
-def upload(s3, base_path, bucket_name, s3_prefix_path, location, tmp_location, last_modified):
+class GpgEncryptor:
     """
-    Upload the file to S3
-    :param s3: s3_client
-    :param base_path: Used to create the prefix i.e., to reflect the local file structure
-    :param bucket_name: Name of the bucket
-    :param s3_prefix_path: Prefix to be used after bucket name
-    :param location: Used to create the prefix i.e., to reflect the local file structure
-    :param tmp_location: Temporary location from where the file is uploaded. if no compress and no encrypt,
-                         location is considered as tmp_location
-    :param last_modified: last modified time is added as metadata while upload. Used while restoring the file
-    :return: bool
+    Encrypt using gpg, one gpg process per file or stream. The output can be decrypted with gpg -d
     """
-    if not tmp_location:
-        tmp_location = location
-    file_name = tmp_location[tmp_location.rindex("/") + 1:]
-    prefix = location[len(base_path):location.rindex("/")].strip("/")
-    if s3_prefix_path:
-        if prefix:
-            key = s3_prefix_path + "/" + prefix + "/" + file_name
-        else:
-            key = s3_prefix_path + "/" + file_name
-    else:
-        if prefix:
-            key = prefix + "/" + file_name
-        else:
-            key = file_name
-    try:
-        response = s3.upload_file(Filename=tmp_location, Bucket=bucket_name, Key=key,
-                                  ExtraArgs={"Metadata": {"Local-Last-Modified": last_modified}})
-    except ClientError as e:
-        LOGGER.error("Client error for location: " + location + " with tmp_path: " + tmp_location)
-        return False
-    except FileNotFoundError as e:
-        LOGGER.error("Client error for location: " + location + " with tmp_path: " + tmp_location)
-    return True
+    name = "gpg"
+    suffix = ".gpg"
+
+    def __init__(self, gpg_id, retries=1):
+        """
+        :param gpg_id: GPG ID to be used for encryption
+        :param retries: Number of times a failed encryption is tried again
+        """
+        self.gpg_id = gpg_id
+        self.retries = retries
 
+    def encrypt_file(self, location, encrypted_path):
+        """
+        Encrypt location into encrypted_path
+        :param location:
+        :param encrypted_path:
+        :return:
+        """
+        command = ["gpg", "--batch", "--yes", "--always-trust", "-o", encrypted_path, "-r", self.gpg_id, "-e", location]
+        for attempt in range(self.retries + 1):
+            result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE)
+            if not result.returncode:
+                return
+            LOGGER.error("Encryption for {} failed [{}/{}]. {}".format(location, attempt + 1, self.retries + 1,
+                                                                     result.stderr.decode(errors="replace").strip()))
+            clean_up(encrypted_path)
+        raise EncryptionError("gpg couldn't encrypt {}".format(location))
+
+    def writer(self, out):
+        """
+        :param out: File like object the encrypted stream is written to
+        :return: File like object encrypting the bytes written to it
+        """
+        return GpgEncryptWriter(out, self.gpg_id)
 
-def scan(base_path, include, exclude, test_regex=False, consider_older=0):
+
+class AesGcmEncryptor:
     """
-    Scan the files in base_path, creating their hashes. Precedence: Exclude has higher precedence than include, i.e.,
-    files are first excluded and then included.
-    :param base_path:
-    :param include: Regex compiled object to search for matching file to include
-    :param exclude: Regex compiled object to search for matching file to exclude
-    :param test_regex: If True, pretty print the included and excluded files
-    :param consider_older: Consider files older than these days
-    :return: dict having filename and their respective hashes
+    Encrypt in process with AES-256-GCM, avoiding a gpg process per file. The stream is a header
+    (MAGIC, 8 bytes nonce prefix, 4 bytes chunk size) followed by chunks of chunk size bytes, each encrypted and
+    authenticated on its own with the nonce prefix + chunk counter as nonce. The last chunk, possibly empty, is
+    marked in its associated data so that a truncated stream doesn't decrypt.
     """
-    start_scan = time.time()
-    file_info = dict()
-    delta = datetime.now().date() - timedelta(consider_older)
-    file_count, dir_count, exclude_count, include_count = 0, 0, 0, 0
-    if test_regex:
-        exclude_files, include_files = [], []
-    print("{}".format("".join(["-"] * 75)))
-    print("Scanning files in {}".format(base_path))
-    LOGGER.info("Scanning files in {}".format(base_path))
+    name = "aes-gcm"
+    suffix = ".aes"
+    MAGIC = b"PBKAES01"
+    CHUNK_SIZE = 1048576
 
-    def hash_it():
+    def __init__(self, key):
         """
-        Calculates the hash of the file.
-        :return:
+        :param key: 32 bytes key
         """
-        m_time = datetime.fromtimestamp(os.stat(location).st_mtime).date()
-        if m_time < delta:
-            file_info[location] = dict()
-            file_info[location]["hash"] = checksum(location)
-            # print("Time for {} is {}".format(location, str(time.time()-start)))
-        else:
-            LOGGER.info(
-                "Ignored [{}] as it's modified date is within the ignore range. m_time=[{}]".format(location, m_time))
+        if AESGCM is None:
+            raise EncryptionError("aes-gcm encryption needs the cryptography package")
+        if len(key) != 32:
+            raise EncryptionError("aes-gcm encryption needs a 32 bytes key, got {} bytes".format(len(key)))
+        self.key = key
+        self.aead = AESGCM(key)
 
-    for root, _, files in os.walk(base_path):
-        # print(root, dir, files)
-        for file in files:
-            location = os.path.join(root, file)
-            file_count += 1
-            if exclude:
-                if exclude.search(file) is None:
-                    if include:
-                        if include.search(file):
-                            hash_it()
-                            include_count += 1
-                            if test_regex:
-                                include_files.append(location)
-                        else:
-                            exclude_count += 1
-                            if test_regex:
-                                exclude_files.append(location)
-                    else:
-                        hash_it()
-                        include_count += 1
-                        if test_regex:
-                            include_files.append(location)
-                else:
-                    exclude_count += 1
-                    if test_regex:
-                        exclude_files.append(location)
-            else:
-                if include:
-                    if include.search(file):
-                        hash_it()
-                        include_count += 1
-                        if test_regex:
-                            include_files.append(location)
-                    else:
-                        exclude_count += 1
-                        if test_regex:
-                            exclude_files.append(location)
-                else:
-                    hash_it()
-                    include_count += 1
-                    if test_regex:
-                        include_files.append(location)
-            print("\rScanned [{}] directories [{}] files, [{}] file included, [{}] files excluded".format(dir_count, file_count, include_count, exclude_count), end="", flush=True)
+    def __reduce__(self):
+        # AESGCM can't be pickled, the encryptor is sent to the archive processes by its key
+        return self.__class__, (self.key,)
 
-        dir_count += 1
-    end_scan = time.time()
-    LOGGER.info("Time taken for hashing = {}, total files = {}".format(end_scan - start_scan, file_count))
-    print("\nScan Time [{:.4f}]s".format(end_scan - start_scan, file_count))
-    if test_regex:
-        print("Files Included")
-        import pprint
-        pprint.pprint(include_files)
-        print("Files Excluded")
-        pprint.pprint(exclude_files)
-    return file_info
+    def encrypt_file(self, location, encrypted_path):
+        try:
+            with open(location, "rb") as f_in, open(encrypted_path, "wb") as f_out:
+                writer = self.writer(f_out)
+                shutil.copyfileobj(f_in, writer, self.CHUNK_SIZE)
+                writer.close()
+        except OSError as e:
+            clean_up(encrypted_path)
+            raise EncryptionError("Couldn't encrypt {}. {}".format(location, e))
+
+    def writer(self, out):
+        return AesGcmEncryptWriter(out, self.aead, self.CHUNK_SIZE)
+
+    def decrypt_blocks(self, f_in):
+        """
+        Decrypt the stream written by AesGcmEncryptWriter
+        :param f_in: File like object having the encrypted stream
+        :return: generator of the decrypted chunks
+        """
+        header = f_in.read(len(self.MAGIC) + 12)
+        if len(header) != len(self.MAGIC) + 12 or not header.startswith(self.MAGIC):
+            raise EncryptionError("Not an aes-gcm encrypted stream")
+        nonce_prefix = header[len(self.MAGIC):len(self.MAGIC) + 8]
+        chunk_size = struct.unpack(">I", header[len(self.MAGIC) + 8:])[0] + 16
+        counter = 0
+        chunk = f_in.read(chunk_size)
+        while True:
+            next_chunk = f_in.read(chunk_size) if len(chunk) == chunk_size else b""
+            last = b"\x01" if not next_chunk else b"\x00"
+            try:
+                yield self.aead.decrypt(nonce_prefix + struct.pack(">I", counter), chunk, last)
+            except InvalidTag:
+                raise EncryptionError("aes-gcm stream is corrupt or truncated at chunk {}".format(counter))
+            if not next_chunk:
+                return
+            chunk, counter = next_chunk, counter + 1
 
 
-def compare(new, base_path, archive=False, dir_level=None, meta_file_name=None):
+class AesGcmEncryptWriter:
     """
-    Compare the file hashes generated today with the file hashes generated yesterday.
-    :param new: File information dict of today
-    :param base_path: string
-    :param archive: bool
-    :param dir_level: int/None
-    :return: list, dictionary. List of changed location, dictionary of changed dictionaries
+    File like object encrypting the bytes written to it with AES-256-GCM, in the format described in AesGcmEncryptor
     """
-    if meta_file_name:
-        pickle_path = os.path.join(os.getcwd(), "data/" + meta_file_name + ".pkl")
-    else:
-        pickle_path = os.path.join(os.getcwd(), "data/" + base_path[base_path.rindex("/") + 1:] + ".pkl")
-    len_base_path = len(Path(base_path).parents) + 1
-    changed_dirs = None
-    if archive:
-        changed_dirs = dict()
-    try:
-        with open(pickle_path, "rb") as pickle_in:
-            old = pickle.load(pickle_in)
-    except FileNotFoundError:
-        old = None
 
-    if old:
-        changed_files = list()
+    def __init__(self, out, aead, chunk_size):
+        """
+        :param out: File like object the encrypted stream is written to. Not closed by close
+        :param aead: AESGCM
+        :param chunk_size: Size of the plain text in each chunk
+        """
+        self.out = out
+        self.aead = aead
+        self.chunk_size = chunk_size
+        self.nonce_prefix = os.urandom(8)
+        self.counter = 0
+        self.buffer = bytearray()
+        self.out.write(AesGcmEncryptor.MAGIC + self.nonce_prefix + struct.pack(">I", chunk_size))
 
-        for key in new:
-            try:
-                LOGGER.info("{} --> {} -- {}".format(key, old[key]["hash"], new[key]["hash"]))
-                if new[key]["hash"] != old[key]["hash"]:
-                    # print("{} --> {} -- {}".format(key, old[key]["hash"], new[key]["hash"]))
-                    changed_files.append(key)
-                    if archive:
-                        location = Path(key)
-                        index = len(location.parents) - len_base_path - dir_level
-                        index = index if index > 0 else 0
-                        archive_dir_path = str(location.parents[index])
-                        try:
-                            changed_dirs[archive_dir_path].append(key)
-                        except KeyError:
-                            changed_dirs[archive_dir_path] = list()
-                            changed_dirs[archive_dir_path].append(key)
-
-            except KeyError:
-                changed_files.append(key)
-                if archive:
-                    location = Path(key)
-                    index = len(location.parents) - len_base_path - dir_level
-                    index = index if index > 0 else 0
-                    archive_dir_path = str(location.parents[index])
-                    try:
-                        changed_dirs[archive_dir_path].append(key)
-                    except KeyError:
-                        changed_dirs[archive_dir_path] = list()
-                        changed_dirs[archive_dir_path].append(key)
+    def write(self, data):
+        self.buffer += data
+        # Keep the last chunk in the buffer, until close tells it is the last
+        while len(self.buffer) > self.chunk_size:
+            self.encrypt_chunk(bytes(self.buffer[:self.chunk_size]), b"\x00")
+            del self.buffer[:self.chunk_size]
+        return len(data)
 
-        return changed_files, changed_dirs
+    def encrypt_chunk(self, chunk, last):
+        nonce = self.nonce_prefix + struct.pack(">I", self.counter)
+        self.counter += 1
+        self.out.write(self.aead.encrypt(nonce, chunk, last))
 
-    else:
-        if archive:
-            for key in new:
-                location = Path(key)
-                index = len(location.parents) - len_base_path - dir_level
-                index = index if index > 0 else 0
-                archive_dir_path = str(location.parents[index])
-                try:
-                    changed_dirs[archive_dir_path].append(key)
-                except KeyError:
-                    changed_dirs[archive_dir_path] = list()
-                    changed_dirs[archive_dir_path].append(key)
+    def flush(self):
+        pass
 
-        return new.keys(), changed_dirs
+    def close(self):
+        if self.buffer is not None:
+            self.encrypt_chunk(bytes(self.buffer), b"\x01")
+            self.buffer = None
 
+    def abort(self):
+        self.buffer = None
 
-def clean_up(t):
+
+def encrypt_bytes(encryptor, data):
     """
-    Removes the location l. Similar to rm -f t
-    :param t: location
-    :return:
+    Encrypt data in memory
+    :param encryptor: GpgEncryptor/AesGcmEncryptor
+    :param data: bytes
+    :return: bytes
     """
-    if t and os.path.exists(t):
-        os.remove(t)
+    out = io.BytesIO()
+    writer = encryptor.writer(out)
+    try:
+        writer.write(data)
+        writer.close()
+    except EncryptionError:
+        writer.abort()
+        raise
+    return out.getvalue()
 
 
-def clean_up_empty_directories(base_path):
-    command = "find {}/ -type d -empty -delete".format(base_path)
-    LOGGER.info("Deleting Empty Directories below {}".format(base_path))
-    if os.WEXITSTATUS(os.system(command)):
-        os.system(command)
+def open_encryptor(encryption, gpg_id=None, encryption_key_file=None, retries=1):
+    """
+    Create the encryptor chosen in the config
+    :param encryption: "gpg" or "aes-gcm"
+    :param gpg_id: GPG ID to be used for gpg encryption
+    :param encryption_key_file: File having the 32 bytes key, raw or hex encoded, for aes-gcm encryption
+    :param retries: Number of times a failed gpg encryption is tried again
+    :return: GpgEncryptor/AesGcmEncryptor
+    """
+    if encryption == "aes-gcm":
+        if not encryption_key_file:
+            raise EncryptionError("aes-gcm encryption needs encryption_key_file")
+        with open(encryption_key_file, "rb") as f:
+            key = f.read()
+        # Only the hex form is stripped, a raw key may begin or end with whitespace bytes
+        if len(key) != 32 and len(key.strip()) == 64:
+            key = bytes.fromhex(key.strip().decode())
+        return AesGcmEncryptor(key)
+    if not gpg_id:
+        raise EncryptionError("gpg encryption needs gpg_id")
+    return GpgEncryptor(gpg_id, retries)
 
 
-def fetch_optional_config(config, key, default):
+class GpgEncryptWriter:
     """
-    Fetch the value of key in config file if present, else return default value
-    :param config: dict
-    :param key: string
-    :param default: bool/ None/ int as required
-    :return: value of key in config
+    File like object encrypting the bytes written to it through a gpg process, writing the encrypted stream to out.
+    Nothing is stored on the disk.
     """
-    try:
-        return config[key]
-    except KeyError:
-        return default
+    BLOCK_SIZE = 1048576
 
+    def __init__(self, out, gpg_id):
+        """
+        :param out: File like object the encrypted stream is written to. Not closed by close
+        :param gpg_id: GPG ID to be used for encryption
+        """
+        self.out = out
+        self.error = None
+        # gpg's messages go to a file rather than a pipe nobody drains while the stream runs, which would block gpg
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(["gpg", "--batch", "--always-trust", "-r", gpg_id, "-e", "-o", "-"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr)
+        self.reader = threading.Thread(target=self.pump, name="gpg-reader", daemon=True)
+        self.reader.start()
 
-def main():
-    os.environ["AWS_CONFIG_FILE"] = os.path.join(os.getcwd(), ".aws/config")
-    os.environ["AWS_SHARED_CREDENTIALS_FILE"] = os.path.join(os.getcwd(), ".aws/credentials")
+    def pump(self):
+        """
+        Copy the encrypted stream from gpg to out. Runs in the reader thread
+        :return:
+        """
+        try:
+            block = self.process.stdout.read(self.BLOCK_SIZE)
+            while block:
+                self.out.write(block)
+                block = self.process.stdout.read(self.BLOCK_SIZE)
+        except Exception as e:
+            self.error = e
+            self.process.kill()
 
-    # print(os.getenv("AWS_CONFIG_FILE"), os.getenv("AWS_SHARED_CREDENTIALS_FILE"))
-    start_entire = time.time()
+    def write(self, data):
+        if self.error:
+            raise self.error
+        try:
+            self.process.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            self.close()
+            raise EncryptionError("gpg stopped reading the stream")
+        return len(data)
 
-    parser = ArgumentParser()
-    parser.add_argument("-c", "--config", help="Test Configuration Path", type=str, metavar="", dest="config_path", default=None)
-    args = parser.parse_args()
-    if args.config_path:
-        config_file = args.config_path
-    else:
-        config_file = os.path.join(os.getcwd(), "backup_config.json")
+    def flush(self):
+        pass
 
-    LOGGER.info("Reading config from {}".format(config_file))
-    try:
-        with open(config_file, "r") as f:
-            config = json.load(f)
-    except FileNotFoundError:
-        print("Configuration file Not found.")
-        LOGGER.exception("Configuration file Not found. Stack trace")
-        exit(0)
-    except json.decoder.JSONDecodeError:
-        print("Configuration file is not a valid json file.")
-        LOGGER.exception("Configuration file is not a valid json file. Stack trace")
-        exit(0)
+    def close(self):
+        """
+        Finish the encrypted stream. Raises the reason if gpg or out failed
+        :return:
+        """
+        if not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.reader.join()
+            self.process.wait()
+            self.stderr.seek(0)
+            stderr = self.stderr.read().decode(errors="replace")
+            self.stderr.close()
+            if self.process.returncode and not self.error:
+                self.error = EncryptionError("gpg exited with {}. {}".format(self.process.returncode, stderr.strip()))
+        if self.error:
+            raise self.error
 
-    for _, a_config in config.items():
-        # Required Configurations
-        base_path = a_config["base_path"].rstrip("/")
-        bucket_name = a_config["bucket_name"]
-        s3_prefix_path = a_config['s3_prefix_path'].rstrip("/")
-        do_compress = a_config["compress"]
-        do_encrypt = a_config["encrypt"]
-        s3_upload = a_config["s3_upload"]
-        aws_profile = a_config["aws_profile"]
-        tmp_path = a_config["tmp_path"]
-
-        # Optional Configurations
-        gpg_id = fetch_optional_config(a_config, "gpg_id", default=None)
-        consider_older = fetch_optional_config(a_config, "consider_older", default=0)
-        test_regex = fetch_optional_config(a_config, "test_regex", default=False)
-        ignore_case = fetch_optional_config(a_config, "ignore_case", default=False)
-        include = fetch_optional_config(a_config, "include", default=None)
-        exclude = fetch_optional_config(a_config, "exclude", default=None)
-        if ignore_case:
-            include = re.compile(include, re.IGNORECASE) if include else None
-            exclude = re.compile(exclude, re.IGNORECASE) if exclude else None
-        else:
-            include = re.compile(include) if include else None
-            exclude = re.compile(exclude) if exclude else None
-        archive = fetch_optional_config(a_config, "archive", default=False)
-        dir_level = None
-        if archive:
-            dir_level = fetch_optional_config(a_config, "dir_level", default=None)
-            test_archive = fetch_optional_config(a_config, "test_archive", default=False)
-        delete_source = fetch_optional_config(a_config, "delete_source", default=False)
-        delete_empty_dirs = fetch_optional_config(a_config, "delete_empty_dirs", default=False)
-        meta_file_name = fetch_optional_config(a_config, "meta_file_name", default=None)
-        # Test regex and exit
-        if test_regex:
-            scan(base_path, include, exclude, test_regex)
+    def abort(self):
+        """
+        Kill gpg, discarding the stream
+        :return:
+        """
+        self.process.kill()
+        self.reader.join()
+        self.process.wait()
+        self.stderr.close()
 
-        else:
-            file_info = scan(base_path, include, exclude, consider_older=consider_older)
-            changed_locations, changed_dirs = compare(file_info, base_path, archive, dir_level, meta_file_name)
 
-            LOGGER.info("Changed files are " + str(list(changed_locations)))
-            count_changed_locations = len(changed_locations)
-            print("Number of Changed files are [{}]".format(str(count_changed_locations)))
+class MultipartUploadWriter:
+    """
+    File like object uploading the bytes written to it as a S3 multipart upload. Each part is uploaded concurrently
+    as soon as it is filled, holding at most max_concurrency + 1 parts in memory. Objects smaller than a part are
+    uploaded with a single put_object.
+    """
+
+    def __init__(self, s3, bucket_name, key, metadata, part_size=8388608, max_concurrency=4):
+        """
+        :param s3: s3_client
+        :param bucket_name: Name of the bucket
+        :param key: Key of the object
+        :param metadata: dict added as metadata of the object
+        :param part_size: Size of each part. At least 5mb, the minimum allowed by S3
+        :param max_concurrency: Number of parts uploaded concurrently
+        """
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.metadata = metadata
+        self.part_size = max(part_size, 5242880)
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = list()
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="part")
+        self.slots = threading.BoundedSemaphore(max_concurrency)
 
-            session = boto3.session.Session(profile_name=aws_profile)
-            s3 = session.client("s3")
-            count_compressed, count_encrypted, count_uploaded = 0, 0, 0
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self.upload_part(part)
+        return len(data)
 
-            if archive:
-                count_archived = 0
+    def flush(self):
+        pass
 
-                LOGGER.info("Changed Directories are {}".format(changed_dirs))
-                count_changed_dirs = len(changed_dirs)
-                print("Number of Changed Directories are [{}]".format(count_changed_dirs))
+    def upload_part(self, part):
+        """
+        Submit the part for upload, blocking while max_concurrency parts are in flight
+        :param part: bytes
+        :return:
+        """
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                                             Metadata=self.metadata)["UploadId"]
+        for number, future in self.parts:
+            if future.done() and future.exception():
+                raise future.exception()
+        self.slots.acquire()
+        number = len(self.parts) + 1
+        future = self.executor.submit(self.s3.upload_part, Bucket=self.bucket_name, Key=self.key, PartNumber=number,
+                                      UploadId=self.upload_id, Body=part)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.parts.append((number, future))
 
-                # Test archive and exit
-                if test_archive:
-                    import pprint
-                    print("Archiving happens at")
-                    pprint.pprint(changed_dirs)
-                    exit(0)
+    def close(self):
+        """
+        Upload the remaining bytes and complete the upload
+        :return:
+        """
+        try:
+            if self.upload_id is None:
+                self.s3.put_object(Bucket=self.bucket_name, Key=self.key, Body=bytes(self.buffer),
+                                   Metadata=self.metadata)
+            else:
+                if self.buffer:
+                    self.upload_part(bytes(self.buffer))
+                parts = [{"PartNumber": number, "ETag": future.result()["ETag"]} for number, future in self.parts]
+                self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={"Parts": parts})
+            self.buffer = bytearray()
+        finally:
+            self.executor.shutdown()
 
-                for directory in changed_dirs:
-                    # dir_name = os.path.basename(directory)
-                    dir_name = directory[directory.rindex("/") + 1:]
-                    archive_path = os.path.join(tmp_path, dir_name + ".tar.gz")
+    def abort(self):
+        """
+        Abort the upload, discarding the parts uploaded so far
+        :return:
+        """
+        self.executor.shutdown(cancel_futures=True)
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+            except ClientError:
+                LOGGER.exception("Couldn't abort the multipart upload of {}".format(self.key))
 
-                    with tarfile.open(archive_path, "w:gz") as archiver:
-                        LOGGER.info("Creating Archive at {}".format(archive_path))
-                        for location in changed_dirs[directory]:
-                            t = None
-                            len_location = len(location)
-                            if do_compress:
-                                LOGGER.info("Compressing [{}/{}] {}".format(count_compressed, count_changed_locations, location))
-                                print("\rCompressed [{}/{}], Encrypted [{}/{}], Archived [{}/{}], Uploaded [{}/{}]. Compressing {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_archived, count_changed_dirs, count_uploaded, count_changed_dirs, location), end="", flush=True)
-                                t = compress(location, tmp_path)
-                                count_compressed += 1
-                                print("\rCompressed [{}/{}], Encrypted [{}/{}], Archived [{}/{}], Uploaded [{}/{}]. {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_archived, count_changed_dirs, count_uploaded, count_changed_dirs, " " * (len_location + 15)), end="", flush=True)
-                            if do_encrypt:
-                                LOGGER.info("Encrypting [{}/{}] {}".format(count_encrypted, count_changed_locations, location))
-                                # print('Encrypting ' + location)
-                                print("\rCompressed [{}/{}], Encrypted [{}/{}], Archived [{}/{}], Uploaded [{}/{}]. Encrypting {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_archived, count_changed_dirs, count_uploaded, count_changed_dirs, location), end="", flush=True)
-                                if t:
-                                    t = encrypt(t, gpg_id)
-                                else:
-                                    t = encrypt(tmp_path, gpg_id, location)
-                                count_encrypted += 1
-                                print("\rCompressed [{}/{}], Encrypted [{}/{}], Archived [{}/{}], Uploaded [{}/{}]. {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_archived, count_changed_dirs, count_uploaded, count_changed_dirs, " " * (len_location + 15)), end="", flush=True)
-                            if t:
-                                arc_name = os.path.join(dir_name, location[len(directory) + 1:location.rindex("/")], os.path.basename(t))
-                                LOGGER.info("Adding {} to archive at location {}".format(t, arc_name))
-                                archiver.add(t, arcname=arc_name, recursive=False)
-                                clean_up(t)
-                            else:
-                                LOGGER.info("Adding {} to archive at location {}".format(location, arc_name))
-                                archiver.add(location, arcname=arc_name, recursive=False)
-
-                        count_archived += 1
-                        print("\rCompressed [{}/{}], Encrypted [{}/{}], Archived [{}/{}], Uploaded [{}/{}]. {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_archived, count_changed_dirs, count_uploaded, count_changed_dirs, " " * (len_location + 15)), end="", flush=True)
-                        LOGGER.info("Archive [{}/{}] for {} created at {}".format(count_archived, count_changed_dirs, directory, archive_path))
-
-                    if s3_upload:
-                        LOGGER.info("Uploading archived {}".format(directory))
-                        print("\rCompressed [{}/{}], Encrypted [{}/{}], Archived [{}/{}], Uploaded [{}/{}]. Uploading {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_archived, count_changed_dirs, count_uploaded, count_changed_dirs, directory), end="", flush=True)
-                        # print('Uploading ' + location)
-                        if not upload(s3, base_path, bucket_name, s3_prefix_path, directory, archive_path, datetime.fromtimestamp(os.stat(directory).st_mtime).date().isoformat()):
-                            LOGGER.error("Couldn't upload {} in tmp_path {}".format(directory, archive_path))
-                            print("Couldn't upload {} in tmp_path {}".format(directory, archive_path))
-                        else:
-                            count_uploaded += 1
-                        print("\rCompressed [{}/{}], Encrypted [{}/{}], Archived [{}/{}], Uploaded [{}/{}]. {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_archived, count_changed_dirs, count_uploaded, count_changed_dirs, " " * (len(directory) + 15)), end="", flush=True)
-                    # Todo Uncomment the below
-                    clean_up(archive_path)
 
-            # If no archiving is needed
+def stream_upload(s3, base_path, bucket_name, s3_prefix_path, location, last_modified, codec="none", level=None,
+                  encryptor=None, part_size=8388608, max_concurrency=4, compress_executor=None,
+                  parallel_threshold=None, block_size=8388608, local_hash=None, compressing=False, budget=None):
+    """
+    Compress, encrypt and upload the file in a single pass, streaming the bytes through the codec and encryption into a
+    multipart upload. Unlike compress, encrypt and upload, nothing is written to the tmp_path.
+    :param s3: s3_client
+    :param base_path: Used to create the prefix i.e., to reflect the local file structure
+    :param bucket_name: Name of the bucket
+    :param s3_prefix_path: Prefix to be used after bucket name
+    :param location: File to be uploaded
+    :param last_modified: last modified time is added as metadata while upload. Used while restoring the file
+    :param codec: "gzip", "zstd", "lz4" or "none"
+    :param level: Compression level. None for the default level of the codec
+    :param encryptor: GpgEncryptor/AesGcmEncryptor. None doesn't encrypt
+    :param part_size: Size of each part of the multipart upload
+    :param max_concurrency: Number of parts uploaded concurrently
+    :param compress_executor: Process pool compressing the files of at least parallel_threshold bytes block wise
+    :param parallel_threshold: Size in bytes from which a file is compressed on the compress_executor
+    :param block_size: Size of the blocks compressed on the compress_executor
+    :param local_hash: Hash of location found by scan, added as metadata
+    :param compressing: If True, the entry compresses, see codec_suffix
+    :param budget: ResourceBudget, see compress_stream
+    :return: bool
+    """
+    file_name = location + codec_suffix(codec, compressing) + (encryptor.suffix if encryptor else "")
+    key = s3_key(base_path, s3_prefix_path, location, file_name)
+    writer = MultipartUploadWriter(s3, bucket_name, key, object_metadata(last_modified, local_hash), part_size,
+                                   max_concurrency)
+    sink = writer
+    try:
+        if encryptor:
+            sink = encryptor.writer(writer)
+        with open(location, "rb") as f_in:
+            if codec != "none":
+                compress_stream(f_in, sink, codec, level, compress_executor, parallel_threshold, block_size,
+                                budget=budget)
             else:
-                for location in changed_locations:
-                    t = None
-                    len_location = len(location)
-                    if do_compress:
-                        LOGGER.info("Compressing " + location)
-                        print("\rCompressed [{}/{}], Encrypted [{}/{}], Uploaded [{}/{}]. Compressing {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_uploaded, count_changed_locations, location), end="", flush=True)
-                        t = compress(location, tmp_path)
-                        count_compressed += 1
-                        print("\rCompressed [{}/{}], Encrypted [{}/{}], Uploaded [{}/{}]. {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_uploaded, count_changed_locations, " " * (len_location + 15)), end="", flush=True)
-                    if do_encrypt:
-                        LOGGER.info('Encrypting ' + location)
-                        # print('Encrypting ' + location)
-                        print("\rCompressed [{}/{}], Encrypted [{}/{}], Uploaded [{}/{}]. Encrypting {}".format(
-                            count_compressed, count_changed_locations, count_encrypted, count_changed_locations,
-                            count_uploaded, count_changed_locations, location), end="", flush=True)
-                        if t:
-                            t = encrypt(t, gpg_id)
-                        else:
-                            t = encrypt(tmp_path, gpg_id, location)
-                        count_encrypted += 1
-                        print("\rCompressed [{}/{}], Encrypted [{}/{}], Uploaded [{}/{}]. {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_uploaded, count_changed_locations, " " * (len_location + 15)), end="", flush=True)
-                    if s3_upload:
-                        LOGGER.info('Uploading ' + location)
-                        print("\rCompressed [{}/{}], Encrypted [{}/{}], Uploaded [{}/{}]. Uploading {}".format(
-                            count_compressed, count_changed_locations, count_encrypted, count_changed_locations,
-                            count_uploaded, count_changed_locations, location), end="", flush=True)
-                        # print('Uploading ' + location)
-                        if not upload(s3, base_path, bucket_name, s3_prefix_path, location, t,
-                                      datetime.fromtimestamp(os.stat(location).st_mtime).date().isoformat()):
-                            LOGGER.error("Couldn't upload " + location + " in tmp_path " + t)
-                            print("Couldn't upload" + location + " in tmp_path " + t)
-                        else:
-                            count_uploaded += 1
-
-                        print("\rCompressed [{}/{}], Encrypted [{}/{}], Uploaded [{}/{}]. {}".format(count_compressed, count_changed_locations, count_encrypted, count_changed_locations, count_uploaded, count_changed_locations, " " * (len_location + 15)), end="", flush=True)
+                shutil.copyfileobj(f_in, sink, 1048576)
+        if sink is not writer:
+            sink.close()
+        writer.close()
+    except (ClientError, BotoCoreError, EncryptionError, OSError) as e:
+        LOGGER.error("Streaming upload failed for location: {}. {}".format(location, e))
+        if sink is not writer:
+            sink.abort()
+        writer.abort()
+        return False
+    return True
 
-                    clean_up(t)
-                    # Save todays file info
 
-            if meta_file_name:
-                pickle_path = os.path.join(os.getcwd(), "data/" + meta_file_name + ".pkl")
+def cdc_chunks(f_in, min_size=262144, avg_size=1048576, max_size=4194304):
+    """
+    Split f_in into content defined chunks using a gear rolling hash, FastCDC style. A chunk ends where the top bits
+    of the hash are zero, so the boundaries depend only on the bytes around them. An insert or delete changes the
+    chunks around it, the rest of the file gives the same chunks as the previous version.
+    :param f_in: File opened for reading
+    :param min_size: No boundary is looked for in the first min_size bytes of a chunk
+    :param avg_size: Expected size of the chunks
+    :param max_size: A chunk is cut at max_size if no boundary is found
+    :return: generator of chunks
+    """
+    bits = max(1, (avg_size - min_size).bit_length() - 1)
+    mask = ((1 << bits) - 1) << (64 - bits)
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            block = f_in.read(max_size)
+            if block:
+                buffer += block
             else:
-                pickle_path = os.path.join(os.getcwd(), "data/" + base_path[base_path.rindex("/") + 1:] + ".pkl")
-            print("\nCaching Metadata for {}".format(base_path))
-            with open(pickle_path, "wb") as pickle_out:
-                pickle.dump(file_info, pickle_out)
-
-            if delete_source:
-                LOGGER.info("Deleting Source Files Start")
-                i = 1
-                for location in changed_locations:
-                    print("\rDeleted [{}/{}]. Deleting {}".format(i, count_changed_locations, location), end="", flush=True)
-                    LOGGER.info("Deleted [{}/{}]. Deleting {}".format(i, count_changed_locations, location))
-                    clean_up(location)
-                    i += 1
-                LOGGER.info("Deleting Source Files Successful")
+                eof = True
+        if not buffer:
+            return
+        cut = cut_point(buffer, min_size, max_size, mask)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
 
-            if delete_empty_dirs:
-                LOGGER.info("Deleting Empty Directories")
-                print("\nDeleting Empty Directories")
+
+def cut_point(buffer, min_size, max_size, mask):
+    """
+    Find the end of the chunk at the start of buffer. With numpy, the hashes are computed a block at a time, else
+    byte by byte
+    :return: int
+    """
+    end = min(len(buffer), max_size)
+    if end <= min_size:
+        return end
+    if numpy is not None:
+        return numpy_cut_point(buffer, min_size, end, mask)
+    gear = GEAR
+    h = 0
+    for i, byte in enumerate(buffer[min_size:end], min_size + 1):
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFFFFFFFFFF
+        if not h & mask:
+            return i
+    return end
+
+
+def numpy_cut_point(buffer, min_size, end, mask):
+    """
+    cut_point on numpy arrays. The hash after a byte is the sum of the gear values of the last 64 bytes, each shifted
+    by its distance from the byte, as the older ones are shifted out. The sums are built by doubling, the sum of the
+    last 2n bytes being the sum of the last n added to the sum of the n before them shifted by n, in 6 passes over a
+    block.
+    :param buffer:
+    :param min_size: The hash starts from 0 at min_size
+    :param end: Cut at end if no boundary is found before
+    :param mask:
+    :return: int
+    """
+    mask = numpy.uint64(mask)
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8, count=end)
+    for start in range(min_size, end, CUT_BLOCK_SIZE):
+        stop = min(start + CUT_BLOCK_SIZE, end)
+        # The 63 bytes before the block are shifted into its first hashes, except those before min_size
+        history = min(63, start - min_size)
+        h = GEAR_ARRAY[data[start - history:stop]]
+        width = 1
+        while width < 64:
+            h[width:] += h[:-width] << numpy.uint64(width)
+            width *= 2
+        cuts = numpy.flatnonzero((h[history:] & mask) == 0)
+        if len(cuts):
+            return start + int(cuts[0]) + 1
+    return end
+
+
+class ChunkStore:
+    """
+    Dedup backup mode. Files are split into content defined chunks and each unique chunk is stored once in S3,
+    compressed and encrypted, below <s3_prefix_path>/.chunks/ named by its sha256. A file is stored as its recipe,
+    the list of its chunk names, which is kept in the manifest and uploaded as json next to where the file would have
+    been uploaded, with the .recipe suffix. Only the chunks not stored yet are uploaded.
+    """
+    CHUNK_PREFIX = ".chunks"
+
+    def __init__(self, s3, base_path, bucket_name, s3_prefix_path, manifest, codec_policy=None, encryptor=None,
+                 avg_size=1048576, max_concurrency=4):
+        """
+        :param s3: s3_client
+        :param base_path: Used to create the prefix i.e., to reflect the local file structure
+        :param bucket_name: Name of the bucket
+        :param s3_prefix_path: Prefix to be used after bucket name
+        :param manifest: Manifest the stored chunks and the recipes are recorded in
+        :param codec_policy: CodecPolicy choosing the codec of the new chunks of a file. None doesn't compress
+        :param encryptor: GpgEncryptor/AesGcmEncryptor. None doesn't encrypt
+        :param avg_size: Expected size of the chunks. The chunks are between a quarter and four times of it
+        :param max_concurrency: Number of chunks uploaded concurrently
+        """
+        self.s3 = s3
+        self.base_path = base_path
+        self.bucket_name = bucket_name
+        self.s3_prefix_path = s3_prefix_path
+        self.chunk_prefix = s3_prefix_path + "/" + self.CHUNK_PREFIX if s3_prefix_path else self.CHUNK_PREFIX
+        self.manifest = manifest
+        self.codec_policy = codec_policy
+        self.encryptor = encryptor
+        self.avg_size = avg_size
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="chunk")
+        self.slots = threading.BoundedSemaphore(max_concurrency * 2)
+        self.total_bytes, self.new_bytes, self.total_chunks, self.new_chunks = 0, 0, 0, 0
+
+    def put_chunk(self, name, chunk, codec, level):
+        """
+        Compress, encrypt and upload a chunk. Runs in the executor
+        :return:
+        """
+        try:
+            body = compress_block(codec, chunk, level) if codec != "none" else chunk
+            if self.encryptor:
+                body = encrypt_bytes(self.encryptor, body)
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.chunk_prefix + "/" + name, Body=body)
+        finally:
+            self.slots.release()
+
+    def backup(self, location, last_modified):
+        """
+        Upload the new chunks and the recipe of the file
+        :param location:
+        :param last_modified: last modified time is added as metadata of the recipe. Used while restoring the file
+        :return: bool
+        """
+        codec, level = self.codec_policy.choose(location) if self.codec_policy else ("none", None)
+        suffix = CODEC_SUFFIXES[codec] + (self.encryptor.suffix if self.encryptor else "")
+        names, submitted, size = list(), dict(), 0
+        try:
+            with open(location, "rb") as f_in:
+                for chunk in cdc_chunks(f_in, self.avg_size // 4, self.avg_size, self.avg_size * 4):
+                    digest = hashlib.sha256(chunk).hexdigest()
+                    size += len(chunk)
+                    self.total_chunks += 1
+                    self.total_bytes += len(chunk)
+                    name = submitted[digest][0] if digest in submitted else self.manifest.chunk_name(digest)
+                    if name is None:
+                        name = digest[:2] + "/" + digest + suffix
+                        self.slots.acquire()
+                        submitted[digest] = name, len(chunk), self.executor.submit(self.put_chunk, name, chunk, codec,
+                                                                                   level)
+                        self.new_chunks += 1
+                        self.new_bytes += len(chunk)
+                    names.append(name)
+        except OSError as e:
+            LOGGER.error("Couldn't read {} for dedup. {}".format(location, e))
+            return False
+        finally:
+            failed = False
+            for digest, (name, chunk_size, future) in submitted.items():
+                try:
+                    future.result()
+                    self.manifest.add_chunk(digest, name, chunk_size)
+                except (ClientError, BotoCoreError, EncryptionError) as e:
+                    LOGGER.error("Couldn't upload chunk {} of {}. {}".format(name, location, e))
+                    failed = True
+        if failed:
+            return False
+
+        recipe = {"size": size, "chunk_prefix": self.chunk_prefix, "chunks": names}
+        key = s3_key(self.base_path, self.s3_prefix_path, location, location + ".recipe")
+        try:
+            self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=json.dumps(recipe).encode(),
+                               Metadata={"Local-Last-Modified": last_modified})
+        except (ClientError, BotoCoreError) as e:
+            LOGGER.error("Couldn't upload the recipe of {}. {}".format(location, e))
+            return False
+        self.manifest.annotate(location, recipe=names)
+        return True
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class PackStore:
+    """
+    Pack backup mode. The changed files smaller than threshold are compressed and encrypted one by one in memory and
+    appended to a pack object, uploaded below <s3_prefix_path>/.packs/ once it reaches pack_size, instead of a PUT and
+    a gpg process per file. Each pack is uploaded with its index, the json list of its members with their offset and
+    length, as <pack>.index, and the pack, offset and length of each file are kept in the manifest. A member is
+    compressed and encrypted on its own, so a single file is restored with one ranged GET of the pack.
+    With gpg encryption each member is still encrypted by a gpg process, aes-gcm encrypts them in process.
+    """
+    PACK_PREFIX = ".packs"
+
+    def __init__(self, s3, base_path, bucket_name, s3_prefix_path, codec_policy=None, encryptor=None,
+                 pack_size=16777216, threshold=1048576, max_concurrency=4):
+        """
+        :param s3: s3_client
+        :param base_path: The paths in the index are relative to it
+        :param bucket_name: Name of the bucket
+        :param s3_prefix_path: Prefix to be used after bucket name
+        :param codec_policy: CodecPolicy choosing the codec of each file. None doesn't compress
+        :param encryptor: GpgEncryptor/AesGcmEncryptor. None doesn't encrypt
+        :param pack_size: A pack is uploaded once it's at least this size
+        :param threshold: Files of at least this size are not packed
+        :param max_concurrency: Number of packs uploaded concurrently, and held in memory besides the one being filled
+        """
+        self.s3 = s3
+        self.base_path = base_path
+        self.bucket_name = bucket_name
+        self.pack_prefix = s3_prefix_path + "/" + self.PACK_PREFIX if s3_prefix_path else self.PACK_PREFIX
+        self.codec_policy = codec_policy
+        self.encryptor = encryptor
+        self.pack_size = pack_size
+        self.threshold = threshold
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="pack")
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        # Packs of this run are named after its start, so the later packs of a file sort after the earlier ones
+        self.run = datetime.now().strftime("%Y%m%d%H%M%S") + "-" + os.urandom(4).hex()
+        self.body, self.members = bytearray(), list()
+        self.packs = 0
+        self.uploaded, self.failed = list(), list()
+        self.collected = 0
+
+    def fits(self, location):
+        """
+        :param location:
+        :return: True if location is small enough to be packed
+        """
+        try:
+            return os.path.getsize(location) < self.threshold
+        except OSError:
+            return False
+
+    def add(self, location, last_modified, local_hash=None):
+        """
+        Compress, encrypt and append the file to the pack being filled, uploading the pack once it's full
+        :param location:
+        :param last_modified: last modified date of the file, kept in the index. Used while restoring the file
+        :param local_hash: Hash of the file found by scan, kept in the index
+        :return: codec of the file
+        """
+        codec, level = self.codec_policy.choose(location) if self.codec_policy else ("none", None)
+        with open(location, "rb") as f:
+            data = f.read()
+        body = compress_block(codec, data, level) if codec != "none" else data
+        if self.encryptor:
+            body = encrypt_bytes(self.encryptor, body)
+        self.members.append((location, {"path": location[len(self.base_path) + 1:], "offset": len(self.body),
+                                        "length": len(body), "size": len(data), "codec": codec,
+                                        "encryption": self.encryptor.name if self.encryptor else None,
+                                        "last_modified": last_modified, "hash": local_hash}))
+        self.body += body
+        if len(self.body) >= self.pack_size:
+            self.flush()
+        return codec
+
+    def flush(self):
+        """
+        Upload the pack being filled. Blocks while max_concurrency packs are being uploaded
+        :return:
+        """
+        if not self.members:
+            return
+        self.packs += 1
+        key = "{}/{}-{:06d}.pack".format(self.pack_prefix, self.run, self.packs)
+        self.slots.acquire()
+        self.executor.submit(self.put_pack, key, bytes(self.body), self.members)
+        self.body, self.members = bytearray(), list()
+
+    def put_pack(self, key, body, members):
+        """
+        Upload the pack and its index. Runs in the executor
+        :return:
+        """
+        try:
+            self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=body)
+            index = {"pack": key, "members": [member for _, member in members]}
+            self.s3.put_object(Bucket=self.bucket_name, Key=key[:-len(".pack")] + ".index",
+                               Body=json.dumps(index).encode())
+            LOGGER.info("Uploaded pack {} of [{}] files".format(key, len(members)))
+            self.uploaded.extend((location, [key, member["offset"], member["length"]]) for location, member in members)
+        except Exception as e:
+            # Any error fails the members, an error left in the future of the executor would go unnoticed
+            LOGGER.exception("Couldn't upload pack {}. {}".format(key, e))
+            self.failed.extend(location for location, _ in members)
+        finally:
+            self.slots.release()
+
+    def collect(self):
+        """
+        :return: list of (location, [pack key, offset, length]) of the packs uploaded since the last call
+        """
+        count = len(self.uploaded)
+        uploaded, self.collected = self.uploaded[self.collected:count], count
+        return uploaded
+
+    def close(self):
+        """
+        Upload the last pack and wait for the uploads
+        :return: list of the locations in the packs that couldn't be uploaded
+        """
+        self.flush()
+        self.executor.shutdown()
+        return self.failed
+
+
+def commit_packed(manifest, pack_store, backed_up):
+    """
+    Commit the locations of the packs uploaded so far, keeping their pack, offset and length in the manifest
+    :param manifest:
+    :param pack_store: PackStore
+    :param backed_up: list the committed locations are appended to
+    :return:
+    """
+    for location, pack in pack_store.collect():
+        manifest.annotate(location, pack=pack)
+        manifest.commit(location)
+        backed_up.append(location)
+
+
+def pack_location(pack_store, manifest, location, progress, backed_up):
+    """
+    Add location to the pack being filled, committing the locations of the packs uploaded so far
+    :param pack_store: PackStore
+    :param manifest:
+    :param location:
+    :param progress: Progress
+    :param backed_up: list the committed locations are appended to
+    :return:
+    """
+    LOGGER.info('Packing ' + location)
+    progress.draw("Packing", location)
+    try:
+        with progress.timer("pack"):
+            codec = pack_store.add(location, datetime.fromtimestamp(os.stat(location).st_mtime).date().isoformat(),
+                                   (manifest.current(location) or dict()).get("hash"))
+    except (OSError, EncryptionError) as e:
+        LOGGER.error("Couldn't pack {}. {}".format(location, e))
+        print("\nCouldn't pack " + location)
+        progress.add("failed")
+        return
+    progress.add("compressed", 1 if codec != "none" else 0)
+    progress.add("encrypted", 1 if pack_store.encryptor else 0)
+    progress.add("packed")
+    commit_packed(manifest, pack_store, backed_up)
+
+
+def object_metadata(last_modified, local_hash=None):
+    """
+    Metadata added to the uploaded objects
+    :param last_modified: last modified date of the file. Used while restoring the file
+    :param local_hash: Hash of the file found by scan. Used to reconcile the objects present in S3 with the scan when
+                       the manifest is lost
+    :return: dict
+    """
+    if local_hash:
+        return {"Local-Last-Modified": last_modified, "Local-Hash": local_hash}
+    return {"Local-Last-Modified": last_modified}
+
+
+def upload(s3, base_path, bucket_name, s3_prefix_path, location, tmp_location, last_modified, content_md5=None,
+           max_put_size=8388608, local_hash=None, suffix=""):
+    """
+    Upload the file to S3
+    :param s3: s3_client
+    :param base_path: Used to create the prefix i.e., to reflect the local file structure
+    :param bucket_name: Name of the bucket
+    :param s3_prefix_path: Prefix to be used after bucket name
+    :param location: Used to create the prefix i.e., to reflect the local file structure
+    :param tmp_location: Temporary location from where the file is uploaded. if no compress and no encrypt,
+                         location is considered as tmp_location
+    :param last_modified: last modified time is added as metadata while upload. Used while restoring the file
+    :param content_md5: base64 md5 of location calculated by scan. If given and the file is uploaded as is in a single
+                        put, S3 verifies the upload against it
+    :param max_put_size: Size up to which the file is uploaded in a single put with the content_md5
+    :param local_hash: Hash of location found by scan, added as metadata
+    :param suffix: Added to the file name of location when it is uploaded as is, see codec_suffix
+    :return: bool
+    """
+    key = s3_key(base_path, s3_prefix_path, location, tmp_location or location + suffix)
+    if not tmp_location:
+        tmp_location = location
+    try:
+        if content_md5 and tmp_location == location and os.path.getsize(location) <= max_put_size:
+            with open(location, "rb") as body:
+                s3.put_object(Bucket=bucket_name, Key=key, Body=body, ContentMD5=content_md5,
+                              Metadata=object_metadata(last_modified, local_hash))
+            return True
+        response = s3.upload_file(Filename=tmp_location, Bucket=bucket_name, Key=key,
+                                  ExtraArgs={"Metadata": object_metadata(last_modified, local_hash)})
+    except (ClientError, BotoCoreError, S3UploadFailedError) as e:
+        LOGGER.error("Client error for location: " + location + " with tmp_path: " + tmp_location + ". " + str(e))
+        return False
+    except FileNotFoundError as e:
+        LOGGER.error("Client error for location: " + location + " with tmp_path: " + tmp_location)
+        return False
+    return True
+
+
+def s3_key(base_path, s3_prefix_path, location, tmp_location):
+    """
+    Key of the uploaded file, reflecting the local file structure below base_path
+    :param base_path:
+    :param s3_prefix_path: Prefix to be used after bucket name
+    :param location: Used to create the prefix
+    :param tmp_location: The file name is taken from here, having the suffixes added by compression and encryption
+    :return: string
+    """
+    file_name = tmp_location[tmp_location.rindex("/") + 1:]
+    prefix = location[len(base_path):location.rindex("/")].strip("/")
+    if s3_prefix_path:
+        if prefix:
+            return s3_prefix_path + "/" + prefix + "/" + file_name
+        return s3_prefix_path + "/" + file_name
+    if prefix:
+        return prefix + "/" + file_name
+    return file_name
+
+
+def s3_client(session, endpoint_url=None, max_pool_connections=10):
+    """
+    Create the s3 client
+    :param session: boto3 session
+    :param endpoint_url: Endpoint of a S3 compatible store, like MinIO or moto server. None for AWS
+    :param max_pool_connections: Size of the connection pool, shared by the concurrent transfers
+    :return: s3_client
+    """
+    return session.client("s3", endpoint_url=endpoint_url, config=Config(max_pool_connections=max_pool_connections))
+
+
+class TokenBucket:
+    """
+    Caps the bytes per second. The bytes are taken as the requests are sent, a request larger than the bucket runs
+    it into debt, which the following requests wait out, so the average rate stays at the cap.
+    """
+
+    def __init__(self, rate=None, capacity=None):
+        """
+        :param rate: Bytes per second. None doesn't cap
+        :param capacity: Bytes that can be sent in a burst. By default one second of rate
+        """
+        self.lock = threading.Lock()
+        self.rate, self.capacity = None, None
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.set_rate(rate, capacity)
+
+    def set_rate(self, rate, capacity=None):
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.capacity = capacity or rate
+                self.tokens = min(self.tokens, self.capacity or 0)
+
+    def consume(self, size):
+        """
+        Take size bytes, sleeping till the bucket has them
+        :param size: Bytes
+        :return:
+        """
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time:
+            time.sleep(wait_time)
+
+
+class AdaptiveConcurrency:
+    """
+    Number of requests sent at once, adjusted by additive increase and multiplicative decrease: one more request is
+    allowed after each interval the throughput improved, and the allowed requests are halved on a throttling error or
+    a timeout, at most once per interval.
+    """
+
+    def __init__(self, maximum, minimum=1, adaptive=True, interval=5):
+        """
+        :param maximum: Requests allowed at most
+        :param minimum: Requests allowed at least, where adaptive starts
+        :param adaptive: If False, maximum requests are allowed
+        :param interval: Seconds the throughput is measured over
+        """
+        self.condition = threading.Condition()
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.adaptive = adaptive
+        self.interval = interval
+        self.limit = self.minimum if adaptive else maximum
+        self.active = 0
+        self.window_start = self.last_decrease = time.monotonic()
+        self.window_bytes = 0
+        self.throughput = None
+
+    def set_maximum(self, maximum):
+        with self.condition:
+            self.maximum = maximum
+            self.limit = min(self.limit, maximum) if self.adaptive else maximum
+            self.condition.notify_all()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, size=0, throttled=False):
+        """
+        :param size: Bytes sent by the request
+        :param throttled: If True, the request was throttled or timed out
+        :return:
+        """
+        with self.condition:
+            self.active -= 1
+            now = time.monotonic()
+            if throttled:
+                if self.adaptive and now - self.last_decrease >= self.interval:
+                    self.limit = max(1, min(self.minimum, self.maximum), self.limit // 2)
+                    self.last_decrease = now
+                    self.window_start, self.window_bytes, self.throughput = now, 0, None
+                    LOGGER.info("Upload concurrency decreased to [{}]".format(self.limit))
+            else:
+                self.window_bytes += size
+                if now - self.window_start >= self.interval:
+                    throughput = self.window_bytes / (now - self.window_start)
+                    if self.adaptive and self.limit < self.maximum and \
+                            (self.throughput is None or throughput > self.throughput * 1.05):
+                        self.limit += 1
+                        LOGGER.info("Upload concurrency increased to [{}] at [{:.2f}] MB/s".format(
+                            self.limit, throughput / 1048576))
+                    self.window_start, self.window_bytes, self.throughput = now, 0, throughput
+            self.condition.notify_all()
+
+
+class UploadShaper:
+    """
+    Shapes the uploads of an s3 client: caps their bandwidth with a TokenBucket and their concurrency with
+    AdaptiveConcurrency. The PutObject and UploadPart requests of every upload path of the client, including their
+    retries, take the bytes and a slot as they are sent. The limits may change by the time of day.
+    """
+    OPERATIONS = ("PutObject", "UploadPart")
+    THROTTLING_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestTimeout", "RequestLimitExceeded",
+                        "ServiceUnavailable"}
+    DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+    def __init__(self, max_bandwidth=None, max_concurrency=10, adaptive=False, min_concurrency=1, windows=None,
+                 interval=5):
+        """
+        :param max_bandwidth: Bytes per second outside the windows. None doesn't cap
+        :param max_concurrency: Requests sent at once outside the windows
+        :param adaptive: If True, adjust the requests sent at once between min_concurrency and the maximum
+        :param min_concurrency:
+        :param windows: list of {"start": "HH:MM", "end": "HH:MM", "days": ["mon", ..], "max_bandwidth": ..,
+                        "max_concurrency": ..}. The first window the local time is in sets the limits, a window
+                        ending before its start spans midnight. Without days, a window applies every day
+        :param interval: Seconds the throughput is measured over by the adaptive concurrency
+        """
+        self.default = {"max_bandwidth": max_bandwidth, "max_concurrency": max_concurrency}
+        self.windows = list()
+        for window in windows or list():
+            days = window.get("days") or self.DAYS
+            unknown = set(days) - set(self.DAYS)
+            if unknown:
+                raise ValueError("Unknown days {} in the window {}".format(sorted(unknown), window))
+            self.windows.append((self.minutes(window["start"]), self.minutes(window["end"]),
+                                 {self.DAYS.index(day) for day in days},
+                                 {"max_bandwidth": window.get("max_bandwidth"),
+                                  "max_concurrency": min(window.get("max_concurrency", max_concurrency),
+                                                         max_concurrency)}))
+        self.bucket = TokenBucket()
+        self.concurrency = AdaptiveConcurrency(max_concurrency, min_concurrency, adaptive, interval)
+        self.local = threading.local()
+        self.checked = 0
+        self.limits = None
+        self.check_window()
+
+    @staticmethod
+    def minutes(hh_mm):
+        hours, minutes = hh_mm.split(":")
+        if not (0 <= int(hours) <= 24 and 0 <= int(minutes) < 60):
+            raise ValueError("Invalid time {}".format(hh_mm))
+        return int(hours) * 60 + int(minutes)
+
+    def current_limits(self, now=None):
+        """
+        :param now: datetime. By default the local time
+        :return: dict of max_bandwidth and max_concurrency of the window now is in
+        """
+        now = now or datetime.now()
+        minute, day = now.hour * 60 + now.minute, now.weekday()
+        for start, end, days, limits in self.windows:
+            if start <= end:
+                if day in days and start <= minute < end:
+                    return limits
+            # Spanning midnight, the part after midnight belongs to the window started the day before
+            elif (day in days and minute >= start) or ((day - 1) % 7 in days and minute < end):
+                return limits
+        return self.default
+
+    def check_window(self):
+        """
+        Apply the limits of the current window, checked at most once a minute
+        :return:
+        """
+        if time.monotonic() - self.checked < 60:
+            return
+        self.checked = time.monotonic()
+        limits = self.current_limits()
+        if limits != self.limits:
+            self.limits = limits
+            self.bucket.set_rate(limits["max_bandwidth"])
+            self.concurrency.set_maximum(limits["max_concurrency"])
+            LOGGER.info("Upload limits are {}".format(limits))
+
+    def attach(self, s3):
+        """
+        Shape the uploads of the s3 client
+        :param s3: s3_client
+        :return: s3
+        """
+        for operation in self.OPERATIONS:
+            s3.meta.events.register("before-send.s3.{}".format(operation), self.before_send)
+            s3.meta.events.register("response-received.s3.{}".format(operation), self.response_received)
+        return s3
+
+    def before_send(self, request, **kwargs):
+        self.check_window()
+        headers = request.headers
+        # The length of the payload, without the checksum trailer of an aws-chunked body
+        size = int(headers.get("X-Amz-Decoded-Content-Length") or headers.get("Content-Length") or 0)
+        self.concurrency.acquire()
+        self.local.size = size
+        self.bucket.consume(size)
+
+    def response_received(self, response_dict=None, parsed_response=None, exception=None, **kwargs):
+        size = getattr(self.local, "size", None)
+        if size is None:
+            return
+        self.local.size = None
+        error = (parsed_response or dict()).get("Error", dict())
+        status = (response_dict or dict()).get("status_code")
+        throttled = isinstance(exception, (ReadTimeoutError, ConnectTimeoutError)) or status in (429, 503) or \
+            error.get("Code") in self.THROTTLING_CODES
+        self.concurrency.release(size if exception is None and not error else 0, throttled)
+
+
+class UploadSubscriber(BaseSubscriber):
+    """
+    Reports the result of a queued upload back to the Uploader
+    """
+
+    def __init__(self, uploader, location, tmp_location, tmp_dir, reserved=0):
+        self.uploader = uploader
+        self.location = location
+        self.tmp_location = tmp_location
+        self.tmp_dir = tmp_dir
+        self.reserved = reserved
+
+    def on_done(self, future, **kwargs):
+        try:
+            future.result()
+            error = None
+        except Exception as e:
+            # Any error is reported, done has to release the slot, the tmp_path and the reservation of the upload
+            error = e
+        self.uploader.done(self.location, self.tmp_location, self.tmp_dir, error, self.reserved)
+
+
+class Uploader:
+    """
+    Upload many files at once using a s3transfer TransferManager over one pooled client, instead of blocking on
+    upload() per file. The number of queued files is bounded, so that the tmp_path doesn't fill up when the files
+    are produced faster than they are uploaded. The results are collected as the uploads complete.
+    """
+
+    def __init__(self, s3, base_path, bucket_name, s3_prefix_path, max_concurrency=10, multipart_threshold=8388608,
+                 multipart_chunksize=8388608, max_queued=None, budget=None):
+        """
+        :param s3: s3_client, with at least max_concurrency connections in its pool
+        :param base_path: Used to create the prefix i.e., to reflect the local file structure
+        :param bucket_name: Name of the bucket
+        :param s3_prefix_path: Prefix to be used after bucket name
+        :param max_concurrency: Number of concurrent requests, shared by the parts of all the queued files
+        :param multipart_threshold: Files larger than this are uploaded in parts
+        :param multipart_chunksize: Size of each part
+        :param max_queued: Number of files queued before submit blocks. By default twice max_concurrency
+        :param budget: ResourceBudget the tmp_path bytes of the queued files are released to
+        """
+        self.base_path = base_path
+        self.budget = budget
+        self.bucket_name = bucket_name
+        self.s3_prefix_path = s3_prefix_path
+        config = TransferConfig(max_concurrency=max_concurrency, multipart_threshold=multipart_threshold,
+                                multipart_chunksize=multipart_chunksize)
+        self.manager = create_transfer_manager(s3, config)
+        self.slots = threading.BoundedSemaphore(max_queued or max_concurrency * 2)
+        self.uploaded, self.failed = list(), list()
+        self.collected = 0
+
+    def submit(self, location, tmp_location, last_modified, tmp_dir=None, local_hash=None, reserved=0, suffix=""):
+        """
+        Queue the upload of the file. Blocks while the queue is full
+        :param location: Used to create the prefix i.e., to reflect the local file structure
+        :param tmp_location: Temporary location from where the file is uploaded, removed once the upload is done.
+                             If None, location is uploaded
+        :param last_modified: last modified time is added as metadata while upload. Used while restoring the file
+        :param tmp_dir: Temporary directory of tmp_location, removed once the upload is done
+        :param local_hash: Hash of location found by scan, added as metadata
+        :param reserved: tmp_path bytes reserved for tmp_location, released once the upload is done
+        :param suffix: Added to the file name of location when it is uploaded as is, see codec_suffix
+        :return:
+        """
+        key = s3_key(self.base_path, self.s3_prefix_path, location, tmp_location or location + suffix)
+        if not tmp_location:
+            tmp_location = location
+        self.slots.acquire()
+        try:
+            self.manager.upload(tmp_location, self.bucket_name, key,
+                                extra_args={"Metadata": object_metadata(last_modified, local_hash)},
+                                subscribers=[UploadSubscriber(self, location, tmp_location, tmp_dir, reserved)])
+        except Exception as e:
+            # Failed before it was queued, no subscriber will release the slot
+            self.done(location, tmp_location, tmp_dir, e, reserved)
+
+    def done(self, location, tmp_location, tmp_dir, error, reserved=0):
+        """
+        Called by the transfer threads as each upload completes
+        :return:
+        """
+        if error:
+            LOGGER.error("Upload failed for location: {} with tmp_path: {}. {}".format(location, tmp_location, error))
+            self.failed.append(location)
+        else:
+            LOGGER.info("Uploaded {}".format(location))
+            self.uploaded.append(location)
+        if tmp_location != location:
+            clean_up(tmp_location)
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if self.budget:
+            self.budget.release(reserved)
+        self.slots.release()
+
+    def collect(self):
+        """
+        :return: list of the locations uploaded since the last call, to be committed as the uploads complete
+        """
+        count = len(self.uploaded)
+        uploaded, self.collected = self.uploaded[self.collected:count], count
+        return uploaded
+
+    def wait(self):
+        """
+        Wait for all the queued uploads to complete
+        :return: list, list. Uploaded locations, failed locations
+        """
+        self.manager.shutdown()
+        return self.uploaded, self.failed
+
+
+def commit_uploaded(manifest, uploader, queued, backed_up):
+    """
+    Commit the locations of the queued uploads completed so far
+    :param manifest:
+    :param uploader: Uploader
+    :param queued: dict of {uploaded location: [locations backed up by the upload]}, a directory maps to the members
+                   of its archive
+    :param backed_up: list the committed locations are appended to
+    :return:
+    """
+    for uploaded in uploader.collect():
+        for location in queued.pop(uploaded):
+            manifest.commit(location)
+            backed_up.append(location)
+
+
+class Inventory:
+    """
+    Listing of the objects below the s3_prefix_path, cached in a sqlite database next to the manifest so that the
+    prefix is listed once per max_age. Used to reconcile the changed files with the objects already in S3, when the
+    manifest was lost or the base_path is backed up from a new host.
+    """
+
+    def __init__(self, db_path, max_age=86400):
+        """
+        :param db_path: sqlite database file
+        :param max_age: Seconds after which the listing is refreshed
+        """
+        self.db_path = db_path
+        self.max_age = max_age
+        # Read by the hash workers of the pipeline
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, size INTEGER, etag TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)")
+        self.connection.commit()
+
+    def state(self, key):
+        row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def stale(self, bucket_name, prefix):
+        """
+        :return: True if the listing is older than max_age or of another bucket or prefix
+        """
+        listed = self.state("listed")
+        return listed is None or time.time() - listed > self.max_age or \
+            self.state("location") != "{}/{}".format(bucket_name, prefix)
+
+    def refresh(self, s3, bucket_name, prefix, workers=8):
+        """
+        List the objects below prefix. The first level is listed with a delimiter and each common prefix below it is
+        then listed on its own thread, so that a prefix with millions of keys isn't listed one page after another.
+        :param s3: s3_client
+        :param bucket_name:
+        :param prefix: s3_prefix_path
+        :param workers: Number of prefixes listed in parallel
+        :return: Number of objects listed
+        """
+        start = time.time()
+        root = prefix + "/" if prefix else ""
+
+        def list_prefix(sub_prefix, delimiter=None):
+            objects, prefixes = list(), list()
+            arguments = {"Bucket": bucket_name, "Prefix": sub_prefix}
+            if delimiter:
+                arguments["Delimiter"] = delimiter
+            for page in s3.get_paginator("list_objects_v2").paginate(**arguments):
+                objects.extend((item["Key"], item["Size"], item["ETag"].strip('"'))
+                               for item in page.get("Contents", list()))
+                prefixes.extend(item["Prefix"] for item in page.get("CommonPrefixes", list()))
+            return objects, prefixes
+
+        objects, prefixes = list_prefix(root, "/")
+        with self.connection:
+            self.connection.execute("DELETE FROM objects")
+            self.connection.executemany("INSERT OR REPLACE INTO objects (key, size, etag) VALUES (?, ?, ?)", objects)
+        count = len(objects)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="list") as executor:
+            for objects, _ in executor.map(list_prefix, prefixes):
+                with self.connection:
+                    self.connection.executemany("INSERT OR REPLACE INTO objects (key, size, etag) VALUES (?, ?, ?)",
+                                                objects)
+                count += len(objects)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('listed', ?)", (time.time(),))
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('location', ?)",
+                                    ("{}/{}".format(bucket_name, prefix),))
+        print("Listed [{}] objects below s3://{}/{} in [{:.4f}]s".format(count, bucket_name, root,
+                                                                         time.time() - start))
+        LOGGER.info("Listed [{}] objects below s3://{}/{}".format(count, bucket_name, root))
+        return count
+
+    def get(self, key):
+        """
+        :param key:
+        :return: (size, etag) of the object, None if not listed
+        """
+        with self.lock:
+            return self.connection.execute("SELECT size, etag FROM objects WHERE key = ?", (key,)).fetchone()
+
+    def close(self):
+        self.connection.close()
+
+
+def open_inventory(s3, base_path, bucket_name, s3_prefix_path, meta_file_name=None, max_age=86400, workers=8,
+                   refresh=False):
+    """
+    Open the cached listing of the s3_prefix_path, listing it again if it is stale
+    :param refresh: If True, list again even if the listing is not stale. The objects uploaded since the listing are
+                    not in it, so it is refreshed when the manifest was lost
+    :return: Inventory
+    """
+    inventory = Inventory(metadata_path(base_path, meta_file_name, ".inventory.db"), max_age)
+    if refresh or inventory.stale(bucket_name, s3_prefix_path):
+        inventory.refresh(s3, bucket_name, s3_prefix_path, workers)
+    return inventory
+
+
+def codec_suffix(codec, compressing=False):
+    """
+    :param codec: Codec the file is compressed with, "none" if stored as is
+    :param compressing: If True, the entry compresses. A file it stores as is gets STORED_SUFFIX
+    :return: Suffix added to the file name by the compression
+    """
+    if codec == "none" and compressing:
+        return STORED_SUFFIX
+    return CODEC_SUFFIXES[codec]
+
+
+def object_suffix(location, codec_policy=None, encryptor=None):
+    """
+    :param location:
+    :param codec_policy: CodecPolicy. None doesn't compress
+    :param encryptor: None doesn't encrypt
+    :return: Suffixes added to the file name of location by the compression and encryption
+    """
+    codec = codec_policy.choose(location)[0] if codec_policy else "none"
+    return codec_suffix(codec, codec_policy is not None) + (encryptor.suffix if encryptor else "")
+
+
+def reconciled(s3, inventory, bucket_name, key, location, info, last_modified):
+    """
+    Check if the object at key is already a backup of location. A listed object is matched by its ETag when it is
+    the md5 of the file uploaded as is, else by the Local-Hash metadata. Objects uploaded before Local-Hash was added
+    are matched by their Local-Last-Modified and size, only if uploaded as is.
+    :param s3: s3_client
+    :param inventory: Inventory
+    :param bucket_name:
+    :param key: Key location would be uploaded to
+    :param location:
+    :param info: dict having the hash, stat and md5 of location found by scan
+    :param last_modified: last modified date of location
+    :return: bool
+    """
+    listed = inventory.get(key)
+    if listed is None:
+        return False
+    size, etag = listed
+    as_is = key.endswith("/" + os.path.basename(location)) or key == os.path.basename(location)
+    if as_is and size != info["stat"][0]:
+        return False
+    if as_is and info.get("md5") and base64.b64decode(info["md5"]).hex() == etag:
+        return True
+    try:
+        metadata = s3.head_object(Bucket=bucket_name, Key=key)["Metadata"]
+    except (ClientError, BotoCoreError) as e:
+        LOGGER.error("Couldn't head {}. {}".format(key, e))
+        return False
+    if "local-hash" in metadata:
+        return metadata["local-hash"] == info["hash"]
+    return as_is and metadata.get("local-last-modified") == last_modified
+
+
+def reconcile(s3, inventory, manifest, base_path, bucket_name, s3_prefix_path, locations, codec_policy=None,
+              encryptor=None, workers=8, present=None):
+    """
+    Find the changed locations already backed up in S3, e.g. by a run whose manifest was lost, and commit them. The
+    locations are checked workers * 4 at a time ahead of the one yielded
+    :param s3: s3_client
+    :param inventory: Inventory
+    :param manifest: Manifest having the file information found by scan
+    :param base_path:
+    :param bucket_name:
+    :param s3_prefix_path:
+    :param locations: Changed locations
+    :param codec_policy: CodecPolicy. None doesn't compress
+    :param encryptor: None doesn't encrypt
+    :param workers: Number of objects checked in parallel
+    :param present: list the locations present in S3 are appended to
+    :return: generator of the locations to be backed up
+    """
+    start = time.time()
+    present = present if present is not None else list()
+    count_present, count_missing = 0, 0
+
+    def check(location, info):
+        # The codec is chosen here, as it may probe the file
+        key = s3_key(base_path, s3_prefix_path, location, location + object_suffix(location, codec_policy, encryptor))
+        last_modified = datetime.fromtimestamp(info["stat"][1] / 1e9).date().isoformat()
+        return reconciled(s3, inventory, bucket_name, key, location, info, last_modified)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reconcile") as executor:
+        pending = collections.deque()
+        locations = iter(locations)
+        while True:
+            # The manifest is only used from the calling thread
+            for location in locations:
+                pending.append((location, executor.submit(check, location, manifest.current(location))))
+                if len(pending) >= workers * 4:
+                    break
+            if not pending:
+                break
+            location, future = pending.popleft()
+            if future.result():
+                manifest.commit(location)
+                present.append(location)
+                count_present += 1
+            else:
+                count_missing += 1
+                yield location
+    print("\nReconciled [{}] changed files already present in S3, [{}] backed up, in [{:.4f}]s".format(
+        count_present, count_missing, time.time() - start))
+    LOGGER.info("Reconciled [{}] changed files already present in S3, [{}] backed up".format(count_present,
+                                                                                         count_missing))
+
+
+class ResourceBudget:
+    """
+    Limits shared by the config entries backed up concurrently. Each hashing thread, compression task and S3 request
+    holds one unit of its resource while it runs, taken from a semaphore shared by all the entries, so the limits
+    hold however the workers of the entries add up. The tmp_path bytes are reserved as the files are written to the
+    tmp_path and released once they are removed, so an entry waits for the space freed by the others instead of
+    filling the disk.
+    """
+
+    def __init__(self, entries=1, hash_threads=None, compress_processes=None, upload_connections=None,
+                 tmp_bytes=None):
+        """
+        :param entries: Number of entries backed up at once
+        :param hash_threads: Files hashed at once by all the entries. None doesn't limit them
+        :param compress_processes: Files or blocks compressed at once by all the entries. None doesn't limit them
+        :param upload_connections: Concurrent S3 requests of all the entries. None doesn't limit them
+        :param tmp_bytes: Bytes in the tmp_path of all the entries. None doesn't limit them
+        """
+        self.entries = entries
+        self.limits = {"hash_threads": hash_threads, "compress_processes": compress_processes,
+                       "upload_connections": upload_connections}
+        self.slots = {resource: threading.BoundedSemaphore(limit) if limit else None
+                      for resource, limit in self.limits.items()}
+        self.local = threading.local()
+        self.tmp_bytes = tmp_bytes
+        self.tmp_used = 0
+        self.condition = threading.Condition()
+
+    def entry_budget(self, tmp_bytes):
+        """
+        :param tmp_bytes: Bytes in the tmp_path of one entry
+        :return: ResourceBudget of the tmp_bytes, sharing the other limits with this one
+        """
+        budget = ResourceBudget(self.entries, tmp_bytes=tmp_bytes)
+        budget.limits, budget.slots = self.limits, self.slots
+        return budget
+
+    def cap(self, resource, wanted):
+        """
+        :param resource: "hash_threads", "compress_processes" or "upload_connections"
+        :param wanted: Number of workers configured for the entry. 0 or None, e.g. serial hashing, is kept as is
+        :return: wanted, capped to the limit. More workers would only wait for the units held by the others
+        """
+        limit = self.limits[resource]
+        if limit is None or not wanted:
+            return wanted
+        return min(wanted, limit)
+
+    def hold(self, resource):
+        """
+        :param resource: "hash_threads", "compress_processes" or "upload_connections"
+        :return: Context manager holding one unit of the resource for the work done in it
+        """
+        return self.slots[resource] or contextlib.nullcontext()
+
+    def gate(self, resource, executor):
+        """
+        :param resource: "hash_threads" or "compress_processes"
+        :param executor: Thread or process pool running the work of the resource. May be None
+        :return: executor, its tasks holding one unit of the resource each, see GatedExecutor
+        """
+        if executor is None or self.slots[resource] is None:
+            return executor
+        return GatedExecutor(executor, self.slots[resource])
+
+    def attach(self, s3):
+        """
+        Hold one of the upload_connections for each request of the s3 client, from its send till its response
+        :param s3: s3_client
+        :return: s3
+        """
+        if self.slots["upload_connections"] is not None:
+            s3.meta.events.register("before-send.s3", self.before_send)
+            s3.meta.events.register("response-received.s3", self.response_received)
+        return s3
+
+    def before_send(self, **kwargs):
+        self.slots["upload_connections"].acquire()
+        self.local.held = True
+
+    def response_received(self, **kwargs):
+        if getattr(self.local, "held", False):
+            self.local.held = False
+            self.slots["upload_connections"].release()
+
+    def reserve(self, size, blocking=True):
+        """
+        Reserve size bytes of the tmp_path, blocking while they would exceed tmp_bytes. Once nothing else is
+        reserved, size is granted even if larger than tmp_bytes, so a large file isn't blocked forever
+        :param size: Bytes
+        :param blocking: If False, return None instead of waiting
+        :return: Bytes reserved, to be released
+        """
+        if self.tmp_bytes is None or not size:
+            return 0
+        with self.condition:
+            while self.tmp_used and self.tmp_used + size > self.tmp_bytes:
+                if not blocking:
+                    return None
+                self.condition.wait()
+            self.tmp_used += size
+        return size
+
+    def release(self, size):
+        if not size:
+            return
+        with self.condition:
+            self.tmp_used -= size
+            self.condition.notify_all()
+
+
+class GatedExecutor:
+    """
+    Executor whose tasks hold one unit of a resource of the ResourceBudget each, from their submit till they are
+    done. submit blocks while all the units are held by the tasks of any entry
+    """
+
+    def __init__(self, executor, slots):
+        """
+        :param executor: ThreadPoolExecutor/ProcessPoolExecutor
+        :param slots: BoundedSemaphore of the resource
+        """
+        self.executor = executor
+        self.slots = slots
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.executor.shutdown(wait, cancel_futures=cancel_futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        return False
+
+
+def tmp_size(locations, intermediates=1, archived=False):
+    """
+    Estimate the tmp_path bytes used to back up the locations: the intermediate files of the largest location, as
+    they are written one location at a time, and the archive of all the locations
+    :param locations:
+    :param intermediates: Number of intermediate files of each location, i.e. compressed and/or encrypted
+    :param archived: If True, the locations are archived in the tmp_path
+    :return: Bytes
+    """
+    sizes = list()
+    for location in locations:
+        try:
+            sizes.append(os.path.getsize(location))
+        except OSError:
+            continue
+    return max(sizes, default=0) * intermediates + (sum(sizes) if archived else 0)
+
+
+def process_pool(workers):
+    """
+    Create a process pool. The workers are started by a fork server, so that they don't inherit the pipes of the gpg
+    processes running when the pool grows, which would keep gpg waiting for the end of its input
+    :param workers: Number of processes
+    :return: ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"))
+
+
+def hash_executor(hash_workers, hash_pool="thread"):
+    """
+    Create the pool used by scan to calculate the hashes in parallel
+    :param hash_workers: Number of workers. 0 disables the pool and the hashes are calculated serially
+    :param hash_pool: "thread" or "process". Threads are enough as hashlib releases the GIL on large blocks,
+                      processes can be used when the hashing is cpu bound on many small files
+    :return: Executor or None
+    """
+    if not hash_workers:
+        return None
+    if hash_pool == "process":
+        return process_pool(hash_workers)
+    return ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="hash")
+
+
+def stat_key(stat):
+    """
+    The part of the stat result used to detect a change without reading the file
+    :param stat: os.stat_result
+    :return: tuple (st_size, st_mtime_ns, st_ino, st_dev)
+    """
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev
+
+
+class Journal:
+    """
+    Filesystem events below a base_path, recorded in a sqlite database by perfios_backup_watcher.py. The backup run
+    reads the paths changed since the events it consumed last, instead of walking the whole tree. The watcher adds a
+    marker (an event without a path) when it starts, when its watches are ready, when the kernel queue overflows or
+    some directories couldn't be watched, and when it stops. Any marker after the consumed events, or a heartbeat
+    older than max_lag, means events may be missing and the run walks the whole tree.
+    """
+    START, READY, OVERFLOW, STOP = "start", "ready", "overflow", "stop"
+
+    def __init__(self, db_path, max_lag=300):
+        """
+        :param db_path: sqlite database file
+        :param max_lag: Seconds since the last heartbeat of the watcher after which it is considered not running
+        """
+        self.db_path = db_path
+        self.max_lag = max_lag
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, "
+                                "event TEXT, time REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)")
+        self.connection.commit()
+        self.last_id = None
+        self.deferred = list()
+
+    def add(self, events):
+        """
+        Record events
+        :param events: iterable of (path, event)
+        :return:
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT INTO events (path, event, time) VALUES (?, ?, ?)",
+                                        ((path, event, now) for path, event in events))
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('heartbeat', ?)", (now,))
+
+    def mark(self, marker):
+        """
+        Record a marker
+        :param marker: START, READY, OVERFLOW or STOP
+        :return:
+        """
+        self.add([(None, marker)])
+
+    def heartbeat(self):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('heartbeat', ?)", (time.time(),))
+
+    def state(self, key):
+        row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def changes(self):
+        """
+        The paths having events since the last consumed event. Consumed by commit
+        :return: set of paths, None if the journal can't be trusted and the whole tree has to be walked
+        """
+        self.last_id = self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        self.deferred = list()
+        consumed = self.state("consumed")
+        heartbeat = self.state("heartbeat")
+        reason = None
+        if consumed is None:
+            reason = "no event was consumed yet"
+        elif heartbeat is None or time.time() - heartbeat > self.max_lag:
+            reason = "the watcher is not running"
+        else:
+            markers = [row[0] for row in self.connection.execute(
+                "SELECT event FROM events WHERE id > ? AND id <= ? AND path IS NULL", (consumed, self.last_id))]
+            if markers:
+                reason = "the journal has the markers {}".format(markers)
+        if reason:
+            LOGGER.info("Walking the whole tree as {} in {}".format(reason, self.db_path))
+            return None
+        return {row[0] for row in self.connection.execute(
+            "SELECT DISTINCT path FROM events WHERE id > ? AND id <= ?", (consumed, self.last_id))}
+
+    def defer(self, path):
+        """
+        Keep the event of path for the next run, e.g. for a file ignored by consider_older
+        :param path:
+        :return:
+        """
+        self.deferred.append(path)
+
+    def commit(self):
+        """
+        Mark the events read by changes as consumed, once the backup run is done
+        :return:
+        """
+        if self.last_id is None:
+            return
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('consumed', ?)", (self.last_id,))
+            self.connection.execute("DELETE FROM events WHERE id <= ?", (self.last_id,))
+        if self.deferred:
+            # Added after the consumed events, so that they don't look like a gap
+            self.connection.executemany("INSERT INTO events (path, event, time) VALUES (?, 'deferred', ?)",
+                                        ((path, time.time()) for path in self.deferred))
+            self.connection.commit()
+        self.last_id = None
+
+    def close(self):
+        self.connection.close()
+
+
+def open_journal(base_path, meta_file_name=None, max_lag=300):
+    """
+    Open the journal written by perfios_backup_watcher.py for the base_path
+    :param base_path: string
+    :param meta_file_name: Name of the metadata file. By default, the last directory of base_path
+    :param max_lag: Seconds since the last heartbeat of the watcher after which it is considered not running
+    :return: Journal/None if the watcher never ran for base_path
+    """
+    db_path = metadata_path(base_path, meta_file_name, ".journal.db")
+    if not os.path.exists(db_path):
+        LOGGER.info("No journal at {}, walking the whole tree".format(db_path))
+        return None
+    return Journal(db_path, max_lag)
+
+
+def file_filter(include, exclude):
+    """
+    Compile include and exclude into a single decision on the file name. Exclude has higher precedence than include,
+    i.e., files are first excluded and then included
+    :param include: Regex compiled object to search for matching file to include
+    :param exclude: Regex compiled object to search for matching file to exclude
+    :return: function taking the file name and returning True if the file is included
+    """
+    if include and exclude:
+        include_search, exclude_search = include.search, exclude.search
+        return lambda file: exclude_search(file) is None and include_search(file) is not None
+    if exclude:
+        exclude_search = exclude.search
+        return lambda file: exclude_search(file) is None
+    if include:
+        include_search = include.search
+        return lambda file: include_search(file) is not None
+    return lambda file: True
+
+
+def list_dir(root, included):
+    """
+    List a directory with os.scandir. Only the included files are stat-ed, symlinks to directories are not followed,
+    like os.walk
+    :param root: Directory
+    :param included: function deciding on the file names, see file_filter
+    :return: tuple (root, [(file, os.stat_result)] of the included files, [file] of the excluded files, [directory])
+    """
+    included_files, excluded_files, dirs = list(), list(), list()
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            dirs.append(entry.path)
+                        continue
+                    if included(entry.name):
+                        included_files.append((entry.name, entry.stat()))
+                    else:
+                        excluded_files.append(entry.name)
+                except OSError as e:
+                    LOGGER.error("Couldn't stat {}. {}".format(entry.path, e))
+    except OSError as e:
+        LOGGER.error("Couldn't list {}. {}".format(root, e))
+    return root, included_files, excluded_files, dirs
+
+
+def scandir_walk(roots, included, workers=0):
+    """
+    Walk the trees below roots with os.scandir, reusing the stat of the directory entries. With workers, the
+    directories are listed by a thread pool, so that the latency of the metadata calls on network file systems
+    overlaps. The directories are yielded in no particular order.
+    :param roots: list of directories
+    :param included: function deciding on the file names, see file_filter
+    :param workers: Number of threads listing the directories. 0 lists them serially
+    :return: generator of (root, [(file, os.stat_result)] of the included files, [file] of the excluded files)
+    """
+    waiting = collections.deque(roots)
+    if not workers:
+        while waiting:
+            root, included_files, excluded_files, dirs = list_dir(waiting.pop(), included)
+            waiting.extend(reversed(dirs))
+            yield root, included_files, excluded_files
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="walk") as executor:
+        pending = set()
+        while waiting or pending:
+            # Bound the listed but not yet consumed directories
+            while waiting and len(pending) < workers * 4:
+                pending.add(executor.submit(list_dir, waiting.popleft(), included))
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                root, included_files, excluded_files, dirs = future.result()
+                waiting.extend(dirs)
+                yield root, included_files, excluded_files
+
+
+def walk(base_path, manifest, journal=None, included=None, workers=0):
+    """
+    Walk base_path with scandir_walk. With a journal, only the paths having events are walked: a changed file is
+    yielded alone, a created or moved in directory is walked, and a deleted or moved out path is forgotten by the
+    manifest.
+    :param base_path:
+    :param manifest: Manifest the deleted paths are forgotten in
+    :param journal: Journal. None walks the whole tree
+    :param included: function deciding on the file names, see file_filter. None includes all the files
+    :param workers: Number of threads listing the directories. 0 lists them serially
+    :return: generator of (root, [(file, os.stat_result)] of the included files, [file] of the excluded files)
+    """
+    included = included or file_filter(None, None)
+    paths = journal.changes() if journal else None
+    if paths is None:
+        manifest.begin_scan()
+        yield from scandir_walk([base_path], included, workers)
+        return
+    manifest.begin_scan(partial=True)
+    print("Walking [{}] paths from the journal".format(len(paths)))
+    LOGGER.info("Walking [{}] paths from the journal".format(len(paths)))
+    dirs = list()
+    # Sorted with a trailing /, so that the paths below a directory come right after it. Sorted as is, a/b-x would
+    # come between a/b and a/b/c, as - sorts before /
+    for path in sorted(paths, key=lambda path: path + "/"):
+        if path != base_path and not path.startswith(base_path + "/"):
+            continue
+        # Already walked with the directory having it
+        if dirs and path.startswith(dirs[-1] + "/"):
+            continue
+        if os.path.isdir(path):
+            dirs.append(path)
+        elif os.path.isfile(path):
+            root, file = os.path.split(path)
+            if included(file):
+                yield root, [(file, os.stat(path))], list()
+            else:
+                yield root, list(), [file]
+        else:
+            manifest.forget(path)
+    yield from scandir_walk(dirs, included, workers)
+
+
+class Progress:
+    """
+    Counters and timers of a backup run. The progress line is formatted and redrawn at most every interval seconds,
+    however often the counters change, and the counters and timers are exported at the end of the run, as JSON and as
+    a Prometheus textfile for the node_exporter textfile collector.
+    """
+    PROMETHEUS_LABEL = str.maketrans({"\\": "\\\\", "\"": "\\\"", "\n": "\\n"})
+
+    def __init__(self, template="", interval=0.25):
+        """
+        :param template: Progress line, formatted with the counters, e.g. "Uploaded [{uploaded}/{changed}]"
+        :param interval: Minimum seconds between two redraws of the progress line. None doesn't draw it
+        """
+        self.template = template
+        self.interval = interval
+        self.counters = collections.Counter()
+        self.timers = collections.Counter()
+        self.last_draw = 0
+        self.width = 0
+
+    def add(self, name, value=1):
+        self.counters[name] += value
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Add the time spent in the with block to the timer of stage
+        :param stage:
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage] += time.perf_counter() - start
+
+    def draw(self, action=None, location=None, force=False):
+        """
+        Redraw the progress line, if interval seconds passed since the last redraw
+        :param action: Shown after the counters, e.g. "Compressing"
+        :param location: Shown after the action
+        :param force: If True, redraw even if the interval didn't pass
+        :return:
+        """
+        if self.interval is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_draw < self.interval:
+            return
+        self.last_draw = now
+        line = self.template.format_map(self.counters)
+        if action:
+            line = "{}. {} {}".format(line, action, location)
+        # Pad over the longer line drawn before
+        print("\r" + line.ljust(self.width), end="", flush=True)
+        self.width = len(line)
+
+    def end(self):
+        """
+        Draw the final counters and end the progress line
+        :return:
+        """
+        if self.interval is None:
+            return
+        self.draw(force=True)
+        print()
+        self.width = 0
+
+    def metrics(self, base_path):
+        return {"base_path": base_path, "timestamp": time.time(), "counters": dict(self.counters),
+                "timers": {stage: round(seconds, 6) for stage, seconds in self.timers.items()}}
+
+    def export(self, base_path, metrics_path=None, textfile_path=None):
+        """
+        Write the counters and timers. Each file is written next to its path and renamed over it, so the collector
+        never reads a partial file
+        :param base_path: Labels the metrics
+        :param metrics_path: Path of the JSON metrics
+        :param textfile_path: Path of the Prometheus textfile, ending with .prom for the collector
+        :return:
+        """
+        metrics = self.metrics(base_path)
+        if metrics_path:
+            with open(metrics_path + ".tmp", "w") as f:
+                json.dump(metrics, f, indent=2)
+            os.replace(metrics_path + ".tmp", metrics_path)
+        if textfile_path:
+            label = "base_path=\"{}\"".format(base_path.translate(self.PROMETHEUS_LABEL))
+            lines = ["# HELP perfios_backup_count Files, directories and bytes through each stage of the last run",
+                     "# TYPE perfios_backup_count gauge"]
+            lines.extend("perfios_backup_count{{{},name=\"{}\"}} {}".format(label, name, value)
+                         for name, value in sorted(metrics["counters"].items()))
+            lines.extend(["# HELP perfios_backup_seconds Seconds spent in each stage of the last run",
+                          "# TYPE perfios_backup_seconds gauge"])
+            lines.extend("perfios_backup_seconds{{{},stage=\"{}\"}} {}".format(label, stage, seconds)
+                         for stage, seconds in sorted(metrics["timers"].items()))
+            lines.extend(["# HELP perfios_backup_last_run_timestamp_seconds End time of the last run",
+                          "# TYPE perfios_backup_last_run_timestamp_seconds gauge",
+                          "perfios_backup_last_run_timestamp_seconds{{{}}} {}".format(label, metrics["timestamp"])])
+            with open(textfile_path + ".tmp", "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(textfile_path + ".tmp", textfile_path)
+        LOGGER.info("Metrics of {} are {}".format(base_path, metrics))
+
+
+def scan(base_path, include, exclude, test_regex=False, consider_older=0, hash_workers=0, hash_pool="thread",
+         manifest=None, paranoid=False, journal=None, walk_workers=0, hash_algorithm="sha1", content_md5=False,
+         progress=None, budget=None):
+    """
+    Scan the files in base_path, creating their hashes. Precedence: Exclude has higher precedence than include, i.e.,
+    files are first excluded and then included.
+    :param base_path:
+    :param include: Regex compiled object to search for matching file to include
+    :param exclude: Regex compiled object to search for matching file to exclude
+    :param test_regex: If True, pretty print the included and excluded files
+    :param consider_older: Consider files older than these days
+    :param hash_workers: Number of workers hashing the files in parallel. 0 hashes the files serially
+    :param hash_pool: "thread" or "process", the kind of pool used when hash_workers is set
+    :param manifest: Manifest the file information of this scan is recorded in. The hash of a file is reused from
+                     the previous run, without reading the file, if its size, mtime, inode and device are unchanged
+    :param paranoid: If True, ignore the previous run and hash every file
+    :param journal: Journal of the watcher. Only the paths having events are scanned, unless the journal has a gap
+    :param walk_workers: Number of threads listing the directories in parallel. 0 lists them serially
+    :param hash_algorithm: see hash_constructor
+    :param content_md5: If True, the md5 used to verify the upload is recorded along with the hash
+    :param progress: Progress the scan is counted in
+    :param budget: ResourceBudget, each file hashed holds one of its hash_threads
+    :return: manifest having filename and their respective hashes and stat keys
+    """
+    start_scan = time.time()
+    if manifest is None:
+        manifest = PickleManifest(None)
+    if budget is None:
+        budget = ResourceBudget()
+    if progress is None:
+        progress = Progress()
+    progress.template = "Scanned [{scanned_dirs}] directories [{scanned_files}] files, [{included}] file included, " \
+                        "[{excluded}] files excluded"
+    counters = progress.counters
+    delta = datetime.now().date() - timedelta(consider_older)
+    executor = None if test_regex else budget.gate("hash_threads", hash_executor(hash_workers, hash_pool))
+    # Bound the submitted but not yet hashed files, so that the walk doesn't run too far ahead of the pool
+    pending, max_pending = dict(), hash_workers * 4
+    if test_regex:
+        exclude_files, include_files = [], []
+    print("{}".format("".join(["-"] * 75)))
+    print("Scanning files in {}".format(base_path))
+    LOGGER.info("Scanning files in {}".format(base_path))
+
+    def hash_it(location, stat):
+        """
+        Calculates the hash of the file.
+        :param location:
+        :param stat: os.stat_result of location, from the walk
+        :return:
+        """
+        m_time = datetime.fromtimestamp(stat.st_mtime).date()
+        if m_time < delta:
+            key = stat_key(stat)
+            old = None if paranoid else manifest.previous(location)
+            if old and old.get("stat") == key:
+                manifest.record(location, {"hash": old["hash"], "stat": key, "md5": old.get("md5")})
+                counters["hash_reused"] += 1
+            elif executor:
+                counters["hashed_bytes"] += stat.st_size
+                pending[executor.submit(checksum, location, hash_algorithm, content_md5)] = location, key
+                if len(pending) >= max_pending:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            else:
+                counters["hashed_bytes"] += stat.st_size
+                with budget.hold("hash_threads"):
+                    hashed = checksum(location, hash_algorithm, content_md5)
+                record(location, key, hashed)
+            # print("Time for {} is {}".format(location, str(time.time()-start)))
+        else:
+            LOGGER.info(
+                "Ignored [{}] as it's modified date is within the ignore range. m_time=[{}]".format(location, m_time))
+            if journal:
+                journal.defer(location)
+
+    def collect(done):
+        """
+        Collect the hashes calculated by the pool into the manifest
+        :param done: Completed futures
+        :return:
+        """
+        for future in done:
+            hashed_location, key = pending.pop(future)
+            record(hashed_location, key, future.result())
+
+    def record(hashed_location, key, result):
+        """
+        Record the result of checksum in the manifest
+        :return:
+        """
+        if content_md5:
+            manifest.record(hashed_location, {"hash": result[0], "stat": key, "md5": result[1]})
+        else:
+            manifest.record(hashed_location, {"hash": result, "stat": key})
+
+    for root, included_files, excluded_files in walk(base_path, manifest, None if test_regex else journal,
+                                                     file_filter(include, exclude), walk_workers):
+        for file, stat in included_files:
+            location = os.path.join(root, file)
+            hash_it(location, stat)
+            if test_regex:
+                include_files.append(location)
+        if test_regex:
+            exclude_files.extend(os.path.join(root, file) for file in excluded_files)
+        counters["included"] += len(included_files)
+        counters["excluded"] += len(excluded_files)
+        counters["scanned_files"] += len(included_files) + len(excluded_files)
+        counters["scanned_dirs"] += 1
+        progress.draw()
+
+    if executor:
+        try:
+            collect(wait(pending).done)
+        finally:
+            executor.shutdown()
+    manifest.end_scan()
+    end_scan = time.time()
+    progress.end()
+    throughput = counters["hashed_bytes"] / 1048576 / max(end_scan - start_scan, 1e-6)
+    LOGGER.info("Time taken for hashing = {}, total files = {}, hashed = {} bytes, throughput = {:.2f} MB/s, "
+                "unchanged stat = {} files".format(end_scan - start_scan, counters["scanned_files"],
+                                                   counters["hashed_bytes"], throughput, counters["hash_reused"]))
+    print("Hash reused for [{}] files with unchanged stat".format(counters["hash_reused"]))
+    print("Scan Time [{:.4f}]s, Hashing Throughput [{:.2f}] MB/s".format(end_scan - start_scan, throughput))
+    if test_regex:
+        print("Files Included")
+        import pprint
+        pprint.pprint(include_files)
+        print("Files Excluded")
+        pprint.pprint(exclude_files)
+    return manifest
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues, each stage run by its own worker threads. A stage blocks while the queue to
+    the next stage is full, so a slow stage holds back the stages before it instead of the items piling up in memory,
+    and the stages overlap: a file is uploaded while the next ones are compressed and hashed.
+    The items are dicts. An item having "error" or a true "skip" is passed on to the output without running the later
+    stages.
+    """
+    STOP = None
+
+    def __init__(self, stages, queue_size=8, finish=None):
+        """
+        :param stages: list of (name, function, workers). The function takes an item and returns it
+        :param queue_size: Number of items waiting in front of each stage. The output queue is not bounded, the
+                           items are collected by the thread putting them
+        :param finish: Called with each item by the last stage, as it's put to the output. Frees what the item holds
+                       without waiting for the thread putting the items to collect it
+        """
+        self.stages = stages
+        self.finish = finish
+        self.queues = [queue.Queue(queue_size) for _ in stages] + [queue.Queue()]
+        self.running = [workers for _, _, workers in stages]
+        self.busy = collections.Counter()
+        self.lock = threading.Lock()
+        for index, (name, function, workers) in enumerate(stages):
+            for i in range(workers):
+                threading.Thread(target=self.work, args=(index, name, function), name="{}-{}".format(name, i),
+                                 daemon=True).start()
+
+    def work(self, index, name, function):
+        """
+        Run the function of a stage on the items of its queue till STOP
+        :return:
+        """
+        source, sink = self.queues[index], self.queues[index + 1]
+        while True:
+            item = source.get()
+            if item is self.STOP:
+                with self.lock:
+                    self.running[index] -= 1
+                    last = not self.running[index]
+                # The last worker of the stage stops the next stage
+                if last:
+                    for _ in range(self.stages[index + 1][2] if index + 1 < len(self.stages) else 1):
+                        sink.put(self.STOP)
+                return
+            if "error" not in item and not item.get("skip"):
+                start = time.time()
+                try:
+                    item = function(item)
+                except (EncryptionError, OSError, ClientError, BotoCoreError) as e:
+                    item["error"] = "{} failed. {}".format(name, e)
+                except Exception as e:
+                    # Any error is kept in the item, a dying worker would block the stages before it
+                    LOGGER.exception("{} failed for {}".format(name, item.get("location")))
+                    item["error"] = "{} failed. {}".format(name, e)
+                with self.lock:
+                    self.busy[name] += time.time() - start
+            if self.finish and index == len(self.stages) - 1:
+                self.finish(item)
+            sink.put(item)
+
+    def put(self, item):
+        """
+        Add an item to the first stage, blocking while its queue is full
+        :param item: dict
+        :return:
+        """
+        self.queues[0].put(item)
+
+    def close(self):
+        """
+        No more items are added. The stages stop after processing the items already added
+        :return:
+        """
+        for _ in range(self.stages[0][2]):
+            self.queues[0].put(self.STOP)
+
+    def results(self, wait=False):
+        """
+        The items through all the stages
+        :param wait: If True, wait for all the items till the pipeline is stopped, else only the items done so far
+        :return: generator of items
+        """
+        output = self.queues[-1]
+        while True:
+            try:
+                item = output.get(block=wait)
+            except queue.Empty:
+                return
+            if item is self.STOP:
+                return
+            yield item
+
+
+def backup_stages(s3, base_path, bucket_name, s3_prefix_path, tmp_path=None, codec_policy=None, encryptor=None,
+                  streaming=False, workers=None, part_size=8388608, max_concurrency=10, compress_executor=None,
+                  parallel_threshold=None, block_size=8388608, read_ahead=8, hash_algorithm="sha1",
+                  content_md5=False, max_put_size=8388608, inventory=None, budget=None):
+    """
+    Stages of the pipeline backing up a file: hash, compress, encrypt and upload. With streaming, compress, encrypt
+    and upload are a single stage streaming to S3 without the tmp_path.
+    :param s3: s3_client. None doesn't upload
+    :param base_path: Used to create the prefix i.e., to reflect the local file structure
+    :param bucket_name: Name of the bucket
+    :param s3_prefix_path: Prefix to be used after bucket name
+    :param tmp_path: Each file gets its own directory in tmp_path for the compressed and encrypted files
+    :param codec_policy: CodecPolicy. None doesn't compress
+    :param encryptor: GpgEncryptor/AesGcmEncryptor. None doesn't encrypt
+    :param streaming: If True, use stream_upload
+    :param workers: dict of the number of workers of each stage, {"hash": .., "compress": .., "encrypt": ..,
+                    "upload": ..}
+    :param part_size: Size of each part of the streaming multipart upload
+    :param max_concurrency: Number of parts uploaded concurrently by a streaming upload
+    :param compress_executor: Process pool compressing the files of at least parallel_threshold bytes block wise
+    :param parallel_threshold: Size in bytes from which a file is compressed on the compress_executor
+    :param block_size: Size of the blocks compressed on the compress_executor
+    :param read_ahead: Number of blocks submitted ahead to the compress_executor
+    :param hash_algorithm: see hash_constructor
+    :param content_md5: If True, the md5 of the files uploaded as is is calculated while hashing and verified by S3
+    :param max_put_size: Size up to which the file is uploaded in a single put with the content md5
+    :param inventory: Inventory. If given, a changed file already present in S3 is marked reconciled and skipped
+    :param budget: ResourceBudget the hashing, compression and uploads of the stages hold their units of. The
+                   tmp_path bytes of each item are reserved by its first stage writing to the tmp_path, see
+                   pipeline_backup
+    :return: list of (name, function, workers)
+    """
+    workers = dict({"hash": 2, "compress": os.cpu_count(), "encrypt": 2, "upload": 8}, **(workers or dict()))
+    if budget:
+        workers.update(hash=budget.cap("hash_threads", workers["hash"]),
+                       compress=budget.cap("compress_processes", workers["compress"]),
+                       upload=budget.cap("upload_connections", workers["upload"]))
+
+    def reserve(item):
+        """
+        Reserve the tmp_path bytes of the compressed and the encrypted files of the item, once. The encrypt stage of a
+        file the compress stage left as is finds them reserved already
+        :return:
+        """
+        if budget and "reserved" not in item:
+            item["reserved"] = budget.reserve(item["size"] * ((codec_policy is not None) + (encryptor is not None)))
+
+    def hash_stage(item):
+        with budget.hold("hash_threads") if budget else contextlib.nullcontext():
+            if content_md5:
+                item["hash"], item["md5"] = checksum(item["location"], hash_algorithm, True)
+            else:
+                item["hash"] = checksum(item["location"], hash_algorithm)
+        item["skip"] = item["hash"] == item["old_hash"]
+        if not item["skip"] and inventory:
+            key = s3_key(base_path, s3_prefix_path, item["location"],
+                         item["location"] + object_suffix(item["location"], codec_policy, encryptor))
+            info = {"hash": item["hash"], "stat": item["stat"], "md5": item.get("md5")}
+            item["skip"] = item["reconciled"] = reconciled(s3, inventory, bucket_name, key, item["location"], info,
+                                                           item["last_modified"])
+        return item
+
+    def compress_stage(item):
+        reserve(item)
+        item["tmp_dir"] = tempfile.mkdtemp(dir=tmp_path)
+        item["tmp"] = compress(item["location"], item["tmp_dir"], compress_executor, parallel_threshold, block_size,
+                               read_ahead, *codec_policy.choose(item["location"]), budget=budget)
+        return item
+
+    def encrypt_stage(item):
+        if item.get("tmp"):
+            item["tmp"] = encrypt(item["tmp"], encryptor)
+        else:
+            reserve(item)
+            item["tmp_dir"] = item.get("tmp_dir") or tempfile.mkdtemp(dir=tmp_path)
+            item["tmp"] = encrypt(item["tmp_dir"], encryptor, item["location"],
+                                  codec_suffix("none", codec_policy is not None))
+        return item
+
+    def upload_stage(item):
+        if not upload(s3, base_path, bucket_name, s3_prefix_path, item["location"], item.get("tmp"),
+                      item["last_modified"], item.get("md5"), max_put_size, item["hash"],
+                      codec_suffix("none", codec_policy is not None)):
+            item["error"] = "Couldn't upload {}".format(item["location"])
+        return item
+
+    def stream_stage(item):
+        codec, level = codec_policy.choose(item["location"]) if codec_policy else ("none", None)
+        if not stream_upload(s3, base_path, bucket_name, s3_prefix_path, item["location"], item["last_modified"],
+                             codec, level, encryptor, part_size, max_concurrency, compress_executor,
+                             parallel_threshold, block_size, item["hash"], codec_policy is not None, budget):
+            item["error"] = "Couldn't upload {}".format(item["location"])
+        return item
+
+    stages = [("hash", hash_stage, workers["hash"])]
+    if streaming:
+        stages.append(("upload", stream_stage, workers["upload"]))
+        return stages
+    if codec_policy:
+        stages.append(("compress", compress_stage, workers["compress"]))
+    if encryptor:
+        stages.append(("encrypt", encrypt_stage, workers["encrypt"]))
+    if s3:
+        stages.append(("upload", upload_stage, workers["upload"]))
+    return stages
+
+
+def pipeline_backup(manifest, base_path, include, exclude, stages, consider_older=0, paranoid=False, queue_size=8,
+                    journal=None, walk_workers=0, progress=None, budget=None):
+    """
+    Walk base_path and run the changed files through the stages, while the walk goes on. Replaces scan, compare and
+    the backup loop of main, which run one after the other. The manifest is only used from the calling thread: the
+    stat of each file is checked against the last run here, the files with a changed stat are hashed by the pipeline
+    and those with a changed hash go through the remaining stages. Each file backed up is committed to the manifest
+    as it comes out of the pipeline, the files left pending by an interrupted or failed run are backed up again.
+    :param manifest: Manifest having the file information of the last run
+    :param base_path:
+    :param include: Regex compiled object to search for matching file to include
+    :param exclude: Regex compiled object to search for matching file to exclude
+    :param stages: list of (name, function, workers), see backup_stages
+    :param consider_older: Consider files older than these days
+    :param paranoid: If True, ignore the stat of the last run and hash every file
+    :param queue_size: Number of items waiting in front of each stage
+    :param journal: Journal of the watcher. Only the paths having events are walked, unless the journal has a gap
+    :param walk_workers: Number of threads listing the directories in parallel. 0 lists them serially
+    :param progress: Progress the files are counted in, and the busy time of the stages is added to
+    :param budget: ResourceBudget the tmp_path bytes reserved by the stages are released to
+    :return: list of the changed locations backed up
+    """
+    start = time.time()
+    print("{}".format("".join(["-"] * 75)))
+    print("Backing up files in {} through the stages {}".format(base_path, [name for name, _, _ in stages]))
+    LOGGER.info("Backing up files in {} through the stages {}".format(base_path, [name for name, _, _ in stages]))
+    delta = datetime.now().date() - timedelta(consider_older)
+
+    def finish(item):
+        """
+        Remove the tmp_path files of the item as it comes out of the pipeline
+        :return:
+        """
+        if item.get("tmp_dir"):
+            shutil.rmtree(item["tmp_dir"], ignore_errors=True)
+        if budget:
+            budget.release(item.pop("reserved", 0))
+
+    pipeline = Pipeline(stages, queue_size, finish)
+    if progress is None:
+        progress = Progress()
+    progress.template = "Scanned [{files}] files, Queued [{queued}], Backed up [{backed_up}], Failed [{failed}]"
+    counts = progress.counters
+    backed_up = list()
+
+    def collect(items):
+        """
+        Record the items through the pipeline in the manifest
+        :param items:
+        :return:
+        """
+        for item in items:
+            if "hash" in item:
+                manifest.record(item["location"], {"hash": item["hash"], "stat": item["stat"], "md5": item.get("md5")})
+            if "error" in item:
+                counts["failed"] += 1
+                LOGGER.error(item["error"])
+                print("\n" + item["error"])
+                # Kept for the next run, which walks only the paths having events
+                if journal:
+                    journal.defer(item["location"])
+            elif item.get("reconciled"):
+                manifest.commit(item["location"])
+                counts["reconciled"] += 1
+                backed_up.append(item["location"])
+            elif item["skip"]:
+                counts["unchanged"] += 1
+            else:
+                manifest.commit(item["location"])
+                counts["backed_up"] += 1
+                backed_up.append(item["location"])
+
+    try:
+        for root, included_files, excluded_files in walk(base_path, manifest, journal, file_filter(include, exclude),
+                                                         walk_workers):
+            counts["files"] += len(included_files) + len(excluded_files)
+            for file, stat in included_files:
+                location = os.path.join(root, file)
+                m_time = datetime.fromtimestamp(stat.st_mtime).date()
+                if m_time >= delta:
+                    LOGGER.info("Ignored [{}] as it's modified date is within the ignore range. m_time=[{}]".format(
+                        location, m_time))
+                    if journal:
+                        journal.defer(location)
+                    continue
+                key = stat_key(stat)
+                old = manifest.previous(location)
+                if old and not paranoid and old.get("stat") == key and not old.get("pending"):
+                    manifest.record(location, {"hash": old["hash"], "stat": key, "md5": old.get("md5")})
+                    counts["reused"] += 1
+                    continue
+                counts["queued"] += 1
+                pipeline.put({"location": location, "stat": key, "size": stat.st_size,
+                              "old_hash": old["hash"] if old and not old.get("pending") else None,
+                              "last_modified": m_time.isoformat()})
+                collect(pipeline.results())
+                progress.draw()
+    finally:
+        pipeline.close()
+        collect(pipeline.results(wait=True))
+    manifest.end_scan()
+    elapsed = time.time() - start
+    progress.end()
+    progress.timers.update({name + "_busy": busy for name, busy in pipeline.busy.items()})
+    print("Hash reused for [{}] files with unchanged stat, [{}] files hashed unchanged".format(counts["reused"],
+                                                                                          counts["unchanged"]))
+    if counts["reconciled"]:
+        print("Reconciled [{}] changed files already present in S3".format(counts["reconciled"]))
+    print("Pipeline Time [{:.4f}]s, Busy Time of the stages {}".format(
+        elapsed, {name: round(busy, 4) for name, busy in pipeline.busy.items()}))
+    LOGGER.info("Pipeline time = {}, counts = {}, busy time of the stages = {}".format(elapsed, dict(counts),
+                                                                                     dict(pipeline.busy)))
+    return backed_up
+
+
+def metadata_path(base_path, meta_file_name=None, extension=".pkl"):
+    """
+    Path of the metadata (file information of the last run) for the base_path
+    :param base_path: string
+    :param meta_file_name: Name of the metadata file. By default, the last directory of base_path
+    :param extension: ".pkl" for the pickle manifest, ".db" for the sqlite manifest
+    :return: string
+    """
+    if meta_file_name:
+        return os.path.join(os.getcwd(), "data/" + meta_file_name + extension)
+    return os.path.join(os.getcwd(), "data/" + base_path[base_path.rindex("/") + 1:] + extension)
+
+
+def load_metadata(pickle_path):
+    """
+    Load the file information dict cached by the last run
+    :param pickle_path: string
+    :return: dict/None if the metadata is not present
+    """
+    try:
+        with open(pickle_path, "rb") as pickle_in:
+            return pickle.load(pickle_in)
+    except FileNotFoundError:
+        return None
+
+
+def dump_metadata(metadata, pickle_path):
+    """
+    Pickle the metadata, replacing pickle_path atomically
+    :param metadata:
+    :param pickle_path: string
+    :return:
+    """
+    tmp_pickle_path = pickle_path + ".tmp"
+    with open(tmp_pickle_path, "wb") as pickle_out:
+        pickle.dump(metadata, pickle_out)
+        pickle_out.flush()
+        os.fsync(pickle_out.fileno())
+    os.replace(tmp_pickle_path, pickle_path)
+
+
+class DirectoryRecords:
+    """
+    The files of a directory of FileTable. The files are found by an open addressing table of their positions in the
+    arrays of FileTable by the hash of their names, and once the table is packed are one after another, ordered by
+    name. The device, the same for all the files of a directory but a mount point, is kept once.
+    """
+    __slots__ = ("index", "start", "end", "count", "dev", "devs", "extras", "removed")
+
+    def __init__(self, start=0, end=0):
+        """
+        :param start: First position of the files of the directory, packed
+        :param end: Position after the last file
+        """
+        # position + 1 of the files by the hash of their name, 0 for a free slot. Built when first needed
+        self.index = None
+        # None once a file is added after the table was packed
+        self.start, self.end = start, end
+        self.count = end - start
+        self.dev = None
+        # {position: device} of the files on another device
+        self.devs = None
+        # {name: dict} of the fields not fitting the arrays, like the recipe of a deduplicated file
+        self.extras = None
+        # Positions of the files removed, left in the arrays till the table is packed
+        self.removed = None
+
+
+class FileTable(collections.abc.MutableMapping):
+    """
+    Compact {location: {"hash": .., "stat": .., "md5": ..}} of PickleManifest. The file names are packed one after
+    another in a bytearray, each followed by a NUL which no file name has, and the binary digest, size, mtime and inode
+    of each file in a fixed size record of another, instead of a dict, a hex string and a tuple of ints per file. The
+    arrays are shared by all the directories, so that they grow the same whatever the order the files are written in
+    and however many directories they are spread over. A file is written and found through the hash table of its
+    directory, see DirectoryRecords. Reading a location builds its dict, so changing that dict doesn't change the table,
+    the location has to be set again.
+    All the digests share the algorithm prefix and length of the first hash recorded, any other hash is kept as is
+    with the other fields not fitting the records.
+    """
+    FORMAT = "file_table_2"
+
+    def __init__(self, items=None):
+        """
+        :param items: dict or iterable of (location, info) to add
+        """
+        self.dirs = dict()
+        self.count = 0
+        self.prefix = None
+        self.width = None
+        # digest, size, mtime and inode of a file
+        self.layout = None
+        self.blob = bytearray()
+        # Offset of each name in blob, followed by the length of blob
+        self.offsets = array.array("I", [0])
+        self.records = bytearray()
+        # 16 bytes per file once a md5 is recorded, zeros for no md5
+        self.md5s = None
+        # Files removed, left in the arrays till the table is packed
+        self.garbage = 0
+        # True while the files of each directory are one after another, ordered by name, and nothing is removed
+        self.packed = True
+        if items:
+            self.update(items)
+
+    @classmethod
+    def load(cls, data):
+        """
+        :param data: Loaded from the pickle file, a dict of older runs or the state of dump
+        :return: FileTable
+        """
+        if isinstance(data, cls):
+            return data
+        if not isinstance(data, tuple) or data[0] not in (cls.FORMAT, "file_table"):
+            return cls(data)
+        table = cls()
+        if data[0] == "file_table":
+            # An array per field per directory, written by the earlier versions
+            _, prefix, width, directories = data
+            table.set_width(prefix, width)
+            for directory, (blob, offsets, digests, sizes, mtimes, inos, devs, md5s, extras) in directories:
+                for position in range(len(offsets) - 1):
+                    name = blob[offsets[position]:offsets[position + 1]].decode("utf-8", "surrogateescape")
+                    info = {"hash": prefix + digests[position * width:(position + 1) * width].hex(),
+                            "stat": (sizes[position], mtimes[position], inos[position], devs[position])}
+                    md5 = md5s[position * 16:(position + 1) * 16] if md5s else None
+                    if md5 and any(md5):
+                        info["md5"] = base64.b64encode(md5).decode()
+                    info.update((extras or dict()).get(name) or dict())
+                    table[directory + "/" + name] = info
+            return table
+        _, prefix, width, table.blob, table.offsets, table.records, table.md5s, directories = data
+        table.set_width(prefix, width)
+        for directory, (start, end, dev, devs, extras) in directories:
+            records = table.dirs[directory] = DirectoryRecords(start, end)
+            records.dev, records.devs, records.extras = dev, devs, extras
+            table.count += records.count
+        return table
+
+    def dump(self):
+        """
+        :return: State of the table as built-in types, so that the pickle file can be read without this class
+        """
+        self.pack()
+        return (self.FORMAT, self.prefix, self.width, self.blob, self.offsets, self.records, self.md5s,
+                [(directory, (records.start, records.end, records.dev, records.devs, records.extras))
+                 for directory, records in self.dirs.items()])
+
+    def copy(self):
+        return FileTable.load(pickle.loads(pickle.dumps(self.dump(), pickle.HIGHEST_PROTOCOL)))
+
+    def set_width(self, prefix, width):
+        """
+        :param prefix: Algorithm prefix of the digests, see hash_prefix
+        :param width: Length of the digests
+        :return:
+        """
+        self.prefix, self.width = prefix, width
+        if width is not None:
+            self.layout = struct.Struct("<{}sqqQ".format(width))
+
+    def encode_hash(self, value):
+        """
+        :param value: "<algorithm>:<hex digest>" or a sha1 hex digest
+        :return: digest bytes, None if it doesn't fit the digests of the table
+        """
+        head, separator, hexdigest = value.rpartition(":")
+        if self.prefix is None:
+            self.set_width(head + separator, len(hexdigest) // 2)
+        if head + separator != self.prefix or len(hexdigest) != self.width * 2:
+            return None
+        try:
+            return bytes.fromhex(hexdigest)
+        except ValueError:
+            return None
+
+    def name(self, position):
+        """
+        :param position:
+        :return: utf-8 encoded name of the file at position
+        """
+        return bytes(self.blob[self.offsets[position]:self.offsets[position + 1] - 1])
+
+    def positions(self, records):
+        """
+        :param records: DirectoryRecords of the table
+        :return: list of the positions of the files of the directory
+        """
+        if records.start is not None:
+            positions = range(records.start, records.end)
+        else:
+            positions = [position - 1 for position in records.index if position]
+        if records.removed:
+            return [position for position in positions if position not in records.removed]
+        return list(positions)
+
+    def build_index(self, records):
+        """
+        Index the files of the directory, leaving the table at most 4/5 full with one more file
+        :param records: DirectoryRecords of the table
+        :return:
+        """
+        capacity = 8
+        while capacity * 4 < (records.count + len(records.removed or ()) + 1) * 5:
+            capacity *= 2
+        index = array.array("I", bytes(capacity * 4))
+        mask = capacity - 1
+        for position in self.positions(records):
+            slot = hash(self.name(position)) & mask
+            while index[slot]:
+                slot = (slot + 1) & mask
+            index[slot] = position + 1
+        records.index = index
+
+    def find(self, records, key):
+        """
+        :param records: DirectoryRecords of the table
+        :param key: utf-8 encoded name
+        :return: Position of the file, None if not in the directory
+        """
+        if records.index is None:
+            self.build_index(records)
+        index, blob, offsets, removed = records.index, self.blob, self.offsets, records.removed
+        mask = len(index) - 1
+        slot = hash(key) & mask
+        while True:
+            position = index[slot]
+            if not position:
+                return None
+            position -= 1
+            # A file removed and written again is found after its removed place
+            if blob[offsets[position]:offsets[position + 1] - 1] == key and not (removed and position in removed):
+                return position
+            slot = (slot + 1) & mask
+
+    def append(self, records, key, record, dev, md5=None):
+        """
+        Add a file after the others
+        :param records: DirectoryRecords of the directory of the file
+        :param key: utf-8 encoded name
+        :param record: Packed digest, size, mtime and inode
+        :param dev: Device
+        :param md5: 16 bytes. None for no md5
+        :return:
+        """
+        if records.index is None or (records.count + len(records.removed or ()) + 1) * 5 > len(records.index) * 4:
+            self.build_index(records)
+        position = len(self.offsets) - 1
+        self.blob += key
+        self.blob.append(0)
+        if self.offsets.typecode == "I" and len(self.blob) > 0xFFFFFFFF:
+            self.offsets = array.array("Q", self.offsets)
+        self.offsets.append(len(self.blob))
+        self.records += record
+        if md5 and self.md5s is None:
+            self.md5s = bytearray(16 * position)
+        if self.md5s is not None:
+            self.md5s += md5 or bytes(16)
+        self.packed = False
+        records.start = records.end = None
+        if not records.count:
+            records.dev = dev
+        elif dev != records.dev:
+            if records.devs is None:
+                records.devs = dict()
+            records.devs[position] = dev
+        records.count += 1
+        index = records.index
+        mask = len(index) - 1
+        slot = hash(key) & mask
+        while index[slot]:
+            slot = (slot + 1) & mask
+        index[slot] = position + 1
+
+    def write(self, records, position, record, dev, md5=None):
+        """
+        Replace the information of the file at position
+        :return:
+        """
+        self.records[position * len(record):(position + 1) * len(record)] = record
+        if dev != records.dev:
+            if records.devs is None:
+                records.devs = dict()
+            records.devs[position] = dev
+        elif records.devs:
+            records.devs.pop(position, None)
+        if md5 and self.md5s is None:
+            self.md5s = bytearray(16 * (len(self.offsets) - 1))
+        if self.md5s is not None:
+            self.md5s[position * 16:(position + 1) * 16] = md5 or bytes(16)
+
+    def pack(self):
+        """
+        Rewrite the arrays with the files of each directory one after another, ordered by name, dropping the files
+        removed
+        :return:
+        """
+        if self.packed:
+            return
+        size = self.layout.size
+        blob, offsets, records = bytearray(), array.array("Q", [0]), bytearray()
+        md5s = bytearray() if self.md5s is not None else None
+        indexed = []
+        for directory in sorted(self.dirs, key=lambda directory: directory + "/"):
+            directory_records = self.dirs[directory]
+            names = {position: self.name(position) for position in self.positions(directory_records)}
+            order = sorted(names, key=names.__getitem__)
+            start, base = len(offsets) - 1, len(blob)
+            blob += b"".join([names[position] + b"\0" for position in order])
+            offsets.extend([base + offset for offset in itertools.accumulate([len(names[position]) + 1
+                                                                              for position in order])])
+            records += b"".join([self.records[position * size:(position + 1) * size] for position in order])
+            if md5s is not None:
+                md5s += b"".join([self.md5s[position * 16:(position + 1) * 16] for position in order])
+            if directory_records.devs:
+                devs = directory_records.devs
+                directory_records.devs = {start + i: devs[position] for i, position in enumerate(order)
+                                          if position in devs} or None
+            directory_records.start, directory_records.end = start, start + len(order)
+            directory_records.removed = None
+            if directory_records.index is not None:
+                indexed.append(directory_records)
+        self.blob, self.records, self.md5s = blob, records, md5s
+        self.offsets = array.array("I", offsets) if len(blob) <= 0xFFFFFFFF else offsets
+        for directory_records in indexed:
+            self.build_index(directory_records)
+        self.garbage = 0
+        self.packed = True
+
+    def get(self, location, default=None):
+        directory, _, name = location.rpartition("/")
+        records = self.dirs.get(directory)
+        if records is None:
+            return default
+        position = self.find(records, name.encode("utf-8", "surrogateescape"))
+        if position is None:
+            return default
+        digest, size, mtime, ino = self.layout.unpack_from(self.records, position * self.layout.size)
+        info = {"hash": self.prefix + digest.hex(),
+                "stat": (size, mtime, ino, records.devs.get(position, records.dev) if records.devs else records.dev)}
+        if self.md5s is not None:
+            md5 = self.md5s[position * 16:(position + 1) * 16]
+            if any(md5):
+                info["md5"] = base64.b64encode(md5).decode()
+        if records.extras:
+            extra = records.extras.get(name)
+            if extra:
+                info.update(extra)
+        return info
+
+    def __getitem__(self, location):
+        info = self.get(location)
+        if info is None:
+            raise KeyError(location)
+        return info
+
+    def __setitem__(self, location, info):
+        directory, _, name = location.rpartition("/")
+        records = self.dirs.get(directory)
+        if records is None:
+            records = self.dirs[directory] = DirectoryRecords()
+        digest = self.encode_hash(info["hash"])
+        extra = {key: value for key, value in info.items() if key not in ("hash", "stat", "md5")}
+        if digest is None:
+            digest, extra["hash"] = bytes(self.width), info["hash"]
+        stat = info.get("stat")
+        if stat is None:
+            stat, extra["stat"] = (0, 0, 0, 0), None
+        md5 = base64.b64decode(info["md5"]) if info.get("md5") else None
+        record = self.layout.pack(digest, stat[0], stat[1], stat[2])
+        key = name.encode("utf-8", "surrogateescape")
+        position = self.find(records, key)
+        if position is None:
+            self.append(records, key, record, stat[3], md5)
+            self.count += 1
+        else:
+            self.write(records, position, record, stat[3], md5)
+        if extra:
+            if records.extras is None:
+                records.extras = dict()
+            records.extras[name] = extra
+        elif records.extras:
+            records.extras.pop(name, None)
+
+    def __delitem__(self, location):
+        directory, _, name = location.rpartition("/")
+        records = self.dirs.get(directory)
+        position = self.find(records, name.encode("utf-8", "surrogateescape")) if records is not None else None
+        if position is None:
+            raise KeyError(location)
+        if records.removed is None:
+            records.removed = set()
+        records.removed.add(position)
+        records.count -= 1
+        if records.extras:
+            records.extras.pop(name, None)
+        if not records.count:
+            del self.dirs[directory]
+        self.remove_garbage(1)
+
+    def remove_garbage(self, count):
+        """
+        Count the files removed, packing the table once they are more than the files left
+        :param count: Files removed
+        :return:
+        """
+        self.count -= count
+        self.garbage += count
+        self.packed = False
+        if self.garbage > self.count:
+            self.pack()
+
+    def __contains__(self, location):
+        directory, _, name = location.rpartition("/")
+        records = self.dirs.get(directory)
+        return records is not None and self.find(records, name.encode("utf-8", "surrogateescape")) is not None
+
+    def __iter__(self):
+        for directory, records in list(self.dirs.items()):
+            for position in self.positions(records):
+                yield directory + "/" + self.name(position).decode("utf-8", "surrogateescape")
+
+    def __len__(self):
+        return self.count
+
+    def remove_tree(self, location):
+        """
+        Remove location and the locations below it
+        :param location:
+        :return:
+        """
+        self.pop(location, None)
+        removed = [directory for directory in self.dirs
+                   if directory == location or directory.startswith(location + "/")]
+        if removed:
+            self.remove_garbage(sum(self.dirs.pop(directory).count for directory in removed))
+
+    def hash_at(self, records, position):
+        """
+        :param records: DirectoryRecords of the table
+        :param position:
+        :return: Hash of the file at position
+        """
+        if records.extras:
+            extra = records.extras.get(self.name(position).decode("utf-8", "surrogateescape"))
+            if extra and "hash" in extra:
+                return extra["hash"]
+        start = position * self.layout.size
+        return self.prefix + self.records[start:start + self.width].hex()
+
+    def changed_since(self, old):
+        """
+        The locations whose hash differs from old, including the locations not in old. The directories are taken in
+        the order of their path, so that the locations below a directory come one after another, and the names of
+        each directory, ordered by pack, are merge joined with those of old. A directory whose names and records are
+        the same in both is skipped without looking at its files.
+        :param old: FileTable
+        :return: generator of location
+        """
+        self.pack()
+        old.pack()
+        same_format = (self.prefix, self.width) == (old.prefix, old.width)
+        for directory in sorted(self.dirs, key=lambda directory: directory + "/"):
+            records, old_records = self.dirs.get(directory), old.dirs.get(directory)
+            if records is None:
+                continue
+            blob = bytes(self.blob[self.offsets[records.start]:self.offsets[records.end]])
+            if old_records is None:
+                for name in blob.split(b"\0")[:-1]:
+                    yield directory + "/" + name.decode("utf-8", "surrogateescape")
+                continue
+            old_blob = bytes(old.blob[old.offsets[old_records.start]:old.offsets[old_records.end]])
+            # The digests of the hashes kept in extras are zeros
+            regular = not any("hash" in extra for table in (records, old_records)
+                              for extra in (table.extras or dict()).values())
+            if same_format and regular and blob == old_blob and \
+                    self.records[records.start * self.layout.size:records.end * self.layout.size] == \
+                    old.records[old_records.start * old.layout.size:old_records.end * old.layout.size]:
+                continue
+            names, old_names = blob.split(b"\0")[:-1], old_blob.split(b"\0")[:-1]
+            j = 0
+            for i, name in enumerate(names):
+                while j < len(old_names) and old_names[j] < name:
+                    j += 1
+                if j < len(old_names) and old_names[j] == name and \
+                        self.hash_at(records, records.start + i) == old.hash_at(old_records, old_records.start + j):
+                    continue
+                yield directory + "/" + name.decode("utf-8", "surrogateescape")
+
+
+class PickleManifest:
+    """
+    File information of the last run and of this run as FileTables of {location: {"hash": .., "stat": ..}}, cached in
+    a pickle file. Both are held in memory, prefer SqliteManifest for large trees.
+    The locations backed up are appended to a commit log next to the pickle file as they complete, and replayed into
+    the last run if the run was interrupted before save.
+    """
+
+    def __init__(self, pickle_path):
+        """
+        :param pickle_path: Pickle file having the file information of the last run. None keeps it only in memory
+        """
+        self.pickle_path = pickle_path
+        old = load_metadata(pickle_path) if pickle_path else None
+        self.old = FileTable.load(old) if old is not None else None
+        self.new = FileTable()
+        self.committed = set()
+        self.log = None
+        # Chunks stored by the dedup mode, {digest: (name, size)}
+        self.chunks = (load_metadata(pickle_path + ".chunks") if pickle_path else None) or dict()
+        if pickle_path:
+            self.replay(pickle_path + ".log")
+
+    def replay(self, log_path):
+        """
+        Apply the commit log of an interrupted run to the last run, so that its committed locations aren't backed up
+        again
+        :param log_path:
+        :return: Number of locations replayed
+        """
+        try:
+            with open(log_path) as log:
+                lines = log.readlines()
+        except FileNotFoundError:
+            return 0
+        if self.old is None:
+            self.old = FileTable()
+        count = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                # The last line is torn if the run died while writing it
+                continue
+            info = entry["info"]
+            if info.get("stat"):
+                info["stat"] = tuple(info["stat"])
+            self.old[entry["path"]] = info
+            count += 1
+        LOGGER.info("Replayed [{}] committed locations from {}".format(count, log_path))
+        return count
+
+    def begin_scan(self, partial=False):
+        """
+        :param partial: If True, only the changed paths are scanned and the others are kept from the last run
+        :return:
+        """
+        self.new = self.old.copy() if partial and self.old else FileTable()
+
+    def end_scan(self):
+        pass
+
+    def current(self, location):
+        """
+        :param location:
+        :return: dict having the hash and stat of location found by this scan, None if not present
+        """
+        return self.new.get(location)
+
+    def forget(self, location):
+        """
+        Remove a deleted location, or everything below it if it was a directory
+        :param location:
+        :return:
+        """
+        self.new.remove_tree(location)
+
+    def previous(self, location):
+        """
+        :param location:
+        :return: dict having the hash and stat of location in the last run, None if not present
+        """
+        return self.old.get(location) if self.old else None
+
+    def record(self, location, info):
+        """
+        Record the file information of location found in this scan. The annotations of the last run are kept if the
+        hash didn't change
+        :param location:
+        :param info: dict having the hash and stat
+        :return:
+        """
+        old = self.old.get(location) if self.old else None
+        if old and old["hash"] == info["hash"]:
+            info = dict(old, **info)
+        self.new[location] = info
+
+    def annotate(self, location, **fields):
+        """
+        Store more information about the backup of location, like the recipe of a deduplicated file
+        :param location:
+        :param fields:
+        :return:
+        """
+        self.new[location] = dict(self.new[location], **fields)
+
+    def has_backups(self):
+        """
+        :return: False if no location was backed up, e.g. the pickle file was lost
+        """
+        return bool(self.old) or bool(self.committed)
+
+    def commit(self, location):
+        """
+        Mark location as backed up, appending it to the commit log
+        :param location:
+        :return:
+        """
+        self.committed.add(location)
+        if not self.pickle_path:
+            return
+        if self.log is None:
+            self.log = open(self.pickle_path + ".log", "a")
+        self.log.write(json.dumps({"path": location, "info": self.new[location]}) + "\n")
+        self.log.flush()
+
+    def chunk_name(self, digest):
+        """
+        :param digest: sha256 of the chunk
+        :return: Name of the chunk object if the chunk is stored, else None
+        """
+        chunk = self.chunks.get(digest)
+        return chunk[0] if chunk else None
+
+    def add_chunk(self, digest, name, size):
+        """
+        Record a chunk stored by the dedup mode
+        :param digest: sha256 of the chunk
+        :param name: Name of the chunk object below the chunk prefix
+        :param size: Size of the chunk before compression and encryption
+        :return:
+        """
+        self.chunks[digest] = (name, size)
+
+    def changed(self):
+        """
+        The locations whose hash changed since the last run, including the new locations, a directory after another
+        :return: generator of location
+        """
+        return self.new.changed_since(self.old if self.old is not None else FileTable())
+
+    def count_changed(self):
+        return sum(1 for _ in self.changed())
+
+    def save(self):
+        """
+        Cache the file information of this run, replacing the pickle file atomically. A changed location not
+        committed keeps its information of the last run, so that it is backed up again by the next run
+        :return:
+        """
+        old = self.old or dict()
+        saved = FileTable()
+        for key, info in self.new.items():
+            if key in self.committed or (key in old and old[key]["hash"] == info["hash"]):
+                saved[key] = info
+            elif key in old:
+                saved[key] = old[key]
+        dump_metadata(saved.dump(), self.pickle_path)
+        if self.chunks:
+            dump_metadata(self.chunks, self.pickle_path + ".chunks")
+        if self.log:
+            self.log.close()
+            self.log = None
+        clean_up(self.pickle_path + ".log")
+        self.old = saved
+        self.committed = set()
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+
+class SqliteManifest:
+    """
+    File information kept in a sqlite database in WAL mode, keyed by location. The scan upserts the rows as the files
+    are hashed and the changed locations are streamed by a query, so the memory used doesn't grow with the file count.
+    Each row has the hash backed up (hash) and the hash found by the last scan (new_hash). The hash is set as each
+    location is committed, so an interrupted run leaves the locations not backed up yet as changed for the next one.
+    """
+    BATCH_SIZE = 5000
+
+    def __init__(self, db_path, pickle_path=None):
+        """
+        :param db_path: sqlite database file
+        :param pickle_path: Pickle file of PickleManifest, imported once if the database doesn't exist yet
+        """
+        exists = os.path.exists(db_path)
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, hash TEXT, new_hash TEXT, "
+                                "size INTEGER, mtime_ns INTEGER, ino INTEGER, dev INTEGER, scan_id INTEGER, "
+                                "extra TEXT, md5 TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS chunks (digest TEXT PRIMARY KEY, name TEXT, "
+                                "size INTEGER)")
+        for column in ("extra", "md5"):
+            try:
+                self.connection.execute("ALTER TABLE files ADD COLUMN {} TEXT".format(column))
+            except sqlite3.OperationalError:
+                # Already present
+                pass
+        self.connection.commit()
+        self.scan_id = 0
+        self.partial = False
+        self.pending = list()
+        if not exists and pickle_path and os.path.exists(pickle_path):
+            self.import_pickle(pickle_path)
+
+    def import_pickle(self, pickle_path):
+        """
+        Import the file information cached by PickleManifest. The files without a stat key are hashed again in the
+        next scan
+        :param pickle_path:
+        :return: Number of locations imported
+        """
+        LOGGER.info("Importing metadata from {} into {}".format(pickle_path, self.db_path))
+        old = FileTable.load(load_metadata(pickle_path) or dict())
+        rows = ((key, info["hash"], info["hash"]) + tuple(info.get("stat") or (None, None, None, None))
+                for key, info in old.items())
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO files (path, hash, new_hash, size, mtime_ns, ino, dev, "
+                                        "scan_id) VALUES (?, ?, ?, ?, ?, ?, ?, 0)", rows)
+        return len(old)
+
+    def begin_scan(self, partial=False):
+        """
+        :param partial: If True, only the changed paths are scanned and the others are kept from the last run
+        :return:
+        """
+        self.scan_id = self.connection.execute("SELECT COALESCE(MAX(scan_id), 0) + 1 FROM files").fetchone()[0]
+        self.partial = partial
+
+    def end_scan(self):
+        """
+        Flush the pending rows and forget the locations not found by a full scan
+        :return:
+        """
+        self.flush()
+        if not self.partial:
+            with self.connection:
+                self.connection.execute("DELETE FROM files WHERE scan_id != ?", (self.scan_id,))
+
+    def forget(self, location):
+        # "0" follows "/", so the range has the paths below location
+        self.flush()
+        with self.connection:
+            self.connection.execute("DELETE FROM files WHERE path = ? OR (path > ? AND path < ?)",
+                                    (location, location + "/", location + "0"))
+
+    def previous(self, location):
+        row = self.connection.execute("SELECT new_hash, size, mtime_ns, ino, dev, md5, hash FROM files WHERE path = ?",
+                                      (location,)).fetchone()
+        if row is None:
+            return None
+        # pending: hashed by an earlier scan, but not backed up
+        return {"hash": row[0], "stat": tuple(row[1:5]), "md5": row[5], "pending": row[6] != row[0]}
+
+    def current(self, location):
+        self.flush()
+        return self.previous(location)
+
+    def record(self, location, info):
+        self.pending.append((location, info["hash"]) + tuple(info["stat"]) + (self.scan_id, info.get("md5")))
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany("INSERT INTO files (path, new_hash, size, mtime_ns, ino, dev, scan_id, md5) "
+                                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET "
+                                        "new_hash=excluded.new_hash, size=excluded.size, mtime_ns=excluded.mtime_ns, "
+                                        "ino=excluded.ino, dev=excluded.dev, scan_id=excluded.scan_id, "
+                                        "md5=excluded.md5", self.pending)
+        self.pending = list()
+
+    def annotate(self, location, **fields):
+        """
+        Store more information about the backup of location as json in the extra column
+        :param location:
+        :param fields:
+        :return:
+        """
+        self.flush()
+        row = self.connection.execute("SELECT extra FROM files WHERE path = ?", (location,)).fetchone()
+        extra = json.loads(row[0]) if row and row[0] else dict()
+        extra.update(fields)
+        with self.connection:
+            self.connection.execute("UPDATE files SET extra = ? WHERE path = ?", (json.dumps(extra), location))
+
+    def chunk_name(self, digest):
+        row = self.connection.execute("SELECT name FROM chunks WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def add_chunk(self, digest, name, size):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO chunks (digest, name, size) VALUES (?, ?, ?)",
+                                    (digest, name, size))
+
+    def changed(self):
+        """
+        The changed locations in the order of their path, read a page after another, so that the rows committed
+        meanwhile don't disturb the query
+        :return: generator of location
+        """
+        last = ""
+        while True:
+            rows = self.connection.execute("SELECT path FROM files WHERE (hash IS NULL OR hash != new_hash) AND "
+                                           "path > ? ORDER BY path LIMIT ?", (last, self.BATCH_SIZE)).fetchall()
+            for row in rows:
+                yield row[0]
+            if len(rows) < self.BATCH_SIZE:
+                return
+            last = rows[-1][0]
+
+    def count_changed(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files WHERE hash IS NULL OR hash != new_hash").fetchone()[0]
+
+    def has_backups(self):
+        """
+        :return: False if no location was backed up, e.g. the database was lost
+        """
+        return self.connection.execute("SELECT 1 FROM files WHERE hash IS NOT NULL LIMIT 1").fetchone() is not None
+
+    def commit(self, location):
+        """
+        Mark the hash of location found by this scan as backed up. Committed right away, so that it survives a crash
+        :param location:
+        :return:
+        """
+        self.flush()
+        with self.connection:
+            self.connection.execute("UPDATE files SET hash = new_hash WHERE path = ?", (location,))
+
+    def save(self):
+        """
+        Write the pending rows. The hashes are marked as backed up by commit, the changed locations not committed
+        stay changed for the next run
+        :return:
+        """
+        self.flush()
+
+    def close(self):
+        self.connection.close()
+
+
+def open_manifest(base_path, meta_file_name=None, backend="sqlite"):
+    """
+    Open the manifest having the file information of the last run
+    :param base_path: string
+    :param meta_file_name: Name of the metadata file. By default, the last directory of base_path
+    :param backend: "sqlite" or "pickle"
+    :return: SqliteManifest/PickleManifest
+    """
+    pickle_path = metadata_path(base_path, meta_file_name)
+    if backend == "pickle":
+        return PickleManifest(pickle_path)
+    return SqliteManifest(metadata_path(base_path, meta_file_name, ".db"), pickle_path)
+
+
+def archive_directory(directory, base_path, dir_level=None):
+    """
+    Directory archived with the files in directory, the directory dir_level levels below base_path. The files above
+    that level are archived with their own directory
+    :param directory: Directory of the file
+    :param base_path:
+    :param dir_level: int/None. None archives the whole base_path
+    :return: string
+    """
+    parts = directory[len(base_path):].strip("/").split("/") if directory != base_path else list()
+    level = dir_level or 0
+    if len(parts) < level:
+        return directory
+    return "/".join([base_path] + parts[:level])
+
+
+def archive_groups(locations, base_path, dir_level=None):
+    """
+    Group the changed locations by their archive directory. The locations below a directory come one after another,
+    so a group is complete as soon as a location outside its directory comes, and only the groups still open are held
+    in memory. The archive directory is computed once per directory of the locations.
+    :param locations: Changed locations, a directory after another
+    :param base_path:
+    :param dir_level: int/None
+    :return: generator of (archive directory, list of locations)
+    """
+    archive_dirs = dict()
+    groups = collections.OrderedDict()
+    for location in locations:
+        directory = location[:location.rindex("/")]
+        archive_dir = archive_dirs.get(directory)
+        if archive_dir is None:
+            archive_dir = archive_dirs[directory] = archive_directory(directory, base_path, dir_level)
+        for done in [group for group in groups if not location.startswith(group + "/")]:
+            yield done, groups.pop(done)
+        groups.setdefault(archive_dir, list()).append(location)
+    yield from groups.items()
+
+
+def compare(manifest, base_path, archive=False, dir_level=None):
+    """
+    Compare the file hashes generated today with the file hashes generated yesterday. Nothing is read till the
+    results are iterated, and a result can only be iterated once.
+    :param manifest: Manifest having the file information of today and of yesterday
+    :param base_path: string
+    :param archive: bool
+    :param dir_level: int/None
+    :return: iterator, iterator. Changed locations, (archive directory, changed locations in it) if archive else None
+    """
+    changed_dirs = archive_groups(manifest.changed(), base_path, dir_level) if archive else None
+    return manifest.changed(), changed_dirs
+
+
+def archive_members(archiver, directory, locations, tmp, codec_policy=None, encryptor=None, progress=None,
+                    executor=None, parallel_threshold=None, block_size=8388608, read_ahead=8, budget=None):
+    """
+    Compress and encrypt the locations of an archive directory one by one and add them to the archive. A location
+    that couldn't be encrypted is left out
+    :param archiver: TarFile opened for writing
+    :param directory: Archive directory of the locations
+    :param locations: Changed locations below directory
+    :param tmp: Directory of the compressed and encrypted files, removed once added
+    :param codec_policy: CodecPolicy. None doesn't compress
+    :param encryptor: GpgEncryptor/AesGcmEncryptor. None doesn't encrypt
+    :param progress: Progress
+    :param executor: Process pool of the block wise compression, see compress
+    :param parallel_threshold:
+    :param block_size:
+    :param read_ahead:
+    :param budget: ResourceBudget, see compress_stream
+    :return: list of the locations added
+    """
+    if progress is None:
+        progress = Progress(interval=None)
+    dir_name = directory[directory.rindex("/") + 1:]
+    members = list()
+    for location in locations:
+        t = None
+        try:
+            if codec_policy:
+                LOGGER.info("Compressing [{}/{}] {}".format(progress.counters["compressed"], progress.counters["changed"], location))
+                progress.draw("Compressing", location)
+                with progress.timer("compress"):
+                    t = compress(location, tmp, executor, parallel_threshold, block_size, read_ahead,
+                                 *codec_policy.choose(location), budget=budget)
+                progress.add("compressed", 1 if t else 0)
+            if encryptor:
+                LOGGER.info("Encrypting [{}/{}] {}".format(progress.counters["encrypted"], progress.counters["changed"], location))
+                # print('Encrypting ' + location)
+                progress.draw("Encrypting", location)
+                try:
+                    with progress.timer("encrypt"):
+                        if t:
+                            t = encrypt(t, encryptor)
+                        else:
+                            t = encrypt(tmp, encryptor, location, codec_suffix("none", codec_policy is not None))
+                except EncryptionError as e:
+                    LOGGER.error("Skipping {} from the archive. {}".format(location, e))
+                    print("\nCouldn't encrypt " + location)
+                    progress.add("failed")
+                    clean_up(t)
+                    continue
+                progress.add("encrypted")
+            arc_name = os.path.join(dir_name, location[len(directory) + 1:location.rindex("/")],
+                                    os.path.basename(t or location + codec_suffix("none", codec_policy is not None)))
+            with progress.timer("archive"):
+                if t:
+                    LOGGER.info("Adding {} to archive at location {}".format(t, arc_name))
+                    archiver.add(t, arcname=arc_name, recursive=False)
+                else:
+                    LOGGER.info("Adding {} to archive at location {}".format(location, arc_name))
+                    archiver.add(location, arcname=arc_name, recursive=False)
+        finally:
+            clean_up(t)
+        members.append(location)
+    return members
+
+
+def build_archive(directory, locations, archive_tmp_path, codec_policy=None, encryptor=None):
+    """
+    Build the archive of a directory in archive_tmp_path, its members compressed and encrypted in archive_tmp_path
+    too. Runs in a process of parallel_archives, compressing every member on a single core
+    :param directory: Archive directory
+    :param locations: Changed locations below directory
+    :param archive_tmp_path: Directory of this archive alone in the tmp_path
+    :param codec_policy: CodecPolicy. None doesn't compress
+    :param encryptor: GpgEncryptor/AesGcmEncryptor. None doesn't encrypt
+    :return: path of the archive, list of the locations added, counters, timers
+    """
+    progress = Progress(interval=None)
+    progress.counters["changed"] = len(locations)
+    archive_path = os.path.join(archive_tmp_path, directory[directory.rindex("/") + 1:] + ".tar.gz")
+    LOGGER.info("Creating Archive at {}".format(archive_path))
+    with tarfile.open(archive_path, "w:gz") as archiver:
+        members = archive_members(archiver, directory, locations, archive_tmp_path, codec_policy, encryptor,
+                                  progress)
+    del progress.counters["changed"]
+    return archive_path, members, progress.counters, progress.timers
+
+
+def parallel_archives(changed_dirs, tmp_path, workers, codec_policy=None, encryptor=None, budget=None,
+                      progress=None, intermediates=0):
+    """
+    Build the archives of the changed directories concurrently on a process pool. A directory is submitted once the
+    tmp_path bytes of its archive are reserved in the budget, and the archives are yielded as soon as they are built,
+    so they are uploaded while the next ones are being built
+    :param changed_dirs: iterator of (archive directory, changed locations in it)
+    :param tmp_path: Each archive is built in its own directory below tmp_path
+    :param workers: Number of archives built at once
+    :param codec_policy: CodecPolicy. None doesn't compress
+    :param encryptor: GpgEncryptor/AesGcmEncryptor. None doesn't encrypt
+    :param budget: ResourceBudget of the tmp_path bytes. The bytes of a yielded archive are to be released by the
+                   caller. Each archive being built holds one of its compress_processes
+    :param progress: Progress, the counters and timers of the processes are added to it
+    :param intermediates: Number of intermediate files of each location, see tmp_size
+    :return: generator of (archive directory, locations, (archive tmp path, archive path, locations added, reserved))
+    """
+    if budget is None:
+        budget = ResourceBudget()
+    if progress is None:
+        progress = Progress(interval=None)
+    pending = dict()
+
+    def finished(futures):
+        for future in futures:
+            directory, locations, archive_tmp_path, reserved = pending.pop(future)
+            try:
+                archive_path, members, counters, timers = future.result()
+            except (OSError, EncryptionError, tarfile.TarError, ValueError) as e:
+                LOGGER.error("Couldn't archive {}. {}".format(directory, e))
+                print("\nCouldn't archive " + directory)
+                progress.add("failed")
+                shutil.rmtree(archive_tmp_path, ignore_errors=True)
+                budget.release(reserved)
+                continue
+            progress.counters.update(counters)
+            progress.timers.update(timers)
+            yield directory, locations, (archive_tmp_path, archive_path, members, reserved)
+
+    with budget.gate("compress_processes", process_pool(workers)) as executor:
+        try:
+            for directory, locations in changed_dirs:
+                size = tmp_size(locations, intermediates, True)
+                # Only block on the budget with nothing building, else the archives built would hold it
+                reserved = budget.reserve(size, blocking=not pending)
+                while reserved is None or len(pending) >= workers * 2:
+                    yield from finished(wait(pending, return_when=FIRST_COMPLETED).done)
+                    if reserved is None:
+                        reserved = budget.reserve(size, blocking=not pending)
+                archive_tmp_path = tempfile.mkdtemp(dir=tmp_path)
+                future = executor.submit(build_archive, directory, locations, archive_tmp_path, codec_policy,
+                                         encryptor)
+                pending[future] = (directory, locations, archive_tmp_path, reserved)
+                yield from finished([future for future in pending if future.done()])
+            while pending:
+                yield from finished(wait(pending, return_when=FIRST_COMPLETED).done)
+        finally:
+            # Left by an error or by the caller stopping early
+            for future, (_, _, archive_tmp_path, reserved) in list(pending.items()):
+                future.cancel()
+                try:
+                    future.result()
+                except BaseException:
+                    pass
+                shutil.rmtree(archive_tmp_path, ignore_errors=True)
+                budget.release(reserved)
+
+
+def clean_up(t):
+    """
+    Removes the location l. Similar to rm -f t
+    :param t: location
+    :return:
+    """
+    if t and os.path.exists(t):
+        os.remove(t)
+
+
+def clean_up_empty_directories(base_path):
+    command = "find {}/ -type d -empty -delete".format(base_path)
+    LOGGER.info("Deleting Empty Directories below {}".format(base_path))
+    if os.WEXITSTATUS(os.system(command)):
+        os.system(command)
+
+
+def fetch_optional_config(config, key, default):
+    """
+    Fetch the value of key in config file if present, else return default value
+    :param config: dict
+    :param key: string
+    :param default: bool/ None/ int as required
+    :return: value of key in config
+    """
+    try:
+        return config[key]
+    except KeyError:
+        return default
+
+
+def backup_entry(a_config, budget=None):
+    """
+    Back up the base_path of a config entry
+    :param a_config: Entry of backup_config.json
+    :param budget: ResourceBudget shared with the entries backed up concurrently
+    :return:
+    """
+    if budget is None:
+        budget = ResourceBudget()
+    # The tmp_path bytes of an entry backed up alone, when not limited for all the entries
+    if budget.tmp_bytes is None and fetch_optional_config(a_config, "tmp_bytes", default=None):
+        budget = budget.entry_budget(a_config["tmp_bytes"])
+    # Required Configurations
+    base_path = a_config["base_path"].rstrip("/")
+    bucket_name = a_config["bucket_name"]
+    s3_prefix_path = a_config['s3_prefix_path'].rstrip("/")
+    do_compress = a_config["compress"]
+    do_encrypt = a_config["encrypt"]
+    s3_upload = a_config["s3_upload"]
+    aws_profile = a_config["aws_profile"]
+
+    # Optional Configurations
+    tmp_path = fetch_optional_config(a_config, "tmp_path", default=None)
+    gpg_id = fetch_optional_config(a_config, "gpg_id", default=None)
+    encryption = fetch_optional_config(a_config, "encryption", default="gpg")
+    encryption_key_file = fetch_optional_config(a_config, "encryption_key_file", default=None)
+    encrypt_retries = fetch_optional_config(a_config, "encrypt_retries", default=1)
+    consider_older = fetch_optional_config(a_config, "consider_older", default=0)
+    test_regex = fetch_optional_config(a_config, "test_regex", default=False)
+    ignore_case = fetch_optional_config(a_config, "ignore_case", default=False)
+    include = fetch_optional_config(a_config, "include", default=None)
+    exclude = fetch_optional_config(a_config, "exclude", default=None)
+    if ignore_case:
+        include = re.compile(include, re.IGNORECASE) if include else None
+        exclude = re.compile(exclude, re.IGNORECASE) if exclude else None
+    else:
+        include = re.compile(include) if include else None
+        exclude = re.compile(exclude) if exclude else None
+    archive = fetch_optional_config(a_config, "archive", default=False)
+    dir_level = None
+    if archive:
+        dir_level = fetch_optional_config(a_config, "dir_level", default=None)
+        test_archive = fetch_optional_config(a_config, "test_archive", default=False)
+    # Archives built at once on a process pool, 0 builds one after another
+    archive_workers = budget.cap("compress_processes", fetch_optional_config(a_config, "archive_workers", default=0))
+    delete_source = fetch_optional_config(a_config, "delete_source", default=False)
+    delete_empty_dirs = fetch_optional_config(a_config, "delete_empty_dirs", default=False)
+    meta_file_name = fetch_optional_config(a_config, "meta_file_name", default=None)
+    hash_workers = budget.cap("hash_threads", fetch_optional_config(a_config, "hash_workers", default=0))
+    hash_pool = fetch_optional_config(a_config, "hash_pool", default="thread")
+    walk_workers = fetch_optional_config(a_config, "walk_workers", default=0)
+    hash_algorithm = fetch_optional_config(a_config, "hash_algorithm", default="sha1")
+    content_md5 = fetch_optional_config(a_config, "content_md5", default=False)
+    try:
+        hash_constructor(hash_algorithm)
+    except ValueError as e:
+        print("hash_algorithm is not configured correctly for {}. {}".format(base_path, e))
+        LOGGER.error("hash_algorithm is not configured correctly for {}. {}".format(base_path, e))
+        return
+    paranoid = fetch_optional_config(a_config, "paranoid", default=False)
+    manifest_backend = fetch_optional_config(a_config, "manifest", default="sqlite")
+    s3_endpoint_url = fetch_optional_config(a_config, "s3_endpoint_url", default=None)
+    transfer_manager = fetch_optional_config(a_config, "transfer_manager", default=False)
+    max_concurrency = budget.cap("upload_connections",
+                                 fetch_optional_config(a_config, "max_concurrency", default=10))
+    parallel_compress_threshold = fetch_optional_config(a_config, "parallel_compress_threshold", default=None)
+    compress_workers = budget.cap("compress_processes",
+                                  fetch_optional_config(a_config, "compress_workers", default=os.cpu_count()))
+    compress_block_size = fetch_optional_config(a_config, "compress_block_size", default=8388608)
+    codec_policy = None
+    if do_compress:
+        try:
+            codec_policy = CodecPolicy(fetch_optional_config(a_config, "codecs", default=None),
+                                       fetch_optional_config(a_config, "codec", default="gzip"),
+                                       fetch_optional_config(a_config, "codec_level", default=None),
+                                       fetch_optional_config(a_config, "min_compress_ratio", default=None),
+                                       ignore_case=ignore_case)
+        except (KeyError, ValueError, re.error) as e:
+            print("Codecs are not configured correctly for {}. {}".format(base_path, e))
+            LOGGER.error("Codecs are not configured correctly for {}. {}".format(base_path, e))
+            return
+    multipart_threshold = fetch_optional_config(a_config, "multipart_threshold", default=8388608)
+    multipart_chunksize = fetch_optional_config(a_config, "multipart_chunksize", default=8388608)
+    streaming = fetch_optional_config(a_config, "stream_upload", default=False) and s3_upload
+    dedup = fetch_optional_config(a_config, "dedup", default=False) and s3_upload and not archive
+    dedup_chunk_size = fetch_optional_config(a_config, "dedup_chunk_size", default=1048576)
+    pipelined = fetch_optional_config(a_config, "pipeline", default=False) and not archive and not dedup
+    pipeline_workers = fetch_optional_config(a_config, "pipeline_workers", default=None)
+    pipeline_queue_size = fetch_optional_config(a_config, "pipeline_queue_size", default=8)
+    # Small files uploaded together in pack objects, not for archives, dedup or the pipeline
+    pack = fetch_optional_config(a_config, "pack", default=False) and s3_upload and not archive and not dedup \
+        and not pipelined
+    pack_size = fetch_optional_config(a_config, "pack_size", default=16777216)
+    pack_threshold = fetch_optional_config(a_config, "pack_threshold", default=1048576)
+    use_journal = fetch_optional_config(a_config, "journal", default=False)
+    # Skip the changed files already present in S3, for a lost manifest or a new host. Not for archives or dedup
+    do_reconcile = fetch_optional_config(a_config, "reconcile", default=False) and s3_upload and not archive \
+        and not dedup
+    inventory_max_age = fetch_optional_config(a_config, "inventory_max_age", default=86400)
+    inventory_workers = budget.cap("upload_connections",
+                                   fetch_optional_config(a_config, "inventory_workers", default=8))
+    journal_max_lag = fetch_optional_config(a_config, "journal_max_lag", default=300)
+    metrics_file = fetch_optional_config(a_config, "metrics_file",
+                                         default=metadata_path(base_path, meta_file_name, ".metrics.json"))
+    prometheus_textfile = fetch_optional_config(a_config, "prometheus_textfile", default=None)
+    progress_interval = fetch_optional_config(a_config, "progress_interval", default=0.25)
+    max_bandwidth = fetch_optional_config(a_config, "max_bandwidth", default=None)
+    adaptive_concurrency = fetch_optional_config(a_config, "adaptive_concurrency", default=False)
+    upload_windows = fetch_optional_config(a_config, "upload_windows", default=None)
+    shaper = None
+    if max_bandwidth or adaptive_concurrency or upload_windows:
+        try:
+            shaper = UploadShaper(max_bandwidth, max_concurrency, adaptive_concurrency,
+                                  fetch_optional_config(a_config, "min_concurrency", default=1), upload_windows,
+                                  fetch_optional_config(a_config, "adaptive_interval", default=5))
+        except (KeyError, ValueError, AttributeError) as e:
+            print("upload_windows are not configured correctly for {}. {}".format(base_path, e))
+            LOGGER.error("upload_windows are not configured correctly for {}. {}".format(base_path, e))
+            return
+    # Streamed archives still compress and encrypt their members one by one in the tmp_path
+    if not tmp_path and ((archive and (do_compress or do_encrypt or not streaming)) or
+                         (not archive and not streaming and not dedup and (do_compress or do_encrypt))):
+        print("tmp_path is required for {} unless stream_upload is enabled".format(base_path))
+        LOGGER.error("tmp_path is required for {} unless stream_upload is enabled".format(base_path))
+        return
+    encryptor = None
+    if do_encrypt:
+        try:
+            encryptor = open_encryptor(encryption, gpg_id, encryption_key_file, encrypt_retries)
+        except (EncryptionError, OSError, ValueError) as e:
+            print("Encryption is not configured correctly for {}. {}".format(base_path, e))
+            LOGGER.error("Encryption is not configured correctly for {}. {}".format(base_path, e))
+            return
+    # Test regex and exit
+    if test_regex:
+        scan(base_path, include, exclude, test_regex)
+
+    else:
+        start_entry = time.time()
+        # The progress lines of the entries backed up concurrently would overwrite each other
+        progress = Progress(interval=progress_interval if budget.entries == 1 else None)
+        # Present till the metadata is cached, so an interrupted run is found by the next one
+        running_path = metadata_path(base_path, meta_file_name, ".running")
+        if os.path.exists(running_path):
+            print("Resuming the interrupted run of {}, the files committed by it are not backed up again".format(
+                base_path))
+            LOGGER.info("Resuming the interrupted run of {}".format(base_path))
+        else:
+            open(running_path, "w").close()
+        manifest = open_manifest(base_path, meta_file_name, manifest_backend)
+        journal = open_journal(base_path, meta_file_name, journal_max_lag) if use_journal else None
+        if not pipelined:
+            with progress.timer("scan"):
+                scan(base_path, include, exclude, consider_older=consider_older, hash_workers=hash_workers,
+                     hash_pool=hash_pool, manifest=manifest, paranoid=paranoid, journal=journal,
+                     walk_workers=walk_workers, hash_algorithm=hash_algorithm, content_md5=content_md5,
+                     progress=progress, budget=budget)
+            with progress.timer("compare"):
+                changed_locations, changed_dirs = compare(manifest, base_path, archive, dir_level)
+                count_changed_locations = manifest.count_changed()
+            progress.counters["changed"] = count_changed_locations
+            LOGGER.info("Number of Changed files are [{}]".format(count_changed_locations))
+            print("Number of Changed files are [{}]".format(str(count_changed_locations)))
+
+        session = boto3.session.Session(profile_name=aws_profile)
+        s3 = s3_client(session, s3_endpoint_url, max(10, max_concurrency))
+        budget.attach(s3)
+        if shaper:
+            shaper.attach(s3)
+        uploader = None
+        if s3_upload and transfer_manager and not pipelined:
+            uploader = Uploader(s3, base_path, bucket_name, s3_prefix_path, max_concurrency, multipart_threshold,
+                                multipart_chunksize, budget=budget)
+        pack_store = None
+        if pack:
+            pack_store = PackStore(s3, base_path, bucket_name, s3_prefix_path, codec_policy, encryptor, pack_size,
+                                   pack_threshold, max_concurrency)
+        compress_executor = None
+        if do_compress and parallel_compress_threshold is not None:
+            compress_executor = budget.gate("compress_processes", process_pool(compress_workers))
+        # Locations committed to the manifest as they are backed up, and those waiting for a queued upload
+        backed_up, queued = list(), dict()
+        inventory = None
+        if do_reconcile and (pipelined or count_changed_locations):
+            try:
+                with progress.timer("inventory"):
+                    inventory = open_inventory(s3, base_path, bucket_name, s3_prefix_path, meta_file_name,
+                                               inventory_max_age, inventory_workers, not manifest.has_backups())
+            except (ClientError, BotoCoreError) as e:
+                print("Couldn't list s3://{}/{}, not reconciling. {}".format(bucket_name, s3_prefix_path, e))
+                LOGGER.error("Couldn't list s3://{}/{}, not reconciling. {}".format(bucket_name, s3_prefix_path,
+                                                                                   e))
+        if inventory and not pipelined:
+            changed_locations = reconcile(s3, inventory, manifest, base_path, bucket_name, s3_prefix_path,
+                                          changed_locations, codec_policy, encryptor, inventory_workers,
+                                          backed_up)
+
+        # Hash, compress, encrypt and upload overlapping, while the tree is walked
+        if pipelined:
+            stages = backup_stages(s3 if s3_upload else None, base_path, bucket_name, s3_prefix_path, tmp_path,
+                                   codec_policy, encryptor, streaming, pipeline_workers, multipart_chunksize,
+                                   max_concurrency, compress_executor, parallel_compress_threshold,
+                                   compress_block_size, compress_workers * 2, hash_algorithm, content_md5,
+                                   multipart_threshold, inventory, budget)
+            with progress.timer("pipeline"):
+                changed_locations = pipeline_backup(manifest, base_path, include, exclude, stages, consider_older,
+                                                    paranoid, pipeline_queue_size, journal, walk_workers,
+                                                    progress, budget)
+            count_changed_locations = len(changed_locations)
+            progress.counters["changed"] = count_changed_locations
+            backed_up = changed_locations
+
+        elif archive:
+            # A pass over the directories only, the files are read by the second one
+            with progress.timer("compare"):
+                count_changed_dirs = sum(1 for _ in compare(manifest, base_path, archive, dir_level)[1])
+            progress.counters["changed_dirs"] = count_changed_dirs
+            LOGGER.info("Number of Changed Directories are [{}]".format(count_changed_dirs))
+            print("Number of Changed Directories are [{}]".format(count_changed_dirs))
+
+            # Test archive and exit
+            if test_archive:
+                import pprint
+                print("Archiving happens at")
+                pprint.pprint(dict(changed_dirs))
+                clean_up(running_path)
+                exit(0)
+
+            progress.template = "Compressed [{compressed}/{changed}], Encrypted [{encrypted}/{changed}], " \
+                                "Archived [{archived}/{changed_dirs}], Uploaded [{uploaded}/{changed_dirs}]"
+            if archive_workers and not streaming:
+                # Built on a process pool, the finished archives come in the order they complete
+                archives = parallel_archives(changed_dirs, tmp_path, archive_workers, codec_policy, encryptor,
+                                             budget, progress, do_compress + do_encrypt)
+            else:
+                archives = ((directory, dir_locations, None) for directory, dir_locations in changed_dirs)
+            for directory, dir_locations, built in archives:
+                # dir_name = os.path.basename(directory)
+                dir_name = directory[directory.rindex("/") + 1:]
+                last_modified = datetime.fromtimestamp(os.stat(directory).st_mtime).date().isoformat()
+                writer = None
+                if built:
+                    archive_tmp_path, archive_path, members, reserved = built
+                    progress.add("archived")
+                    progress.draw()
+                    LOGGER.info("Archive [{}/{}] for {} created at {}".format(progress.counters["archived"], count_changed_dirs, directory, archive_path))
+                else:
+                    reserved = 0
+                    if budget.tmp_bytes is not None:
+                        reserved = budget.reserve(tmp_size(dir_locations, do_compress + do_encrypt, not streaming))
+                    if streaming:
+                        # The tar stream is uploaded part by part while the later members are still being added,
+                        # only the compressed and encrypted member being added is in the tmp_path
+                        archive_tmp_path, archive_path = tmp_path, None
+                        writer = MultipartUploadWriter(s3, bucket_name,
+                                                       s3_key(base_path, s3_prefix_path, directory,
+                                                              directory + ".tar.gz"),
+                                                       {"Local-Last-Modified": last_modified}, multipart_chunksize,
+                                                       max_concurrency)
+                        archiver = tarfile.open(fileobj=writer, mode="w|gz")
+                        LOGGER.info("Streaming Archive of {} to {}".format(directory, writer.key))
+                    else:
+                        # Queued uploads outlive the iteration, so each archive gets its own directory in tmp_path
+                        archive_tmp_path = tempfile.mkdtemp(dir=tmp_path) if uploader else tmp_path
+                        archive_path = os.path.join(archive_tmp_path, dir_name + ".tar.gz")
+                        archiver = tarfile.open(archive_path, "w:gz")
+                        LOGGER.info("Creating Archive at {}".format(archive_path))
+
+                    try:
+                        with archiver:
+                            members = archive_members(archiver, directory, dir_locations, tmp_path, codec_policy,
+                                                      encryptor, progress, compress_executor,
+                                                      parallel_compress_threshold, compress_block_size,
+                                                      compress_workers * 2, budget)
+                            progress.add("archived")
+                            progress.draw()
+                            LOGGER.info("Archive [{}/{}] for {} created at {}".format(progress.counters["archived"], count_changed_dirs, directory, archive_path or writer.key))
+
+                        if writer:
+                            with progress.timer("upload"):
+                                writer.close()
+                            progress.add("uploaded")
+                            LOGGER.info("Archive of {} uploaded to {}".format(directory, writer.key))
+                            for location in members:
+                                manifest.commit(location)
+                            backed_up.extend(members)
+                    except (ClientError, BotoCoreError, OSError, tarfile.TarError) as e:
+                        if writer:
+                            LOGGER.error("Streaming upload failed for {}. {}".format(directory, e))
+                            print("\nCouldn't upload " + directory)
+                            writer.abort()
+                        else:
+                            LOGGER.error("Couldn't archive {}. {}".format(directory, e))
+                            print("\nCouldn't archive " + directory)
+                            clean_up(archive_path)
+                            if archive_tmp_path != tmp_path:
+                                shutil.rmtree(archive_tmp_path, ignore_errors=True)
+                        progress.add("failed")
+                        budget.release(reserved)
+                        continue
+
+                if s3_upload and not writer:
+                    LOGGER.info("Uploading archived {}".format(directory))
+                    progress.draw("Uploading", directory)
+                    # print('Uploading ' + location)
+                    if uploader:
+                        queued[directory] = members
+                        uploader.submit(directory, archive_path, last_modified, tmp_dir=archive_tmp_path,
+                                        reserved=reserved)
+                        archive_path, reserved = None, 0
+                        commit_uploaded(manifest, uploader, queued, backed_up)
+                    else:
+                        with progress.timer("upload"):
+                            uploaded = upload(s3, base_path, bucket_name, s3_prefix_path, directory, archive_path,
+                                              last_modified)
+                        if not uploaded:
+                            LOGGER.error("Couldn't upload {} in tmp_path {}".format(directory, archive_path))
+                            print("\nCouldn't upload {} in tmp_path {}".format(directory, archive_path))
+                            progress.add("failed")
+                        else:
+                            progress.add("uploaded")
+                            for location in members:
+                                manifest.commit(location)
+                            backed_up.extend(members)
+                elif not s3_upload:
+                    for location in members:
+                        manifest.commit(location)
+                    backed_up.extend(members)
+                # Todo Uncomment the below
+                clean_up(archive_path)
+                if archive_path and archive_tmp_path != tmp_path:
+                    shutil.rmtree(archive_tmp_path, ignore_errors=True)
+                budget.release(reserved)
+
+        # Upload only the chunks not stored yet
+        elif dedup:
+            chunk_store = ChunkStore(s3, base_path, bucket_name, s3_prefix_path, manifest, codec_policy, encryptor,
+                                     dedup_chunk_size, max_concurrency)
+            progress.template = "Uploaded [{uploaded}/{changed}]"
+            for location in changed_locations:
+                LOGGER.info('Dedup ' + location)
+                progress.draw("Chunking", location)
+                with progress.timer("dedup"):
+                    stored = chunk_store.backup(location,
+                                                datetime.fromtimestamp(os.stat(location).st_mtime).date().isoformat())
+                if not stored:
+                    LOGGER.error("Couldn't upload " + location)
+                    print("\nCouldn't upload " + location)
+                    progress.add("failed")
+                else:
+                    progress.add("uploaded")
+                    manifest.commit(location)
+                    backed_up.append(location)
+            with progress.timer("dedup"):
+                chunk_store.close()
+            progress.end()
+            progress.counters.update({"chunks": chunk_store.total_chunks, "new_chunks": chunk_store.new_chunks,
+                                      "chunk_bytes": chunk_store.total_bytes,
+                                      "new_chunk_bytes": chunk_store.new_bytes})
+            print("Chunks [{}], New Chunks [{}], Bytes [{}], New Bytes [{}]".format(
+                chunk_store.total_chunks, chunk_store.new_chunks, chunk_store.total_bytes, chunk_store.new_bytes))
+            LOGGER.info("Chunks [{}], New Chunks [{}], Bytes [{}], New Bytes [{}]".format(
+                chunk_store.total_chunks, chunk_store.new_chunks, chunk_store.total_bytes, chunk_store.new_bytes))
+
+        # Compress, encrypt and upload in one pass without the tmp_path
+        elif streaming:
+            progress.template = "Compressed [{compressed}/{changed}], Encrypted [{encrypted}/{changed}], " \
+                                "Uploaded [{uploaded}/{changed}]" + (", Packed [{packed}]" if pack_store else "")
+            for location in changed_locations:
+                if pack_store and pack_store.fits(location):
+                    pack_location(pack_store, manifest, location, progress, backed_up)
+                    continue
+                LOGGER.info('Streaming ' + location)
+                progress.draw("Streaming", location)
+                codec, level = codec_policy.choose(location) if do_compress else ("none", None)
+                with progress.timer("stream"):
+                    streamed = stream_upload(s3, base_path, bucket_name, s3_prefix_path, location,
+                                             datetime.fromtimestamp(os.stat(location).st_mtime).date().isoformat(),
+                                             codec, level, encryptor, multipart_chunksize, max_concurrency,
+                                             compress_executor, parallel_compress_threshold, compress_block_size,
+                                             (manifest.current(location) or dict()).get("hash"), do_compress,
+                                             budget)
+                if not streamed:
+                    LOGGER.error("Couldn't upload " + location)
+                    print("\nCouldn't upload " + location)
+                    progress.add("failed")
+                else:
+                    progress.add("compressed", 1 if codec != "none" else 0)
+                    progress.add("encrypted", 1 if do_encrypt else 0)
+                    progress.add("uploaded")
+                    manifest.commit(location)
+                    backed_up.append(location)
+
+        # If no archiving is needed
+        else:
+            progress.template = "Compressed [{compressed}/{changed}], Encrypted [{encrypted}/{changed}], " \
+                                "Uploaded [{uploaded}/{changed}]" + (", Packed [{packed}]" if pack_store else "")
+            for location in changed_locations:
+                if pack_store and pack_store.fits(location):
+                    pack_location(pack_store, manifest, location, progress, backed_up)
+                    continue
+                t = None
+                reserved = 0
+                if budget.tmp_bytes is not None:
+                    reserved = budget.reserve(tmp_size([location], do_compress + do_encrypt))
+                # Queued uploads outlive the iteration, so each file gets its own directory in tmp_path
+                file_tmp_path = tempfile.mkdtemp(dir=tmp_path) if uploader and (do_compress or do_encrypt) else tmp_path
+                if do_compress:
+                    LOGGER.info("Compressing " + location)
+                    progress.draw("Compressing", location)
+                    with progress.timer("compress"):
+                        t = compress(location, file_tmp_path, compress_executor, parallel_compress_threshold,
+                                     compress_block_size, compress_workers * 2, *codec_policy.choose(location),
+                                     budget=budget)
+                    progress.add("compressed", 1 if t else 0)
+                if do_encrypt:
+                    LOGGER.info('Encrypting ' + location)
+                    # print('Encrypting ' + location)
+                    progress.draw("Encrypting", location)
+                    try:
+                        with progress.timer("encrypt"):
+                            if t:
+                                t = encrypt(t, encryptor)
+                            else:
+                                t = encrypt(file_tmp_path, encryptor, location, codec_suffix("none", do_compress))
+                    except EncryptionError as e:
+                        LOGGER.error("Couldn't encrypt {}. {}".format(location, e))
+                        print("\nCouldn't encrypt " + location)
+                        progress.add("failed")
+                        clean_up(t)
+                        if file_tmp_path != tmp_path:
+                            shutil.rmtree(file_tmp_path, ignore_errors=True)
+                        budget.release(reserved)
+                        continue
+                    progress.add("encrypted")
+                if s3_upload:
+                    LOGGER.info('Uploading ' + location)
+                    progress.draw("Uploading", location)
+                    # print('Uploading ' + location)
+                    info = manifest.current(location) or dict()
+                    if uploader:
+                        queued[location] = [location]
+                        uploader.submit(location, t, datetime.fromtimestamp(os.stat(location).st_mtime).date().isoformat(),
+                                        tmp_dir=file_tmp_path if file_tmp_path != tmp_path else None,
+                                        local_hash=info.get("hash"), reserved=reserved,
+                                        suffix=codec_suffix("none", do_compress))
+                        t, file_tmp_path, reserved = None, tmp_path, 0
+                        commit_uploaded(manifest, uploader, queued, backed_up)
+                    else:
+                        with progress.timer("upload"):
+                            uploaded = upload(s3, base_path, bucket_name, s3_prefix_path, location, t,
+                                              datetime.fromtimestamp(os.stat(location).st_mtime).date().isoformat(),
+                                              info.get("md5") if content_md5 else None, multipart_threshold,
+                                              info.get("hash"), codec_suffix("none", do_compress))
+                        if not uploaded:
+                            LOGGER.error("Couldn't upload {} in tmp_path {}".format(location, t))
+                            print("\nCouldn't upload {} in tmp_path {}".format(location, t))
+                            progress.add("failed")
+                        else:
+                            progress.add("uploaded")
+                            manifest.commit(location)
+                            backed_up.append(location)
+                else:
+                    manifest.commit(location)
+                    backed_up.append(location)
+
+                clean_up(t)
+                if file_tmp_path != tmp_path:
+                    shutil.rmtree(file_tmp_path, ignore_errors=True)
+                budget.release(reserved)
+                # Save todays file info
+
+        if compress_executor:
+            compress_executor.shutdown()
+
+        if not pipelined and not dedup:
+            progress.end()
+
+        if uploader:
+            print("Waiting for the queued uploads")
+            with progress.timer("upload_wait"):
+                uploaded, failed = uploader.wait()
+            commit_uploaded(manifest, uploader, queued, backed_up)
+            progress.counters.update({"uploaded": len(uploaded), "failed": len(failed)})
+            for location in failed:
+                print("Couldn't upload " + location)
+            print("Uploaded [{}], Failed [{}]".format(len(uploaded), len(failed)))
+            LOGGER.info("Uploaded [{}], Failed [{}]".format(len(uploaded), len(failed)))
+
+        if pack_store:
+            print("Waiting for the packs")
+            with progress.timer("pack_wait"):
+                failed = pack_store.close()
+            commit_packed(manifest, pack_store, backed_up)
+            progress.counters["packs"] = pack_store.packs
+            progress.add("failed", len(failed))
+            for location in failed:
+                print("Couldn't upload the pack of " + location)
+            print("Packed [{}] files in [{}] packs, Failed [{}]".format(progress.counters["packed"] - len(failed),
+                                                                         pack_store.packs, len(failed)))
+            LOGGER.info("Packed [{}] files in [{}] packs, Failed [{}]".format(
+                progress.counters["packed"] - len(failed), pack_store.packs, len(failed)))
+
+        progress.counters["backed_up"] = len(backed_up)
+        print("Backed up [{}/{}] changed files".format(len(backed_up), count_changed_locations))
+        LOGGER.info("Backed up [{}/{}] changed files".format(len(backed_up), count_changed_locations))
+        if len(backed_up) < count_changed_locations:
+            print("[{}] files not backed up are retried by the next run".format(
+                count_changed_locations - len(backed_up)))
+        if journal and not pipelined and len(backed_up) < count_changed_locations:
+            # The events of the files not backed up are kept, else the next run wouldn't walk them to retry them
+            committed = set(backed_up)
+            for location in manifest.changed():
+                if location not in committed:
+                    journal.defer(location)
+        print("Caching Metadata for {}".format(base_path))
+        with progress.timer("save"):
+            manifest.save()
+            manifest.close()
+        if inventory:
+            inventory.close()
+        if journal:
+            journal.commit()
+            journal.close()
+        clean_up(running_path)
+
+        if delete_source:
+            # Only the files backed up, the failed ones are kept for the next run
+            LOGGER.info("Deleting Source Files Start")
+            progress.template = "Deleted [{deleted}/{backed_up}]"
+            with progress.timer("delete"):
+                for location in backed_up:
+                    progress.add("deleted")
+                    progress.draw("Deleting", location)
+                    LOGGER.info("Deleted [{}/{}]. Deleting {}".format(progress.counters["deleted"], len(backed_up),
+                                                                      location))
+                    clean_up(location)
+            progress.end()
+            LOGGER.info("Deleting Source Files Successful")
+
+        if delete_empty_dirs:
+            LOGGER.info("Deleting Empty Directories")
+            print("Deleting Empty Directories")
+            with progress.timer("delete"):
                 clean_up_empty_directories(base_path)
-                LOGGER.info("Deleted")
+            LOGGER.info("Deleted")
+
+        progress.timers["total"] = time.time() - start_entry
+        try:
+            progress.export(base_path, metrics_file, prometheus_textfile)
+        except OSError as e:
+            print("Couldn't export the metrics of {}. {}".format(base_path, e))
+            LOGGER.error("Couldn't export the metrics of {}. {}".format(base_path, e))
+
+
+def main():
+    os.environ["AWS_CONFIG_FILE"] = os.path.join(os.getcwd(), ".aws/config")
+    os.environ["AWS_SHARED_CREDENTIALS_FILE"] = os.path.join(os.getcwd(), ".aws/credentials")
+
+    # print(os.getenv("AWS_CONFIG_FILE"), os.getenv("AWS_SHARED_CREDENTIALS_FILE"))
+    start_entire = time.time()
+
+    parser = ArgumentParser()
+    parser.add_argument("-c", "--config", help="Test Configuration Path", type=str, metavar="", dest="config_path", default=None)
+    parser.add_argument("-p", "--parallel", help="Number of config entries backed up concurrently", type=int,
+                        metavar="", default=1)
+    parser.add_argument("--hash_threads", help="Hashing threads shared by the concurrent entries", type=int,
+                        metavar="", default=None)
+    parser.add_argument("--compress_processes", help="Compression processes shared by the concurrent entries",
+                        type=int, metavar="", default=None)
+    parser.add_argument("--upload_connections", help="S3 connections shared by the concurrent entries", type=int,
+                        metavar="", default=None)
+    parser.add_argument("--tmp_bytes", help="Bytes in the tmp_path shared by the concurrent entries", type=int,
+                        metavar="", default=None)
+    args = parser.parse_args()
+    if args.config_path:
+        config_file = args.config_path
+    else:
+        config_file = os.path.join(os.getcwd(), "backup_config.json")
+
+    LOGGER.info("Reading config from {}".format(config_file))
+    try:
+        with open(config_file, "r") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        print("Configuration file Not found.")
+        LOGGER.exception("Configuration file Not found. Stack trace")
+        exit(0)
+    except json.decoder.JSONDecodeError:
+        print("Configuration file is not a valid json file.")
+        LOGGER.exception("Configuration file is not a valid json file. Stack trace")
+        exit(0)
+
+    parallel = max(1, min(args.parallel, len(config)))
+    budget = ResourceBudget(parallel, args.hash_threads, args.compress_processes, args.upload_connections,
+                            args.tmp_bytes)
+    entry_times = dict()
+
+    def backup_timed(name, a_config):
+        start_entry = time.time()
+        try:
+            backup_entry(a_config, budget)
+        finally:
+            entry_times[name] = time.time() - start_entry
+            LOGGER.info("Entry [{}] Time [{:.4f}]s".format(name, entry_times[name]))
+
+    if parallel > 1:
+        print("Backing up [{}] config entries, [{}] at once".format(len(config), parallel))
+        with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="entry") as executor:
+            futures = [executor.submit(backup_timed, name, a_config) for name, a_config in config.items()]
+            for future in futures:
+                future.result()
+    else:
+        for name, a_config in config.items():
+            backup_timed(name, a_config)
 
     # Todo Handle Exception in main program, do clean up in except
     print("\n{}".format("".join(["-"] * 75)))
+    for name, elapsed in entry_times.items():
+        print("Entry [{}] Time [{:.4f}]s".format(name, elapsed))
     print("Total Time [{:.4f}]s".format(time.time() - start_entire))
     LOGGER.info("Total Time [{:.4f}]s".format(time.time() - start_entire))
 
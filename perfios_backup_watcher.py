@@ -0,0 +1,284 @@
+"""
+Companion watcher of perfios_backup_to_s3. Records the create, modify, move and delete events below the base_path of
+each configuration into a journal, using inotify. With "journal": true in the configuration, the backup run scans
+only the paths in the journal instead of walking the whole tree, and walks the whole tree only when the journal has
+a gap: the watcher was restarted or not running, the kernel event queue overflowed, or some directories couldn't be
+watched (see /proc/sys/fs/inotify/max_user_watches).
+Run it from the directory perfios_backup_to_s3 runs from, as the journal is kept next to the metadata in data/.
+Linux only.
+
+Usage:
+python3 perfios_backup_watcher.py [-h] [-c]
+optional arguments:
+  -h, --help           show this help message and exit
+  -c , --config        Test Configuration Path
+
+Author: Sudharshan
+"""
+
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import signal
+import struct
+import time
+
+from argparse import ArgumentParser
+
+from perfios_backup_to_s3 import LOGGER
+from perfios_backup_to_s3 import Journal
+from perfios_backup_to_s3 import fetch_optional_config
+from perfios_backup_to_s3 import metadata_path
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_NAMES = ((IN_CREATE, "create"), (IN_MOVED_TO, "moved_to"), (IN_MOVED_FROM, "moved_from"),
+               (IN_DELETE, "delete"), (IN_CLOSE_WRITE, "modify"), (IN_MODIFY, "modify"), (IN_ATTRIB, "modify"))
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    Minimal inotify binding over ctypes
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        :param path: Directory to watch
+        :param mask:
+        :return: Watch descriptor
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """
+        Read the pending events
+        :param timeout: Seconds to wait for an event
+        :return: list of (wd, mask, cookie, name)
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return list()
+        data = os.read(self.fd, 1048576)
+        events, offset = list(), 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    Watches the directories below the base paths and records their events in the journals. The events are batched
+    for flush_interval seconds, so that a file written in many blocks is recorded once.
+    """
+
+    def __init__(self, journals, flush_interval=1, heartbeat_interval=30):
+        """
+        :param journals: dict of {base_path: Journal}
+        :param flush_interval: Seconds the events are batched for
+        :param heartbeat_interval: Seconds between the heartbeats of an idle watcher
+        """
+        self.journals = journals
+        self.flush_interval = flush_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.inotify = Inotify()
+        self.watches = dict()
+        self.paths = dict()
+        # Base paths having directories that couldn't be watched
+        self.incomplete = set()
+        self.pending = {base_path: dict() for base_path in journals}
+        self.running = True
+
+    def base_path_of(self, path):
+        for base_path in self.journals:
+            if path == base_path or path.startswith(base_path + "/"):
+                return base_path
+        return None
+
+    def watch_tree(self, root):
+        """
+        Watch root and the directories below it
+        :param root:
+        :return:
+        """
+        for directory, _, _ in os.walk(root):
+            try:
+                wd = self.inotify.add_watch(directory)
+            except OSError as e:
+                LOGGER.error("Couldn't watch {}. {}".format(directory, e))
+                self.incomplete.add(self.base_path_of(directory))
+                continue
+            self.watches[wd] = directory
+            self.paths[directory] = wd
+
+    def unwatch_tree(self, root):
+        """
+        Stop watching root and the directories below it, e.g. after it was moved out
+        :param root:
+        :return:
+        """
+        for directory in [path for path in self.paths if path == root or path.startswith(root + "/")]:
+            wd = self.paths.pop(directory)
+            self.watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def handle(self, wd, mask, name):
+        """
+        Turn an inotify event into a journal event
+        :return:
+        """
+        if mask & IN_Q_OVERFLOW:
+            LOGGER.error("inotify queue overflowed, the next backup runs walk the whole tree")
+            for journal in self.journals.values():
+                journal.mark(Journal.OVERFLOW)
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            self.paths.pop(directory, None)
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # Recorded by the event of the parent, except for the base path itself
+            if directory in self.journals:
+                self.pending[directory][directory] = "delete"
+            return
+        path = os.path.join(directory, name)
+        base_path = self.base_path_of(path)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path)
+            elif mask & (IN_MOVED_FROM | IN_DELETE):
+                self.unwatch_tree(path)
+        for bit, event in EVENT_NAMES:
+            if mask & bit:
+                self.pending[base_path][path] = event
+                break
+
+    def flush(self):
+        """
+        Write the batched events to the journals
+        :return:
+        """
+        for base_path, events in self.pending.items():
+            if events:
+                self.journals[base_path].add(events.items())
+                self.pending[base_path] = dict()
+
+    def run(self):
+        """
+        Watch till stop is called
+        :return:
+        """
+        for base_path, journal in self.journals.items():
+            journal.mark(Journal.START)
+            self.watch_tree(base_path)
+            journal.mark(Journal.OVERFLOW if base_path in self.incomplete else Journal.READY)
+            print("Watching [{}] directories below {}".format(
+                sum(1 for path in self.paths if self.base_path_of(path) == base_path), base_path))
+            LOGGER.info("Watching {}".format(base_path))
+        last_flush = last_heartbeat = time.time()
+        try:
+            while self.running:
+                for wd, mask, _, name in self.inotify.read(self.flush_interval):
+                    self.handle(wd, mask, name)
+                now = time.time()
+                if now - last_flush >= self.flush_interval:
+                    self.flush()
+                    last_flush = now
+                if now - last_heartbeat >= self.heartbeat_interval:
+                    for base_path, journal in self.journals.items():
+                        # Events are missed in the directories not watched, so the journal stays untrusted
+                        if base_path in self.incomplete:
+                            journal.mark(Journal.OVERFLOW)
+                        else:
+                            journal.heartbeat()
+                    last_heartbeat = now
+        finally:
+            self.flush()
+            for journal in self.journals.values():
+                journal.mark(Journal.STOP)
+                journal.close()
+            self.inotify.close()
+
+    def stop(self, *args):
+        self.running = False
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-c", "--config", help="Test Configuration Path", type=str, metavar="", dest="config_path",
+                        default=None)
+    args = parser.parse_args()
+    if args.config_path:
+        config_file = args.config_path
+    else:
+        config_file = os.path.join(os.getcwd(), "backup_config.json")
+
+    LOGGER.info("Reading config from {}".format(config_file))
+    try:
+        with open(config_file, "r") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        print("Configuration file Not found.")
+        LOGGER.exception("Configuration file Not found. Stack trace")
+        exit(0)
+    except json.decoder.JSONDecodeError:
+        print("Configuration file is not a valid json file.")
+        LOGGER.exception("Configuration file is not a valid json file. Stack trace")
+        exit(0)
+
+    journals = dict()
+    for _, a_config in config.items():
+        base_path = a_config["base_path"].rstrip("/")
+        if not os.path.isdir(base_path):
+            print("{} is not a directory, not watching it".format(base_path))
+            LOGGER.error("{} is not a directory, not watching it".format(base_path))
+            continue
+        meta_file_name = fetch_optional_config(a_config, "meta_file_name", default=None)
+        journals[base_path] = Journal(metadata_path(base_path, meta_file_name, ".journal.db"))
+
+    watcher = Watcher(journals)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    signal.signal(signal.SIGINT, watcher.stop)
+    watcher.run()
+
+
+if __name__ == "__main__":
+    main()
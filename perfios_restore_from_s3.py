@@ -0,0 +1,822 @@
+"""
+Restore of perfios_backup_to_s3. Lists the s3_prefix_path of each configuration and rebuilds the tree below
+base_path from the objects: the files, the archives of archive mode, the recipes of dedup mode and the packs of pack
+mode. Each object is downloaded with parallel ranged GETs and decrypted and decompressed as a stream by the suffixes of
+its key, nothing is staged on the disk besides the restored file itself. A packed file is read from its pack with one
+ranged GET, at the offset in the index of the pack. The modified date is restored from the Local-Last-Modified
+metadata, and the file is verified against the Local-Hash metadata when the object has it.
+The same backup_config.json is used, for the bucket and the encryption. A file is hashed with the algorithm of its
+Local-Hash, which may differ from the hash_algorithm of the entry. The gpg encrypted objects need the secret key of
+gpg_id in the keyring.
+
+Usage:
+python3 perfios_restore_from_s3.py [-h] [-c] [-t] [-e] [-p] [-w] [--part_size] [--read_ahead]
+optional arguments:
+  -h, --help           show this help message and exit
+  -c , --config        Test Configuration Path
+  -t , --target        Directory to restore into, below a directory per config entry. By default each base_path
+  -e , --entry         Restore only this config entry
+  -p , --prefix        Restore only the files below this path, relative to base_path
+  -w , --workers       Number of objects restored concurrently
+  --part_size          Size of each ranged GET
+  --read_ahead         Number of ranged GETs of an object fetched ahead of the one being decoded
+
+Author: Sudharshan
+"""
+
+import collections
+import gzip
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from datetime import datetime
+
+import boto3
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
+
+from perfios_backup_to_s3 import CODEC_SUFFIXES
+from perfios_backup_to_s3 import STORED_SUFFIX
+from perfios_backup_to_s3 import LOGGER
+from perfios_backup_to_s3 import AesGcmEncryptor
+from perfios_backup_to_s3 import ChunkStore
+from perfios_backup_to_s3 import PackStore
+from perfios_backup_to_s3 import EncryptionError
+from perfios_backup_to_s3 import Progress
+from perfios_backup_to_s3 import fetch_optional_config
+from perfios_backup_to_s3 import hash_algorithm_of
+from perfios_backup_to_s3 import hash_constructor
+from perfios_backup_to_s3 import hash_prefix
+from perfios_backup_to_s3 import lz4
+from perfios_backup_to_s3 import open_encryptor
+from perfios_backup_to_s3 import s3_client
+from perfios_backup_to_s3 import zstandard
+
+BLOCK_SIZE = 1048576
+ENCRYPTION_SUFFIXES = {".gpg": "gpg", ".aes": "aes-gcm"}
+CODECS = {suffix: codec for codec, suffix in CODEC_SUFFIXES.items() if suffix}
+
+
+class RangedReader(io.RawIOBase):
+    """
+    File like object reading an object with ranged GETs of part_size bytes. read_ahead parts are fetched
+    concurrently ahead of the part being read, so an object downloads at the speed of several connections while it's
+    read in order.
+    """
+
+    def __init__(self, s3, bucket_name, key, size, executor, part_size=8388608, read_ahead=4):
+        """
+        :param s3: s3_client
+        :param bucket_name:
+        :param key:
+        :param size: Size of the object, from the listing
+        :param executor: Executor the GETs run on, shared by the objects being read
+        :param part_size: Size of each ranged GET
+        :param read_ahead: Number of parts fetched ahead
+        """
+        super().__init__()
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = size
+        self.executor = executor
+        self.part_size = part_size
+        self.read_ahead = max(1, read_ahead)
+        self.offset = 0
+        self.parts = collections.deque()
+        self.buffer = memoryview(b"")
+        self.first = None
+        self.downloaded = 0
+        self.fetch_ahead()
+
+    def fetch(self, start, end):
+        """
+        GET the bytes start to end, both included. Runs in the executor
+        :return: response, body
+        """
+        if self.size == 0:
+            # A range of an empty object is not satisfiable
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=self.key)
+        else:
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=self.key,
+                                          Range="bytes={}-{}".format(start, end))
+        return response, response["Body"].read()
+
+    def fetch_ahead(self):
+        while len(self.parts) < self.read_ahead and (self.offset < self.size or (self.size == 0 and
+                                                                                 self.first is None)):
+            end = min(self.offset + self.part_size, self.size) - 1
+            future = self.executor.submit(self.fetch, self.offset, end)
+            if self.first is None:
+                self.first = future
+            self.parts.append(future)
+            self.offset = end + 1
+
+    @property
+    def metadata(self):
+        """
+        :return: dict of the user metadata of the object, keys lowercased
+        """
+        return self.first.result()[0].get("Metadata", dict())
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            if not self.parts:
+                return 0
+            _, body = self.parts.popleft().result()
+            self.downloaded += len(body)
+            self.buffer = memoryview(body)
+            self.fetch_ahead()
+        count = min(len(b), len(self.buffer))
+        b[:count] = self.buffer[:count]
+        self.buffer = self.buffer[count:]
+        return count
+
+    def close(self):
+        for future in self.parts:
+            future.cancel()
+        self.parts.clear()
+        super().close()
+
+
+class BlockReader(io.RawIOBase):
+    """
+    File like object reading the blocks of a generator
+    """
+
+    def __init__(self, blocks):
+        super().__init__()
+        self.blocks = iter(blocks)
+        self.buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            self.buffer = memoryview(block)
+        count = min(len(b), len(self.buffer))
+        b[:count] = self.buffer[:count]
+        self.buffer = self.buffer[count:]
+        return count
+
+
+class GpgDecryptReader(io.RawIOBase):
+    """
+    File like object decrypting f_in through a gpg process. f_in is copied to gpg by a writer thread while the
+    decrypted stream is read.
+    """
+
+    def __init__(self, f_in):
+        super().__init__()
+        self.f_in = f_in
+        self.error = None
+        # gpg's messages go to a file rather than a pipe nobody drains while the stream runs, which would block gpg
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(["gpg", "--batch", "--quiet", "-d", "-o", "-"], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=self.stderr)
+        self.writer = threading.Thread(target=self.pump, name="gpg-writer", daemon=True)
+        self.writer.start()
+
+    def pump(self):
+        """
+        Copy f_in to gpg. Runs in the writer thread
+        :return:
+        """
+        try:
+            shutil.copyfileobj(self.f_in, self.process.stdin, BLOCK_SIZE)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            self.error = e
+            self.process.kill()
+        finally:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        count = self.process.stdout.readinto(b)
+        if not count:
+            self.finish()
+        return count
+
+    def finish(self):
+        """
+        Wait for gpg. Raises the reason if gpg or f_in failed
+        :return:
+        """
+        self.writer.join()
+        self.process.wait()
+        self.stderr.seek(0)
+        stderr = self.stderr.read().decode(errors="replace")
+        if self.error:
+            raise self.error
+        if self.process.returncode:
+            raise EncryptionError("gpg exited with {}. {}".format(self.process.returncode, stderr.strip()))
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.writer.join()
+        self.process.wait()
+        for stream in (self.process.stdout, self.stderr):
+            stream.close()
+        super().close()
+
+
+def layers(name, encryption=None, compressed=False):
+    """
+    Split the suffixes added by the backup off the name
+    :param name: Name of the object or the archive member
+    :param encryption: "gpg" or "aes-gcm" if the entry encrypts, else None
+    :param compressed: If True, the entry compresses
+    :return: name of the file, list of the layers to decode, outermost first e.g. ["aes-gcm", "zstd"]
+    """
+    decode = list()
+    for suffix, layer in ENCRYPTION_SUFFIXES.items():
+        if encryption == layer and name.endswith(suffix):
+            name = name[:-len(suffix)]
+            decode.append(layer)
+            break
+    if compressed and name.endswith(STORED_SUFFIX):
+        name = name[:-len(STORED_SUFFIX)]
+    elif compressed:
+        for suffix, codec in CODECS.items():
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                decode.append(codec)
+                break
+    return name, decode
+
+
+def decoder(f_in, decode, encryptor=None):
+    """
+    Stack the readers decoding f_in
+    :param f_in: File like object
+    :param decode: list of the layers, see layers
+    :param encryptor: AesGcmEncryptor, for the aes-gcm layer
+    :return: File like object having the decoded bytes, list of the readers to close
+    """
+    readers = list()
+    for layer in decode:
+        if layer == "gpg":
+            f_in = GpgDecryptReader(f_in)
+        elif layer == "aes-gcm":
+            f_in = BlockReader(encryptor.decrypt_blocks(f_in))
+        elif layer == "zstd":
+            if zstandard is None:
+                raise ValueError("zstd needs the zstandard package")
+            f_in = zstandard.ZstdDecompressor().stream_reader(f_in, read_across_frames=True)
+        elif layer == "lz4":
+            if lz4 is None:
+                raise ValueError("lz4 needs the lz4 package")
+            f_in = lz4.frame.LZ4FrameFile(f_in, mode="rb")
+        else:
+            # Multi member streams of the parallel compression included
+            f_in = gzip.GzipFile(fileobj=f_in, mode="rb")
+        readers.append(f_in)
+    return f_in, readers
+
+
+def write_file(f_in, path, mtime=None, hash_algorithm=None):
+    """
+    Write f_in to path, through a temporary file renamed over path once complete
+    :param f_in: File like object
+    :param path:
+    :param mtime: Modified time set on the file. None keeps the current time
+    :param hash_algorithm: If given, the hash of the bytes written is calculated
+    :return: bytes written, hash of the bytes written as returned by checksum or None
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + ".restoring"
+    digest = hash_constructor(hash_algorithm)() if hash_algorithm else None
+    written = 0
+    try:
+        with open(partial, "wb") as f_out:
+            block = f_in.read(BLOCK_SIZE)
+            while block:
+                f_out.write(block)
+                if digest:
+                    digest.update(block)
+                written += len(block)
+                block = f_in.read(BLOCK_SIZE)
+        if mtime is not None:
+            os.utime(partial, (mtime, mtime))
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return written, hash_prefix(hash_algorithm) + digest.hexdigest() if digest else None
+
+
+def last_modified_time(metadata):
+    """
+    :param metadata: User metadata of the object
+    :return: Timestamp of the Local-Last-Modified date, None if the object doesn't have it
+    """
+    last_modified = metadata.get("local-last-modified")
+    if not last_modified:
+        return None
+    try:
+        return datetime.strptime(last_modified, "%Y-%m-%d").timestamp()
+    except ValueError:
+        return None
+
+
+def safe_path(root, relative):
+    """
+    :return: root joined with relative, None if relative would escape root
+    """
+    path = os.path.normpath(os.path.join(root, relative))
+    if path != root and not path.startswith(root.rstrip("/") + "/"):
+        return None
+    return path
+
+
+class Restorer:
+    """
+    Restores the objects of a config entry below root
+    """
+
+    def __init__(self, s3, bucket_name, s3_prefix_path, base_path, root, executor, encryption=None, encryptor=None,
+                 compressed=False, archive=False, prefix=None, part_size=8388608, read_ahead=4, retries=2):
+        """
+        :param s3: s3_client
+        :param bucket_name:
+        :param s3_prefix_path: Prefix the entry was backed up to
+        :param base_path: base_path of the entry
+        :param root: Directory the tree is rebuilt below
+        :param executor: Executor the ranged GETs run on
+        :param encryption: "gpg" or "aes-gcm" if the entry encrypts, else None
+        :param encryptor: AesGcmEncryptor, for aes-gcm
+        :param compressed: If True, the entry compresses
+        :param archive: If True, the entry archives the directories
+        :param prefix: Restore only the files below this path, relative to base_path
+        :param part_size: Size of each ranged GET
+        :param read_ahead: Number of ranged GETs fetched ahead
+        :param retries: Number of times an object whose decryption failed is restored again
+        """
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.s3_prefix_path = s3_prefix_path
+        self.base_path = base_path
+        self.root = root
+        self.executor = executor
+        self.encryption = encryption
+        self.encryptor = encryptor
+        self.compressed = compressed
+        self.archive = archive
+        self.prefix = prefix.strip("/") if prefix else None
+        self.part_size = part_size
+        self.read_ahead = read_ahead
+        self.retries = retries
+
+    def retried(self, function, *args):
+        """
+        Call function, again if the decryption failed. Many gpg processes at once sometimes fail to reach the secret
+        key in the gpg-agent, and a restored file is only renamed into place once complete
+        :return: Result of function
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args)
+            except EncryptionError as e:
+                if attempt == self.retries:
+                    raise
+                LOGGER.warning("Decryption failed [{}/{}], restoring again. {}".format(attempt + 1, self.retries + 1,
+                                                                                     e))
+                time.sleep(attempt + 1)
+
+    def objects(self):
+        """
+        List the objects of the entry, skipping the chunks of dedup mode and the packs of pack mode
+        :return: generator of (key, path relative to base_path, size, last modified)
+        """
+        list_prefix = self.s3_prefix_path + "/" if self.s3_prefix_path else ""
+        skipped = (list_prefix + ChunkStore.CHUNK_PREFIX + "/", list_prefix + PackStore.PACK_PREFIX + "/")
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=list_prefix):
+            for item in page.get("Contents", list()):
+                key = item["Key"]
+                if key.startswith(skipped) or key.endswith("/"):
+                    continue
+                yield key, key[len(list_prefix):], item["Size"], item["LastModified"]
+
+    def packed(self):
+        """
+        Read the indexes of the packs. A file packed again, after it changed, is taken from the latest pack
+        :return: dict of {path relative to base_path: (last modified of the index, pack key, member)}
+        """
+        list_prefix = (self.s3_prefix_path + "/" if self.s3_prefix_path else "") + PackStore.PACK_PREFIX + "/"
+        indexes = list()
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=list_prefix):
+            indexes.extend((item["LastModified"], item["Key"]) for item in page.get("Contents", list())
+                           if item["Key"].endswith(".index"))
+        indexes.sort()
+        members = dict()
+        for (last_modified, key), body in zip(indexes, self.executor.map(
+                lambda index: self.s3.get_object(Bucket=self.bucket_name, Key=index[1])["Body"].read(), indexes)):
+            index = json.loads(body)
+            for member in index["members"]:
+                if self.wanted(member["path"]):
+                    members[member["path"]] = (last_modified, index["pack"], member)
+        return members
+
+    def superseded(self, relative, last_modified, packed):
+        """
+        Choose between an object and the pack member of the same file, by which was uploaded later
+        :param relative: Path of the object relative to base_path
+        :param last_modified: Last modified time of the object
+        :param packed: dict returned by packed, the member is removed if the object is later
+        :return: True if the object is older than the pack member
+        """
+        name = relative[:-len(".recipe")] if relative.endswith(".recipe") else \
+            layers(relative, self.encryption, self.compressed)[0]
+        if name not in packed:
+            return False
+        if packed[name][0] > last_modified:
+            return True
+        del packed[name]
+        return False
+
+    def wanted(self, relative):
+        """
+        :param relative: Path relative to base_path
+        :return: True if relative is below the prefix restored
+        """
+        return not self.prefix or relative == self.prefix or relative.startswith(self.prefix + "/")
+
+    def wanted_archive(self, relative):
+        """
+        :param relative: Path of the archive relative to base_path, without .tar.gz
+        :return: True if the archive may have files below the prefix restored
+        """
+        return (not self.prefix or self.wanted(relative) or self.prefix.startswith(relative + "/") or
+                relative == os.path.basename(self.base_path))
+
+    def reader(self, key, size):
+        return RangedReader(self.s3, self.bucket_name, key, size, self.executor, self.part_size, self.read_ahead)
+
+    def restore(self, key, relative, size):
+        """
+        Restore an object
+        :param key:
+        :param relative: Path of the object relative to base_path
+        :param size: Size of the object
+        :return: files restored, bytes downloaded, bytes written. None if the object is not below the prefix restored
+        """
+        if relative.endswith(".recipe"):
+            if not self.wanted(relative[:-len(".recipe")]):
+                return None
+            return self.restore_recipe(key, relative[:-len(".recipe")], size)
+        if self.archive and relative.endswith(".tar.gz"):
+            if not self.wanted_archive(relative[:-len(".tar.gz")]):
+                return None
+            return self.restore_archive(key, relative, size)
+        name, decode = layers(relative, self.encryption, self.compressed)
+        if not self.wanted(name):
+            return None
+        path = safe_path(self.root, name)
+        if path is None:
+            raise ValueError("{} is outside of {}".format(name, self.root))
+        downloaded, written = self.restore_file(key, size, path, decode)
+        return 1, downloaded, written
+
+    def restore_file(self, key, size, path, decode):
+        """
+        Download and decode an object into path, verified against the Local-Hash of the object when it has one
+        :return: bytes downloaded, bytes written
+        """
+        reader = self.reader(key, size)
+        # Buffered, as the decoders expect a read to return all the bytes asked for till the end of the stream
+        f_in, readers = decoder(io.BufferedReader(reader, BLOCK_SIZE), decode, self.encryptor)
+        try:
+            metadata = reader.metadata
+            local_hash = metadata.get("local-hash")
+            written, digest = write_file(f_in, path, last_modified_time(metadata),
+                                         hash_algorithm_of(local_hash) if local_hash else None)
+        finally:
+            for stream in reversed(readers):
+                stream.close()
+            reader.close()
+        if local_hash and digest != local_hash:
+            os.remove(path)
+            raise ValueError("{} doesn't match the Local-Hash of the object".format(path))
+        return reader.downloaded, written
+
+    def restore_archive(self, key, relative, size):
+        """
+        Extract the members of an archive, decoding each by its suffixes. The members compressed or encrypted get the
+        date of the archive, the others keep their own modified time
+        :return: files restored, bytes downloaded, bytes written
+        """
+        # The archive is uploaded below the parent of the archived directory, and its members begin with its name.
+        # The archive of base_path itself is uploaded at the top, named after base_path
+        parent = relative[:relative.rindex("/")] if "/" in relative else ""
+        top = not parent and relative[:-len(".tar.gz")] == os.path.basename(self.base_path)
+        reader = self.reader(key, size)
+        files, written = 0, 0
+        try:
+            mtime = last_modified_time(reader.metadata)
+            with tarfile.open(fileobj=io.BufferedReader(reader, BLOCK_SIZE), mode="r|gz") as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    name, decode = layers(member.name, self.encryption, self.compressed)
+                    if top:
+                        member_relative = name.split("/", 1)[-1]
+                    else:
+                        member_relative = parent + "/" + name if parent else name
+                    if not self.wanted(member_relative):
+                        continue
+                    path = safe_path(self.root, member_relative)
+                    if path is None:
+                        raise ValueError("{} of {} is outside of {}".format(member.name, key, self.root))
+                    f_in, readers = decoder(archive.extractfile(member), decode, self.encryptor)
+                    try:
+                        written += write_file(f_in, path, mtime if decode else member.mtime)[0]
+                    finally:
+                        for stream in reversed(readers):
+                            stream.close()
+                    files += 1
+        finally:
+            reader.close()
+        return files, reader.downloaded, written
+
+    def fetch_member(self, pack, member):
+        """
+        GET and decode a pack member in memory, with a ranged GET of the pack. Runs in the executor
+        :return: bytes downloaded, file
+        """
+        if not member["length"]:
+            return 0, b""
+        body = self.s3.get_object(Bucket=self.bucket_name, Key=pack, Range="bytes={}-{}".format(
+            member["offset"], member["offset"] + member["length"] - 1))["Body"].read()
+        decode = [member["encryption"]] if member["encryption"] else list()
+        if member["codec"] != "none":
+            decode.append(member["codec"])
+        f_in, readers = decoder(io.BytesIO(body), decode, self.encryptor)
+        try:
+            return len(body), f_in.read()
+        finally:
+            for stream in reversed(readers):
+                stream.close()
+
+    def restore_pack(self, pack, members):
+        """
+        Restore the files of a pack, read_ahead members fetched concurrently ahead of the one written
+        :param pack: Key of the pack
+        :param members: Members of the index to restore
+        :return: files restored, bytes downloaded, bytes written
+        """
+        pending = collections.deque()
+        members = iter(sorted(members, key=lambda member: member["offset"]))
+        files, downloaded, written = 0, 0, 0
+        try:
+            for member in members:
+                pending.append((member, self.executor.submit(self.fetch_member, pack, member)))
+                if len(pending) >= self.read_ahead:
+                    break
+            while pending:
+                member, future = pending.popleft()
+                for next_member in members:
+                    pending.append((next_member, self.executor.submit(self.fetch_member, pack, next_member)))
+                    break
+                member_downloaded, data = future.result()
+                downloaded += member_downloaded
+                path = safe_path(self.root, member["path"])
+                if path is None:
+                    raise ValueError("{} of {} is outside of {}".format(member["path"], pack, self.root))
+                _, digest = write_file(io.BytesIO(data), path,
+                                       last_modified_time({"local-last-modified": member["last_modified"]}),
+                                       hash_algorithm_of(member["hash"]) if member["hash"] else None)
+                if member["hash"] and digest != member["hash"]:
+                    os.remove(path)
+                    raise ValueError("{} doesn't match the hash in the index of {}".format(path, pack))
+                files += 1
+                written += len(data)
+        finally:
+            for _, future in pending:
+                future.cancel()
+        return files, downloaded, written
+
+    def fetch_chunk(self, chunk_prefix, name):
+        """
+        GET and decode a chunk in memory. Runs in the executor
+        :return: bytes downloaded, chunk
+        """
+        body = self.s3.get_object(Bucket=self.bucket_name, Key=chunk_prefix + "/" + name)["Body"].read()
+        _, decode = layers(name, self.encryption, True)
+        f_in, readers = decoder(io.BytesIO(body), decode, self.encryptor)
+        try:
+            return len(body), f_in.read()
+        finally:
+            for stream in reversed(readers):
+                stream.close()
+
+    def restore_recipe(self, key, relative, size):
+        """
+        Restore a file of dedup mode from its chunks, read_ahead chunks fetched concurrently ahead of the one written
+        :return: files restored, bytes downloaded, bytes written
+        """
+        path = safe_path(self.root, relative)
+        if path is None:
+            raise ValueError("{} is outside of {}".format(relative, self.root))
+        response = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+        recipe = json.loads(response["Body"].read())
+        downloaded = [size]
+        names = iter(recipe["chunks"])
+        pending = collections.deque()
+
+        def chunks():
+            for name in names:
+                pending.append(self.executor.submit(self.fetch_chunk, recipe["chunk_prefix"], name))
+                if len(pending) >= self.read_ahead:
+                    break
+            while pending:
+                chunk_downloaded, chunk = pending.popleft().result()
+                downloaded[0] += chunk_downloaded
+                for name in names:
+                    pending.append(self.executor.submit(self.fetch_chunk, recipe["chunk_prefix"], name))
+                    break
+                yield chunk
+
+        try:
+            written = write_file(BlockReader(chunks()), path, last_modified_time(response.get("Metadata", dict())))[0]
+        finally:
+            for future in pending:
+                future.cancel()
+        if written != recipe["size"]:
+            raise ValueError("{} restored {} bytes of {}".format(path, written, recipe["size"]))
+        return 1, downloaded[0], written
+
+
+def restore_entry(name, a_config, target=None, prefix=None, workers=8, part_size=8388608, read_ahead=4):
+    """
+    Restore the base_path of a config entry
+    :param name: Name of the entry in the config
+    :param a_config: Entry of backup_config.json
+    :param target: Directory to restore into, below a directory named after the entry. None restores to base_path
+    :param prefix: Restore only the files below this path, relative to base_path
+    :param workers: Number of objects restored concurrently
+    :param part_size: Size of each ranged GET
+    :param read_ahead: Number of ranged GETs of an object fetched ahead
+    :return:
+    """
+    base_path = a_config["base_path"].rstrip("/")
+    bucket_name = a_config["bucket_name"]
+    s3_prefix_path = a_config["s3_prefix_path"].rstrip("/")
+    aws_profile = a_config["aws_profile"]
+    encryption = fetch_optional_config(a_config, "encryption", default="gpg") if a_config["encrypt"] else None
+    encryptor = None
+    if encryption == "aes-gcm":
+        try:
+            encryptor = open_encryptor(encryption, None,
+                                       fetch_optional_config(a_config, "encryption_key_file", default=None))
+        except (EncryptionError, OSError, ValueError) as e:
+            print("Encryption is not configured correctly for {}. {}".format(base_path, e))
+            LOGGER.error("Encryption is not configured correctly for {}. {}".format(base_path, e))
+            return
+        if not isinstance(encryptor, AesGcmEncryptor):
+            return
+    s3_endpoint_url = fetch_optional_config(a_config, "s3_endpoint_url", default=None)
+    root = os.path.join(os.path.abspath(target), name) if target else base_path
+
+    session = boto3.session.Session(profile_name=aws_profile)
+    s3 = s3_client(session, s3_endpoint_url, max(10, workers * read_ahead))
+    executor = ThreadPoolExecutor(max_workers=workers * read_ahead, thread_name_prefix="get")
+    restorer = Restorer(s3, bucket_name, s3_prefix_path, base_path, root, executor, encryption, encryptor,
+                        a_config["compress"], fetch_optional_config(a_config, "archive", default=False), prefix,
+                        part_size, read_ahead)
+    print("{}".format("".join(["-"] * 75)))
+    print("Restoring s3://{}/{} to {}".format(bucket_name, s3_prefix_path, root))
+    LOGGER.info("Restoring s3://{}/{} to {}".format(bucket_name, s3_prefix_path, root))
+    progress = Progress("Restored [{restored}] files, [{objects}] objects, Failed [{failed}]")
+    start = time.time()
+    pending = dict()
+
+    def collect(done):
+        for future in done:
+            key = pending.pop(future)
+            try:
+                restored = future.result()
+            except (ClientError, BotoCoreError, EncryptionError, OSError, ValueError, EOFError,
+                    tarfile.TarError) as e:
+                LOGGER.error("Couldn't restore {}. {}".format(key, e))
+                print("\nCouldn't restore {}. {}".format(key, e))
+                progress.add("failed")
+                continue
+            if restored is None:
+                continue
+            files, downloaded, written = restored
+            progress.add("objects")
+            progress.add("restored", files)
+            progress.add("downloaded_bytes", downloaded)
+            progress.add("written_bytes", written)
+        progress.draw()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="restore") as object_executor:
+            packed = restorer.packed()
+            for key, relative, size, last_modified in restorer.objects():
+                if packed and restorer.superseded(relative, last_modified, packed):
+                    continue
+                pending[object_executor.submit(restorer.retried, restorer.restore, key, relative, size)] = key
+                if len(pending) >= workers * 2:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            # The members are restored after the listing, once the files uploaded later on their own are known
+            packs = collections.defaultdict(list)
+            for _, pack, member in packed.values():
+                packs[pack].append(member)
+            for pack, members in packs.items():
+                pending[object_executor.submit(restorer.retried, restorer.restore_pack, pack, members)] = pack
+                if len(pending) >= workers * 2:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            collect(wait(pending).done)
+    except (ClientError, BotoCoreError) as e:
+        print("\nCouldn't list s3://{}/{}. {}".format(bucket_name, s3_prefix_path, e))
+        LOGGER.error("Couldn't list s3://{}/{}. {}".format(bucket_name, s3_prefix_path, e))
+    finally:
+        executor.shutdown()
+    progress.end()
+    elapsed = time.time() - start
+    counters = progress.counters
+    print("Restore Time [{:.4f}]s, Downloaded [{:.2f}] MB/s, Written [{:.2f}] MB/s".format(
+        elapsed, counters["downloaded_bytes"] / 1048576 / max(elapsed, 1e-6),
+        counters["written_bytes"] / 1048576 / max(elapsed, 1e-6)))
+    LOGGER.info("Restored {} in {}s, {}".format(root, elapsed, dict(counters)))
+
+
+def main():
+    os.environ["AWS_CONFIG_FILE"] = os.path.join(os.getcwd(), ".aws/config")
+    os.environ["AWS_SHARED_CREDENTIALS_FILE"] = os.path.join(os.getcwd(), ".aws/credentials")
+    start_entire = time.time()
+
+    parser = ArgumentParser()
+    parser.add_argument("-c", "--config", help="Test Configuration Path", type=str, metavar="", dest="config_path",
+                        default=None)
+    parser.add_argument("-t", "--target", help="Directory to restore into, below a directory per config entry. "
+                                               "By default each base_path", type=str, metavar="", default=None)
+    parser.add_argument("-e", "--entry", help="Restore only this config entry", type=str, metavar="", default=None)
+    parser.add_argument("-p", "--prefix", help="Restore only the files below this path, relative to base_path",
+                        type=str, metavar="", default=None)
+    parser.add_argument("-w", "--workers", help="Number of objects restored concurrently", type=int, metavar="",
+                        default=8)
+    parser.add_argument("--part_size", help="Size of each ranged GET", type=int, metavar="", default=8388608)
+    parser.add_argument("--read_ahead", help="Number of ranged GETs of an object fetched ahead of the one being "
+                                             "decoded", type=int, metavar="", default=4)
+    args = parser.parse_args()
+    if args.config_path:
+        config_file = args.config_path
+    else:
+        config_file = os.path.join(os.getcwd(), "backup_config.json")
+
+    LOGGER.info("Reading config from {}".format(config_file))
+    try:
+        with open(config_file, "r") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        print("Configuration file Not found.")
+        LOGGER.exception("Configuration file Not found. Stack trace")
+        exit(0)
+    except json.decoder.JSONDecodeError:
+        print("Configuration file is not a valid json file.")
+        LOGGER.exception("Configuration file is not a valid json file. Stack trace")
+        exit(0)
+
+    for name, a_config in config.items():
+        if args.entry and name != args.entry:
+            continue
+        restore_entry(name, a_config, args.target, args.prefix, args.workers, args.part_size, args.read_ahead)
+
+    print("\n{}".format("".join(["-"] * 75)))
+    print("Total Time [{:.4f}]s".format(time.time() - start_entire))
+    LOGGER.info("Total Time [{:.4f}]s".format(time.time() - start_entire))
+
+
+if __name__ == "__main__":
+    main()